@@ -0,0 +1,117 @@
+# Benchmark comparing the old three-commit award path with the single transaction posting service.
+#
+# Several threads award points to the same student at once. The benchmark reports awards per second
+# and checks the final balance against the number of successful awards, to show whether updates were lost.
+#
+# Usage: python benchmarks/bench_award_posting.py [--threads 8] [--awards 200]
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from website import create_app, db
+from website.models import Role, User, Account, Transactions, TeacherQuota
+from website.posting import post_award, PostingError
+from website.roles import roles
+
+
+# Function to create a scratch database with one teacher and one student
+def seed(app, total_points):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for name in ('admin', 'teacher', 'student'):
+            db.session.add(Role(name=name))
+        db.session.commit()
+        # Look the role ids up rather than assuming the order they were created in
+        roles.load()
+        teacher = User(email='teacher@bench', first_name='Bench', last_name='Teacher', role_id=roles.id('teacher'), role_approved=True, weekly_point_limit=total_points, points_awarded_this_week=0)
+        student = User(email='student@bench', first_name='Bench', last_name='Student', role_id=roles.id('student'))
+        db.session.add_all([teacher, student])
+        db.session.commit()
+        db.session.add_all([Account(user_id=teacher.id, balance=0, points_awarded=0), Account(user_id=student.id, balance=0)])
+        db.session.commit()
+        return teacher.id, student.id
+
+
+# The award path as it was before the posting service: read-modify-write in Python with three commits
+def legacy_award(teacher_id, student_id, points):
+    teacher = User.query.get(teacher_id)
+    today = datetime.utcnow().date()
+    awarded_this_week = teacher.points_awarded_this_week if teacher.last_award_date and teacher.last_award_date.isocalendar()[1] == today.isocalendar()[1] else 0
+    if teacher.weekly_point_limit - awarded_this_week < points:
+        raise PostingError('You do not have enough points to award.')
+    student_account = Account.query.filter_by(user_id=student_id).first()
+    student_account.balance += points
+    db.session.commit()
+    teacher_account = Account.query.filter_by(user_id=teacher_id).first()
+    teacher_account.points_awarded += points
+    teacher.points_awarded_this_week += points
+    teacher.last_award_date = datetime.utcnow().date()
+    db.session.commit()
+    db.session.add(Transactions(sequence=1, from_account_id=teacher_id, dateTime=datetime.utcnow(), to_account_id=student_id, amount=points))
+    db.session.commit()
+
+
+# The award path through the posting service
+def service_award(teacher_id, student_id, points):
+    post_award(User.query.get(teacher_id), student_id, points)
+
+
+# Function to run the given award function from several threads and report throughput and lost updates
+def run(app, name, award, threads, awards):
+    teacher_id, student_id = seed(app, threads * awards)
+    successes = [0] * threads
+    errors = [0] * threads
+
+    def worker(index):
+        # Each thread gets its own application context, and therefore its own session
+        with app.app_context():
+            for _ in range(awards):
+                try:
+                    award(teacher_id, student_id, 1)
+                    successes[index] += 1
+                except Exception:
+                    db.session.rollback()
+                    errors[index] += 1
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        balance = Account.query.filter_by(user_id=student_id).first().balance
+        # The legacy path counts the week on the user, the posting service in this week's quota row
+        quota_row = TeacherQuota.query.filter_by(teacher_id=teacher_id).first()
+        awarded = quota_row.points_awarded if quota_row else User.query.get(teacher_id).points_awarded_this_week
+        ledger = Transactions.query.count()
+
+    succeeded = sum(successes)
+    print(f'{name:8} {succeeded / elapsed:9.1f} awards/s  succeeded={succeeded} errors={sum(errors)} '
+          f'balance={balance} quota_used={awarded} ledger_rows={ledger} lost_updates={succeeded - balance}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--awards', type=int, default=200, help='awards per thread')
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database, 'METRICS_DIR': os.path.join(os.path.dirname(database), 'metrics')})
+
+    run(app, 'legacy', legacy_award, args.threads, args.awards)
+    run(app, 'service', service_award, args.threads, args.awards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Benchmark comparing the old probe loop in Coupon.generate_code with claiming codes from the pre-generated pool.
+#
+# The scratch database is first filled with --issued coupons that already hold a code (1M by default), then both
+# allocators issue --claims coupons. The benchmark reports the time and queries per coupon and checks uniqueness.
+# At this size random collisions are still rare, so the probe loop mostly costs one query, as does the pool's claim, a single
+# DELETE ... RETURNING. The pool's gain is that the claim never probes the coupon table's index and that concurrent purchases
+# cannot pick the same code.
+#
+# Usage: python benchmarks/bench_coupon_codes.py [--issued 1000000] [--claims 2000]
+import argparse
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event, func
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from website import create_app, db
+from website.models import Coupon
+from website.coupons import claim_code, fill_pool, generate_codes
+
+
+# The allocator as it was before the pool: draw random codes until one is not in the coupon table
+def legacy_generate_code():
+    code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    while Coupon.query.filter_by(code=code).first() is not None:
+        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
+    return code
+
+
+# Function to insert already issued coupons, each holding a unique code
+def seed_issued(issued, batch_size=50000):
+    while issued > 0:
+        codes = list(generate_codes(min(batch_size, issued)))
+        db.session.execute(Coupon.__table__.insert(), [
+            {'student_id': 1, 'name': 'Pen', 'description': 'A high-quality pen', 'points_cost': 10, 'code': code, 'redeemed': False}
+            for code in codes
+        ])
+        db.session.commit()
+        issued -= len(codes)
+
+
+# Function to issue claims coupons with an allocator, each in its own transaction as a purchase would, and report time and queries per code
+def measure(name, allocate, claims, counter):
+    counter[0] = 0
+    codes = []
+    started = time.perf_counter()
+    for _ in range(claims):
+        code = allocate()
+        db.session.execute(Coupon.__table__.insert(), {'student_id': 1, 'name': 'Pen', 'description': 'A high-quality pen', 'points_cost': 10, 'code': code, 'redeemed': False})
+        db.session.commit()
+        codes.append(code)
+    elapsed = time.perf_counter() - started
+    print(f'{name:7} {elapsed / claims * 1e6:8.1f} us/coupon  {counter[0] / claims:5.2f} queries/coupon  unique={len(set(codes)) == len(codes)}')
+    return codes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--issued', type=int, default=1000000, help='coupons already issued before measuring')
+    parser.add_argument('--claims', type=int, default=2000, help='codes allocated by each allocator')
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database, 'METRICS_DIR': os.path.join(os.path.dirname(database), 'metrics')})
+
+    with app.app_context():
+        started = time.perf_counter()
+        seed_issued(args.issued)
+        print(f'seeded {args.issued} issued codes in {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        fill_pool(args.claims)
+        print(f'filled the pool with {args.claims} codes in {time.perf_counter() - started:.2f}s')
+
+        counter = [0]
+        event.listen(db.engine, 'before_cursor_execute', lambda *_: counter.__setitem__(0, counter[0] + 1))
+        measure('legacy', legacy_generate_code, args.claims, counter)
+        pooled = measure('pool', claim_code, args.claims, counter)
+
+        # Every coupon code must still be unique after both runs
+        duplicates = db.session.query(Coupon.code).group_by(Coupon.code).having(func.count(Coupon.id) > 1).count()
+        print(f'duplicate coupon codes: {duplicates}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Benchmark of concurrent writes under different database settings.
+#
+# Writer processes post awards through the posting service, each from its own teacher to its own student, while
+# reader processes load balances and ledger pages like the dashboards do. Each mode runs against a fresh database
+# and reports writes and reads per second, the 95th percentile write latency, and how many writes failed
+# with "database is locked".
+#
+#   legacy    SQLite with no pragmas and no connection pool, as the app ran before config.py
+#   wal       SQLite with the defaults from config.py (pooled connections, WAL, synchronous=NORMAL, busy_timeout, cache and mmap)
+#   wal-full  the same but with synchronous=FULL, to show what the relaxed syncing is worth
+#   postgres  the database at --postgres, if given
+#
+# Usage: python benchmarks/bench_database_modes.py [--writers 4] [--readers 2] [--seconds 5] [--postgres postgresql://localhost/bench]
+import argparse
+import os
+import sys
+import tempfile
+import multiprocessing
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import insert
+from sqlalchemy.exc import OperationalError
+from website import create_app, db, ledger
+from website.models import Role, User, Account
+from website.posting import post_award
+from website.roles import roles
+
+# No pragmas, and no engine options so SQLite file connections are opened per checkout as before
+LEGACY = {name: None for name in ('SQLITE_JOURNAL_MODE', 'SQLITE_SYNCHRONOUS', 'SQLITE_BUSY_TIMEOUT', 'SQLITE_CACHE_SIZE', 'SQLITE_MMAP_SIZE')}
+LEGACY['SQLALCHEMY_ENGINE_OPTIONS'] = {}
+MODES = {
+    'legacy': LEGACY,
+    'wal': {},
+    'wal-full': {'SQLITE_SYNCHRONOUS': 'FULL'},
+}
+
+
+# Function to create one teacher and one student per writer, returning their (teacher id, student id, student account id)
+def seed(app, writers):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.execute(insert(Role), [{'name': name} for name in ('admin', 'teacher', 'student')])
+        db.session.execute(insert(User), [
+            {'email': f'{kind}{n}@bench', 'first_name': 'Bench', 'last_name': f'{kind}{n}', 'user_name': f'{kind}{n}',
+             'role_id': 2 if kind == 'teacher' else 3, 'role_approved': True, 'weekly_point_limit': 10 ** 9}
+            for n in range(writers) for kind in ('teacher', 'student')
+        ])
+        users = {user.email: user.id for user in User.query}
+        db.session.execute(insert(Account), [{'user_id': user_id, 'balance': 0, 'points_awarded': 0} for user_id in users.values()])
+        db.session.commit()
+        accounts = {account.user_id: account.id for account in Account.query}
+        roles.load()
+        return [(users[f'teacher{n}@bench'], users[f'student{n}@bench'], accounts[users[f'student{n}@bench']]) for n in range(writers)]
+
+
+# Function to post awards until the deadline in its own process, like one application server worker
+def writer(config, pair, deadline, results):
+    app = create_app(config)
+    teacher_id, student_id, _ = pair
+    latencies = []
+    locked = 0
+    with app.app_context():
+        teacher = db.session.get(User, teacher_id)
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                post_award(teacher, student_id, 1)
+                latencies.append(time.perf_counter() - started)
+            except OperationalError:
+                db.session.rollback()
+                locked += 1
+    results.put(('write', latencies, locked))
+
+
+# Function to load balances and ledger pages until the deadline in its own process, like the dashboards do
+def reader(config, pair, deadline, results):
+    app = create_app(config)
+    reads = 0
+    locked = 0
+    with app.app_context():
+        while time.time() < deadline:
+            try:
+                ledger.current_balance(pair[2])
+                ledger.ledger_page({})
+                reads += 1
+            except OperationalError:
+                locked += 1
+            db.session.rollback()
+    results.put(('read', reads, locked))
+
+
+# Function to run writer and reader processes for the given time and print the results for one mode
+def run(name, config, writers, readers, seconds):
+    pairs = seed(create_app(config), writers)
+    # Leave the processes time to start before the clock starts
+    started = time.time() + 2
+    deadline = started + seconds
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=writer, args=(config, pairs[index], deadline, results)) for index in range(writers)]
+    processes += [multiprocessing.Process(target=reader, args=(config, pairs[index % writers], deadline, results)) for index in range(readers)]
+    for process in processes:
+        process.start()
+
+    latencies = []
+    reads = 0
+    locked = 0
+    for _ in processes:
+        kind, value, failures = results.get()
+        if kind == 'write':
+            latencies.extend(value)
+        else:
+            reads += value
+        locked += failures
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float('nan')
+    print(f'{name:9} {len(latencies) / seconds:9.1f} writes/s {reads / seconds:9.1f} reads/s  '
+          f'p95 write {p95:7.2f} ms  locked={locked}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--postgres', help='URL of a scratch PostgreSQL database to include, its tables are dropped')
+    args = parser.parse_args()
+
+    for name, overrides in MODES.items():
+        scratch = tempfile.mkdtemp()
+        config = {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(scratch, 'bench.db'), 'METRICS_DIR': os.path.join(scratch, 'metrics')}
+        run(name, {**config, **overrides}, args.writers, args.readers, args.seconds)
+    if args.postgres:
+        run('postgres', {'SQLALCHEMY_DATABASE_URI': args.postgres, 'METRICS_DIR': os.path.join(tempfile.mkdtemp(), 'metrics')}, args.writers, args.readers, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
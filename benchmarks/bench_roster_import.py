@@ -0,0 +1,96 @@
+# Benchmark of importing a roster of students, against creating them one at a time the way sign-up does.
+#
+# Generates a CSV roster of students spread over a few classes and imports it with the roster importer, then creates a
+# sample of the same students one by one (hash, username, user commit, account commit) and extrapolates.
+#
+# Usage: python benchmarks/bench_roster_import.py [--students 5000] [--workers 4] [--sample 500]
+import argparse
+import io
+import os
+import csv
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from werkzeug.security import generate_password_hash
+from website import create_app, db
+from website.models import User, Account, Class, student_class
+from website.naming import allocate_username
+from website.roles import roles
+from website.roster import import_roster
+from website.seed import seed
+
+FIRST_NAMES = ['Amelia', 'Oliver', 'Isla', 'George', 'Ava', 'Noah', 'Mia', 'Arthur', 'Ivy', 'Leo']
+LAST_NAMES = ['Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Patel', 'Wright']
+CLASSES = 40
+
+
+# Function to build a roster CSV of students, each enrolled in two of the classes
+def roster_csv(students, class_names):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=['email', 'first_name', 'last_name', 'password', 'role', 'classes'])
+    writer.writeheader()
+    for n in range(students):
+        writer.writerow({
+            'email': f'student{n}@bench', 'first_name': FIRST_NAMES[n % 10], 'last_name': LAST_NAMES[n // 10 % 10],
+            'password': 'Secret!123', 'role': 'student',
+            'classes': ';'.join({class_names[n % len(class_names)], class_names[n * 7 % len(class_names)]}),
+        })
+    return output.getvalue()
+
+
+# Function to create a scratch database with the default users and a set of classes
+def make_app():
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database, 'METRICS_DIR': os.path.join(os.path.dirname(database), 'metrics')})
+    with app.app_context():
+        seed()
+        teacher = User.query.filter_by(email='teacher@Kimberley.com').first()
+        db.session.add_all([Class(name=f'BENCH{n}', year_group=7 + n % 5, subject_id=1 + n % 8, teacher_id=teacher.id) for n in range(CLASSES)])
+        db.session.commit()
+    return app
+
+
+# The sign-up path: hash, allocate a username, and commit the user and its account separately
+def sign_up_one(person):
+    user = User(email=person['email'], first_name=person['first_name'], last_name=person['last_name'],
+                user_name=allocate_username(person['first_name'], person['last_name']),
+                password=generate_password_hash(person['password'], method='sha256'), role_id=roles.id('student'))
+    db.session.add(user)
+    db.session.commit()
+    db.session.add(Account(user=user, balance=0))
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--sample', type=int, default=500, help='students created one at a time for the comparison')
+    args = parser.parse_args()
+
+    app = make_app()
+    roster = roster_csv(args.students, [f'BENCH{n}' for n in range(CLASSES)])
+    with app.app_context():
+        result = import_roster(csv.DictReader(io.StringIO(roster)), args.workers)
+        users = User.query.filter(User.email.like('%@bench')).count()
+        accounts = db.session.query(Account).join(User, User.id == Account.user_id).filter(User.email.like('%@bench')).count()
+        enrolments = db.session.query(student_class).count()
+    print(f'roster    {result.imported} students in {result.seconds:6.2f}s  {result.rows_per_second:8.0f} rows/s  '
+          f'errors={len(result.errors)} users={users} accounts={accounts} enrolments={enrolments}')
+
+    app = make_app()
+    people = list(csv.DictReader(io.StringIO(roster_csv(args.sample, ['BENCH0']))))
+    with app.app_context():
+        started = time.perf_counter()
+        for person in people:
+            sign_up_one(person)
+        elapsed = time.perf_counter() - started
+    print(f'sign-up   {len(people)} students in {elapsed:6.2f}s  {len(people) / elapsed:8.0f} rows/s  '
+          f'(about {args.students / (len(people) / elapsed):.0f}s for {args.students})')
+
+
+if __name__ == '__main__':
+    main()
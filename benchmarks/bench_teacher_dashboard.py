@@ -0,0 +1,109 @@
+# Benchmark of the teacher dashboard and join request pages on a large school.
+#
+# Creates many teachers with a few classes each and a large number of join requests spread over their classes,
+# then logs in as teachers with few and with many requests and times their pages. The time of each page should
+# depend on the size of that teacher's own classes, not on the size of the school.
+#
+# Usage: python benchmarks/bench_teacher_dashboard.py [--teachers 200] [--requests 50000] [--rounds 20]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from statistics import median
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import insert, event, func
+from werkzeug.security import generate_password_hash
+from website import create_app, db
+from website.models import Role, User, Class, JoinRequest
+
+CLASSES_PER_TEACHER = 5
+STATUSES = ['pending', 'accepted', 'rejected']
+
+
+# Function to create a scratch school, returning the teacher ids ordered from fewest to most join requests and each teacher's request count
+def seed(app, teachers, requests):
+    generator = random.Random(0)
+    password = generate_password_hash('secret', method='sha256')
+    with app.app_context():
+        db.session.execute(insert(Role), [{'name': name} for name in ('admin', 'teacher', 'student')])
+        db.session.execute(insert(User), [
+            {'email': f'teacher{n}@bench', 'first_name': 'Bench', 'last_name': f'Teacher{n}', 'password': password,
+             'role_id': 2, 'role_approved': True, 'user_name': f'T{n}'}
+            for n in range(teachers)
+        ])
+        students = max(requests // 10, 1)
+        db.session.execute(insert(User), [
+            {'email': f'student{n}@bench', 'first_name': 'Bench', 'last_name': f'Student{n}', 'role_id': 3, 'user_name': f'S{n}'}
+            for n in range(students)
+        ])
+        teacher_ids = [row.id for row in db.session.query(User.id).filter(User.role_id == 2).order_by(User.id)]
+        student_ids = [row.id for row in db.session.query(User.id).filter(User.role_id == 3)]
+        db.session.execute(insert(Class), [
+            {'name': f'C{teacher_id}-{n}', 'year_group': 7 + n, 'teacher_id': teacher_id}
+            for teacher_id in teacher_ids for n in range(CLASSES_PER_TEACHER)
+        ])
+        class_ids = [row.id for row in db.session.query(Class.id)]
+
+        # Skew the requests so a few classes are much busier than the rest, each (student, class) pair only once
+        pairs = set()
+        while len(pairs) < requests:
+            pairs.add((generator.choice(student_ids), class_ids[min(int(generator.paretovariate(1.2)) - 1, len(class_ids) - 1)]
+                       if generator.random() < 0.3 else generator.choice(class_ids)))
+        db.session.execute(insert(JoinRequest), [
+            {'student_id': student_id, 'class_id': class_id, 'status': generator.choice(STATUSES)} for student_id, class_id in pairs
+        ])
+        db.session.commit()
+
+        counts = dict(
+            db.session.query(Class.teacher_id, func.count(JoinRequest.id))
+            .join(JoinRequest, JoinRequest.class_id == Class.id)
+            .group_by(Class.teacher_id)
+        )
+        return sorted(teacher_ids, key=lambda teacher_id: counts.get(teacher_id, 0)), counts
+
+
+# Function to time a page for one teacher, returning the median time in milliseconds, queries is left holding the last request's statements
+def time_page(client, path, rounds, queries):
+    timings = []
+    for _ in range(rounds):
+        queries.clear()
+        started = time.perf_counter()
+        response = client.get(path)
+        timings.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, response.status_code
+    return median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teachers', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=50000)
+    parser.add_argument('--rounds', type=int, default=20)
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database, 'METRICS_DIR': os.path.join(os.path.dirname(database), 'metrics'), 'JOBS_INLINE': False})
+    teacher_ids, counts = seed(app, args.teachers, args.requests)
+    # Count the statements each page sends to the database
+    queries = []
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: queries.append(1))
+    print(f'{args.teachers} teachers, {args.teachers * CLASSES_PER_TEACHER} classes, {args.requests} join requests')
+
+    # Compare the quietest, a typical and the busiest teacher
+    for label, teacher_id in (('quietest', teacher_ids[0]), ('median', teacher_ids[len(teacher_ids) // 2]), ('busiest', teacher_ids[-1])):
+        with app.app_context():
+            email = db.session.get(User, teacher_id).email
+        client = app.test_client()
+        client.post('/login', data={'email': email, 'password': 'secret'})
+        for path in ('/teacher', '/join_request?filter=pending', '/join_request?filter=all'):
+            elapsed = time_page(client, path, args.rounds, queries)
+            print(f'{label:8} requests={counts.get(teacher_id, 0):6} {path:30} {elapsed:8.2f} ms  queries={len(queries)}')
+
+
+if __name__ == '__main__':
+    main()
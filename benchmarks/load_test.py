@@ -0,0 +1,605 @@
+# Load test of every route in auth.py, views.py and api.py on a synthetic school.
+#
+# Seeds a scratch database through create_app with N students, M teachers, K classes and T ledger transactions, then
+# drives every route from several threads at once with the Flask test client, each thread logged in as its own admin,
+# teacher and student. Reports p50/p95/p99 latency, queries per request and throughput for each route. The results can
+# be saved as a JSON baseline, and a later run compared against it fails if a route got slower or sends more queries.
+#
+# Usage: python benchmarks/load_test.py [--students 2000] [--teachers 50] [--classes 200] [--transactions 50000]
+#                                       [--threads 4] [--rounds 20] [--save baseline.json] [--compare baseline.json]
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import insert, select, update, event, literal
+from werkzeug.security import generate_password_hash
+from website import create_app, db, ledger, rollups, quota, coupons
+from website.models import User, Account, Class, Subject, JoinRequest, Transactions, Coupon, TeacherRequestHistory, student_class
+from website.roles import roles
+
+PASSWORD = 'secret'
+ADMIN_EMAIL = 'admin@Kimberley.com'
+CLASSES_PER_STUDENT = 3
+JOIN_REQUESTS_PER_STUDENT = 2
+PURCHASE_SHARE = 0.05
+INSERT_BATCH_SIZE = 1000
+
+# A route is only reported as slower than its baseline if its p95 grew by more than the tolerance and by at least this much
+NOISE_FLOOR_MS = 2.0
+
+
+# Scratch data shared by the worker threads: which users each thread logs in as and the pools of one-off ids that
+# write routes use up, e.g. a join request can only be accepted once
+class School:
+    def __init__(self):
+        self.teachers = []
+        self.students = []
+        self.teacher_classes = defaultdict(list)
+        self.pending_requests = defaultdict(deque)
+        self.free_pairs = defaultdict(deque)
+        self.coupons = defaultdict(deque)
+        self.applicants = deque()
+        self.subject_ids = []
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    # Get a number no other thread has been given, for unique sign-up emails
+    def next_number(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+
+
+# Function to split a list into lists of at most size items
+def chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+# Function to insert many rows in batches
+def insert_rows(table, rows):
+    for batch in chunks(rows, INSERT_BATCH_SIZE):
+        db.session.execute(insert(table), batch)
+
+
+# Function to create the synthetic school, returning the School the workers draw their users and one-off ids from
+def seed(app, args):
+    generator = random.Random(0)
+    school = School()
+    # Every thread uses up one of each one-off id per round, with some to spare
+    one_off = (args.rounds + args.warmup) * 2
+
+    # The default roles, subjects and users come from the seed command, so the admin can log in with the usual password
+    app.test_cli_runner().invoke(args=['seed'])
+    with app.app_context():
+        password = generate_password_hash(PASSWORD, method='sha256')
+        teacher_role, student_role = roles.id('teacher'), roles.id('student')
+        school.subject_ids = [subject_id for (subject_id,) in db.session.query(Subject.id)]
+
+        # Teachers get a limit no run can reach, so award routes keep succeeding
+        insert_rows(User, [
+            {'email': f'teacher{n}@load.test', 'password': password, 'first_name': 'Load', 'last_name': f'Teacher{n}', 'user_name': f'LT{n}',
+             'role_id': teacher_role, 'role_approved': True, 'weekly_point_limit': 10 ** 9}
+            for n in range(args.teachers)
+        ])
+        insert_rows(User, [
+            {'email': f'student{n}@load.test', 'password': password, 'first_name': 'Load', 'last_name': f'Student{n}', 'user_name': f'LS{n}',
+             'role_id': student_role}
+            for n in range(args.students)
+        ])
+        # Pending teacher applications for the admin to approve
+        insert_rows(User, [
+            {'email': f'applicant{n}@load.test', 'password': password, 'first_name': 'Load', 'last_name': f'Applicant{n}', 'user_name': f'LA{n}',
+             'role_id': teacher_role, 'role_request': True, 'role_requested_on': datetime.utcnow()}
+            for n in range(one_off * args.threads)
+        ])
+        school.teachers = [user_id for (user_id,) in db.session.query(User.id).filter(User.email.like('teacher%@load.test')).order_by(User.id)]
+        school.students = [user_id for (user_id,) in db.session.query(User.id).filter(User.email.like('student%@load.test')).order_by(User.id)]
+        school.applicants.extend(user_id for (user_id,) in db.session.query(User.id).filter(User.email.like('applicant%@load.test')))
+        insert_rows(TeacherRequestHistory, [{'user_id': user_id, 'status': 'Pending'} for user_id in school.applicants])
+
+        # One account per teacher and student, linked back from the user
+        db.session.execute(insert(Account).from_select(
+            ['user_id', 'balance', 'points_awarded'],
+            select(User.id, literal(0), literal(0)).where(User.email.like('%@load.test'), User.account_id.is_(None)),
+        ))
+        db.session.execute(
+            update(User)
+            .where(User.email.like('%@load.test'))
+            .values(account_id=select(Account.id).where(Account.user_id == User.id).limit(1).scalar_subquery())
+            .execution_options(synchronize_session=False)
+        )
+        accounts = dict(db.session.query(Account.user_id, Account.id).filter(Account.user_id.in_(school.teachers + school.students)))
+
+        # Classes are shared out between the teachers in turn
+        insert_rows(Class, [
+            {'name': f'LOAD-{n}', 'subject_id': school.subject_ids[n % len(school.subject_ids)], 'year_group': 7 + n % 7,
+             'teacher_id': school.teachers[n % len(school.teachers)]}
+            for n in range(args.classes)
+        ])
+        classes = {class_id: (teacher_id, year_group) for class_id, teacher_id, year_group in db.session.query(Class.id, Class.teacher_id, Class.year_group).filter(Class.name.like('LOAD-%'))}
+        for class_id, (teacher_id, _) in classes.items():
+            school.teacher_classes[teacher_id].append(class_id)
+
+        # Enrol every student in a few classes and give them join requests for a few others
+        class_ids = list(classes)
+        enrolled = {student_id: generator.sample(class_ids, min(CLASSES_PER_STUDENT, len(class_ids))) for student_id in school.students}
+        insert_rows(student_class, [{'student_id': student_id, 'class_id': class_id} for student_id, ids in enrolled.items() for class_id in ids])
+        requested = set()
+        for student_id in school.students:
+            others = [class_id for class_id in generator.sample(class_ids, min(CLASSES_PER_STUDENT + JOIN_REQUESTS_PER_STUDENT, len(class_ids))) if class_id not in enrolled[student_id]]
+            requested.update((student_id, class_id) for class_id in others[:JOIN_REQUESTS_PER_STUDENT])
+        # The teachers the threads log in as each get enough pending requests to accept one per round
+        for teacher_id in school.teachers[:args.threads]:
+            own = school.teacher_classes[teacher_id]
+            added = 0
+            for student_id in school.students:
+                if added >= one_off or not own:
+                    break
+                class_id = own[added % len(own)]
+                if class_id not in enrolled[student_id] and (student_id, class_id) not in requested:
+                    requested.add((student_id, class_id))
+                    added += 1
+        insert_rows(JoinRequest, [
+            {'student_id': student_id, 'class_id': class_id, 'status': generator.choice(['pending', 'accepted', 'rejected'])}
+            for student_id, class_id in requested
+        ])
+        db.session.execute(update(JoinRequest).where(JoinRequest.class_id.in_([
+            class_id for teacher_id in school.teachers[:args.threads] for class_id in school.teacher_classes[teacher_id]
+        ])).values(status='pending').execution_options(synchronize_session=False))
+        for request_id, teacher_id in db.session.query(JoinRequest.id, Class.teacher_id).join(Class, Class.id == JoinRequest.class_id).filter(JoinRequest.status == 'pending'):
+            school.pending_requests[teacher_id].append(request_id)
+
+        # Classes the students the threads log in as can still ask to join
+        for student_id in school.students[:args.threads]:
+            school.free_pairs[student_id].extend(
+                (student_id, class_id) for class_id in class_ids if class_id not in enrolled[student_id] and (student_id, class_id) not in requested
+            )
+
+        # Awards from teachers to students over the last half year, with a few purchases mixed in
+        now = datetime.utcnow()
+        purchases = int(args.transactions * PURCHASE_SHARE)
+        awards = []
+        for n in range(args.transactions - purchases):
+            student_id = generator.choice(school.students)
+            class_id = generator.choice(enrolled[student_id])
+            teacher_id, year_group = classes[class_id]
+            awards.append({
+                'sequence': 1, 'from_account_id': teacher_id, 'to_account_id': student_id, 'account_id': accounts[student_id],
+                'amount': generator.randint(1, 10), 'dateTime': now - timedelta(minutes=generator.randint(0, 180 * 24 * 60)),
+                'class_id': class_id, 'year_group': year_group,
+            })
+        insert_rows(Transactions, awards)
+        coupon_owners = [generator.choice(school.students) for _ in range(purchases)]
+        # The threads' students also get unredeemed coupons to redeem, one per round
+        coupon_owners += [student_id for student_id in school.students[:args.threads] for _ in range(one_off)]
+        insert_rows(Coupon.__table__, [
+            {'student_id': student_id, 'name': 'Pen', 'description': 'A high-quality pen', 'points_cost': 10, 'code': f'L{n:07d}', 'redeemed': n < purchases // 2}
+            for n, student_id in enumerate(coupon_owners)
+        ])
+        insert_rows(Transactions, [
+            {'sequence': 1, 'from_account_id': accounts[student_id], 'account_id': accounts[student_id], 'amount': -points_cost,
+             'coupon_id': coupon_id, 'dateTime': now - timedelta(minutes=generator.randint(0, 180 * 24 * 60))}
+            for coupon_id, student_id, points_cost in db.session.query(Coupon.id, Coupon.student_id, Coupon.points_cost).filter(Coupon.code.like('L%'))
+        ])
+        for coupon_id, student_id in db.session.query(Coupon.id, Coupon.student_id).filter(Coupon.student_id.in_(school.students[:args.threads]), Coupon.redeemed == False):
+            school.coupons[student_id].append(coupon_id)
+        db.session.commit()
+
+        # Bring the balances, snapshots, rollups, quotas and coupon code pool in line with the ledger, as in production
+        ledger.rebuild_balances()
+        rollups.rebuild()
+        quota.rollover()
+        coupons.fill_pool(args.rounds * args.threads * 4 + 100)
+    return school
+
+
+# Registered routes as (name, function), each function takes a Worker and returns (client, method, path, form data, ok statuses)
+ROUTES = []
+
+
+# Decorator that registers a route of the load test
+def route(name):
+    def register(function):
+        ROUTES.append((name, function))
+        return function
+    return register
+
+
+@route('GET /')
+def home(worker):
+    return worker.student, 'GET', '/', None, (200,)
+
+
+@route('GET /login')
+def login_page(worker):
+    return worker.app.test_client(), 'GET', '/login', None, (200,)
+
+
+@route('POST /login')
+def login(worker):
+    return worker.app.test_client(), 'POST', '/login', {'email': worker.student_email, 'password': PASSWORD}, (302,)
+
+
+@route('GET /sign_up')
+def sign_up_page(worker):
+    return worker.app.test_client(), 'GET', '/sign_up', None, (200,)
+
+
+@route('POST /sign_up')
+def sign_up(worker):
+    number = worker.school.next_number()
+    return worker.app.test_client(), 'POST', '/sign_up', {
+        'email': f'signup{number}@load.test', 'first_name': 'Load', 'last_name': 'Signup', 'password1': 'Load#Test123', 'password2': 'Load#Test123', 'role': 'student',
+    }, (302,)
+
+
+@route('GET /logout')
+def logout(worker):
+    # Log a separate client in first, outside the timed request, so the thread's own clients stay logged in
+    client = worker.login(worker.student_email)
+    return client, 'GET', '/logout', None, (302,)
+
+
+@route('GET /admin')
+def admin_page(worker):
+    return worker.admin, 'GET', '/admin', None, (200,)
+
+
+@route('GET /admin?account_id')
+def admin_page_filtered(worker):
+    return worker.admin, 'GET', f'/admin?account_id={worker.student_account}', None, (200,)
+
+
+@route('GET /admin/transactions/export')
+def export_transactions(worker):
+    return worker.admin, 'GET', f'/admin/transactions/export?format=csv&account_id={worker.student_account}', None, (200,)
+
+
+@route('GET /admin/import_roster')
+def import_roster_page(worker):
+    return worker.admin, 'GET', '/admin/import_roster', None, (200,)
+
+
+@route('GET /admin/cache_stats')
+def cache_stats(worker):
+    return worker.admin, 'GET', '/admin/cache_stats', None, (200,)
+
+
+@route('POST /admin/update-teacher-request')
+def update_teacher_request(worker):
+    user_id = worker.take(worker.school.applicants)
+    return worker.admin, 'POST', '/admin/update-teacher-request', {'user_id': user_id, 'action': 'approve'}, (302,)
+
+
+@route('GET /teacher_requests_history')
+def teacher_requests_history(worker):
+    return worker.admin, 'GET', '/teacher_requests_history', None, (200,)
+
+
+@route('GET /teacher')
+def teacher(worker):
+    return worker.teacher, 'GET', '/teacher', None, (200,)
+
+
+@route('GET /join_request?filter=pending')
+def join_request_pending(worker):
+    return worker.teacher, 'GET', '/join_request?filter=pending', None, (200,)
+
+
+@route('GET /join_request')
+def join_request_all(worker):
+    return worker.teacher, 'GET', '/join_request', None, (200,)
+
+
+@route('GET /respond_join_request')
+def respond_join_request(worker):
+    request_id = worker.take(worker.school.pending_requests[worker.teacher_id])
+    return worker.teacher, 'GET', f'/respond_join_request/{request_id}/accept', None, (302,)
+
+
+@route('GET /award_points')
+def award_points_page(worker):
+    return worker.teacher, 'GET', '/award_points', None, (200,)
+
+
+@route('POST /award_points student')
+def award_points_student(worker):
+    return worker.teacher, 'POST', '/award_points', {'award_to': 'student', 'student_id': worker.student_id, 'amount': 1}, (302,)
+
+
+@route('POST /award_points class')
+def award_points_class(worker):
+    return worker.teacher, 'POST', '/award_points', {'award_to': 'class', 'class_id': worker.random.choice(worker.classes), 'amount': 1}, (302,)
+
+
+@route('GET /create_class')
+def create_class_page(worker):
+    return worker.teacher, 'GET', '/create_class', None, (200,)
+
+
+@route('POST /create_class')
+def create_class(worker):
+    return worker.teacher, 'POST', '/create_class', {'subject': worker.random.choice(worker.school.subject_ids), 'year_group': worker.random.randint(7, 13)}, (200,)
+
+
+@route('GET /student/<id>')
+def student(worker):
+    return worker.student, 'GET', f'/student/{worker.student_id}', None, (200,)
+
+
+@route('GET /student/<id>?year_group')
+def student_search(worker):
+    return worker.student, 'GET', f'/student/{worker.student_id}?year_group={worker.random.randint(7, 13)}', None, (200,)
+
+
+@route('GET /request_join_class')
+def request_join_class(worker):
+    student_id, class_id = worker.take(worker.school.free_pairs[worker.student_id])
+    return worker.student, 'GET', f'/request_join_class/{student_id}/{class_id}', None, (302,)
+
+
+@route('GET /student_rewards')
+def student_rewards_page(worker):
+    return worker.student, 'GET', '/student_rewards', None, (200,)
+
+
+@route('POST /student_rewards')
+def student_rewards(worker):
+    return worker.student, 'POST', '/student_rewards', {'item_index': 0}, (200,)
+
+
+@route('GET /dashboard')
+def dashboard(worker):
+    return worker.student, 'GET', '/dashboard', None, (200,)
+
+
+@route('GET /statements')
+def statements(worker):
+    return worker.student, 'GET', '/statements?format=csv', None, (200,)
+
+
+@route('POST /redeem_coupon')
+def redeem_coupon(worker):
+    coupon_id = worker.take(worker.school.coupons[worker.student_id])
+    return worker.student, 'POST', '/redeem_coupon', {'coupon_id': coupon_id}, (200,)
+
+
+@route('GET /leaderboard')
+def leaderboard(worker):
+    return worker.student, 'GET', '/leaderboard', None, (200,)
+
+
+@route('GET /leaderboard/data')
+def leaderboard_data(worker):
+    return worker.student, 'GET', f"/leaderboard/data?scope={worker.random.choice(['students', 'classes', 'year_groups'])}", None, (200,)
+
+
+@route('GET /api/v1/balance')
+def api_balance(worker):
+    return worker.student, 'GET', '/api/v1/balance', None, (200,)
+
+
+@route('GET /api/v1/transactions')
+def api_transactions(worker):
+    return worker.student, 'GET', '/api/v1/transactions', None, (200,)
+
+
+@route('GET /api/v1/transactions admin')
+def api_admin_transactions(worker):
+    return worker.admin, 'GET', '/api/v1/transactions', None, (200,)
+
+
+@route('GET /api/v1/coupons')
+def api_coupons(worker):
+    return worker.student, 'GET', '/api/v1/coupons', None, (200,)
+
+
+@route('GET /api/v1/join_requests')
+def api_join_requests(worker):
+    return worker.teacher, 'GET', '/api/v1/join_requests?status=pending', None, (200,)
+
+
+@route('GET /api/v1/quota')
+def api_quota(worker):
+    return worker.teacher, 'GET', '/api/v1/quota', None, (200,)
+
+
+# One load generating thread, logged in as its own admin, teacher and student
+class Worker(threading.Thread):
+    def __init__(self, app, school, index, rounds, warmup, results, counter):
+        super().__init__()
+        self.app = app
+        self.school = school
+        self.rounds = rounds
+        self.warmup = warmup
+        self.results = results
+        self.counter = counter
+        self.random = random.Random(index)
+        self.teacher_id = school.teachers[index % len(school.teachers)]
+        self.student_id = school.students[index % len(school.students)]
+        self.classes = school.teacher_classes[self.teacher_id] or [0]
+        with app.app_context():
+            self.teacher_email = db.session.get(User, self.teacher_id).email
+            self.student_email = db.session.get(User, self.student_id).email
+            self.student_account = db.session.query(Account.id).filter_by(user_id=self.student_id).scalar()
+        self.admin = self.login(ADMIN_EMAIL)
+        self.teacher = self.login(self.teacher_email)
+        self.student = self.login(self.student_email)
+        self.error = None
+
+    # Get a client logged in as the user with the given email
+    def login(self, email):
+        client = self.app.test_client()
+        client.post('/login', data={'email': email, 'password': PASSWORD})
+        return client
+
+    # Take the next one-off id from a pool, ending the thread's run of that route if the pool is empty
+    def take(self, pool):
+        try:
+            return pool.popleft()
+        except IndexError:
+            raise LookupError('pool exhausted')
+
+    def run(self):
+        try:
+            for round_number in range(self.warmup + self.rounds):
+                routes = list(ROUTES)
+                self.random.shuffle(routes)
+                for name, prepare in routes:
+                    try:
+                        client, method, path, data, statuses = prepare(self)
+                    except LookupError:
+                        continue
+                    # Only the request itself is timed, and only the statements this thread sends are counted
+                    self.counter.count = 0
+                    started = time.perf_counter()
+                    response = client.open(path, method=method, data=data)
+                    response.get_data()
+                    elapsed = (time.perf_counter() - started) * 1000
+                    if round_number >= self.warmup:
+                        self.results.append((name, elapsed, self.counter.count, response.status_code in statuses))
+        except Exception as error:
+            self.error = error
+
+
+# Function to get the p-th percentile of a sorted list of values
+def percentile(values, p):
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+# Function to summarise the timings of each route
+def summarise(results, seconds):
+    by_route = defaultdict(list)
+    for name, elapsed, queries, ok in results:
+        by_route[name].append((elapsed, queries, ok))
+    routes = {}
+    for name, _ in ROUTES:
+        samples = by_route.get(name)
+        if not samples:
+            continue
+        timings = sorted(elapsed for elapsed, _, _ in samples)
+        routes[name] = {
+            'requests': len(samples),
+            'errors': sum(not ok for _, _, ok in samples),
+            'p50_ms': round(percentile(timings, 50), 3),
+            'p95_ms': round(percentile(timings, 95), 3),
+            'p99_ms': round(percentile(timings, 99), 3),
+            'queries': round(sum(queries for _, queries, _ in samples) / len(samples), 2),
+        }
+    return {'requests': len(results), 'seconds': round(seconds, 3), 'throughput': round(len(results) / seconds, 1) if seconds else 0, 'routes': routes}
+
+
+# Function to print the summary as a table
+def report(summary):
+    print(f"{'route':40} {'reqs':>5} {'errs':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}")
+    for name, stats in summary['routes'].items():
+        print(f"{name:40} {stats['requests']:5} {stats['errors']:5} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} {stats['queries']:8.1f}")
+    print(f"{summary['requests']} requests in {summary['seconds']:.1f}s, {summary['throughput']:.1f} requests/s")
+
+
+# Function to compare a summary with a saved baseline, returning a line for every route that got slower or sends more queries
+def regressions(summary, baseline, tolerance):
+    problems = []
+    for name, stats in summary['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        if stats['p95_ms'] > before['p95_ms'] * (1 + tolerance) and stats['p95_ms'] - before['p95_ms'] > NOISE_FLOOR_MS:
+            problems.append(f"{name}: p95 {before['p95_ms']:.2f} ms -> {stats['p95_ms']:.2f} ms")
+        if stats['queries'] > before['queries'] + 0.5:
+            problems.append(f"{name}: queries per request {before['queries']:.1f} -> {stats['queries']:.1f}")
+        if stats['errors'] > before['errors']:
+            problems.append(f"{name}: errors {before['errors']} -> {stats['errors']}")
+    if summary['throughput'] < baseline['throughput'] * (1 - tolerance):
+        problems.append(f"throughput {baseline['throughput']:.1f} -> {summary['throughput']:.1f} requests/s")
+    return problems
+
+
+# Function to get the commit being measured, if this is a git checkout
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--teachers', type=int, default=50)
+    parser.add_argument('--classes', type=int, default=200)
+    parser.add_argument('--transactions', type=int, default=50000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=20, help='Number of times each thread requests every route.')
+    parser.add_argument('--warmup', type=int, default=1, help='Rounds run before timing starts, to fill caches and connection pools.')
+    parser.add_argument('--database', default=None, help='Database URL to seed and test, defaults to a scratch SQLite file.')
+    parser.add_argument('--save', default=None, help='File to save the results to as a JSON baseline.')
+    parser.add_argument('--compare', default=None, help='JSON baseline to compare the results with, exiting with 1 on a regression.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline, as a fraction.')
+    args = parser.parse_args()
+
+    # The database, unless one is given, and the metrics files go in a scratch directory rather than the instance folder
+    scratch = tempfile.mkdtemp()
+    database = args.database or 'sqlite:///' + os.path.join(scratch, 'load.db')
+    # Jobs are left queued for a worker as in production, so the timings cover the request path only
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'METRICS_DIR': os.path.join(scratch, 'metrics'), 'JOBS_INLINE': False, 'TESTING': True})
+    started = time.perf_counter()
+    school = seed(app, args)
+    print(f'seeded {args.students} students, {args.teachers} teachers, {args.classes} classes and {args.transactions} transactions in {time.perf_counter() - started:.1f}s')
+
+    # Count the statements sent by each thread, the test client runs the application in the calling thread
+    counter = threading.local()
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: setattr(counter, 'count', getattr(counter, 'count', 0) + 1))
+
+    results = []
+    workers = [Worker(app, school, index, args.rounds, args.warmup, results, counter) for index in range(args.threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - started
+    for worker in workers:
+        if worker.error is not None:
+            raise worker.error
+
+    summary = summarise(results, seconds)
+    report(summary)
+
+    if args.save:
+        baseline = dict(summary, commit=current_commit(), created=datetime.utcnow().isoformat(), python=platform.python_version(),
+                        settings={name: value for name, value in vars(args).items() if name not in ('save', 'compare', 'database')})
+        with open(args.save, 'w') as file:
+            json.dump(baseline, file, indent=2)
+        print(f'saved the results to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        # Timings are only comparable on the same size of school and load
+        changed = [name for name, value in baseline.get('settings', {}).items() if name != 'tolerance' and getattr(args, name, value) != value]
+        if changed:
+            print(f"warning: the baseline was run with different {', '.join(changed)}", file=sys.stderr)
+        problems = regressions(summary, baseline, args.tolerance)
+        print(f"compared with {args.compare} (commit {baseline.get('commit')}): {len(problems)} regressions")
+        for problem in problems:
+            print(f'  {problem}')
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
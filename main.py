@@ -1,3 +1,11 @@
+import os
+
+# Running this file starts the development server, so it uses the development settings unless APP_ENV says otherwise.
+# Loaded any other way, e.g. by 'flask --app main' or a WSGI server, the production settings are the default, so use
+# APP_ENV=development flask --app main run for the development settings there
+if __name__ == '__main__':
+    os.environ.setdefault('APP_ENV', 'development')
+
 from website import create_app
 from website import recreate_database
 
@@ -5,6 +13,13 @@ from website import recreate_database
 
 app = create_app()
 
+# Bring an existing database up to date with: flask --app main migrate
+# Create the default roles, users and subjects before the first run with: flask --app main seed
+# In production (APP_ENV=production) background jobs such as history, leaderboards, redeem dates and the coupon sweep
+# are only run by the worker, so start one next to the web server with: flask --app main worker
+# In development JOBS_INLINE runs the jobs a request queues at the end of that request, but the recurring coupon sweep
+# and code pool fill still need the worker, or fill the pool once with: flask --app main fill-coupon-codes
+
 
 if __name__ == '__main__':
     # recreate_database(app)
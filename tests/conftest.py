@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+from website import create_app, db
+from website.seed import seed
+
+# Every application the tests create uses the testing settings
+os.environ['APP_ENV'] = 'testing'
+
+
+# A fresh application on its own SQLite file for every test, seeded with the default roles and users. A file rather than
+# an in-memory database, so the tests that use several threads share one database through the connection pool
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'CACHE_BACKEND': 'none',
+        # The tests run the worker themselves where they need the jobs done
+        'JOBS_INLINE': False,
+        'TESTING': True,
+    })
+    with app.app_context():
+        seed()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Function to log a test client in as one of the seeded users
+def log_in(client, email, password='secret'):
+    client.post('/login', data={'email': email, 'password': password})
+    return client
@@ -0,0 +1,54 @@
+from website import db, versions
+from website.models import EntityVersion
+from website.posting import post_award
+
+from conftest import log_in
+from test_posting import seeded_ids, staff
+
+
+# Function to get a page of the API and its ETag, sending the given ETag as If-None-Match
+def get(client, path, etag=None):
+    response = client.get(path, headers={'If-None-Match': f'"{etag}"'} if etag else {})
+    return response.status_code, response.headers.get('ETag', '').strip('"')
+
+
+def test_admin_ledger_tag_moves_with_postings_without_a_global_stamp(app, client):
+    log_in(client, 'admin@Kimberley.com')
+    status, tag = get(client, '/api/v1/transactions')
+    assert status == 200
+    assert get(client, '/api/v1/transactions', tag) == (304, tag)
+
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        post_award(staff(teacher_id), student_id, 5)
+        # The posting bumped the stamps of its users but not the one every posting would share
+        assert db.session.get(EntityVersion, versions.LEDGER) is None
+        assert db.session.get(EntityVersion, versions.user_entity(student_id)).version == 1
+
+    status, new_tag = get(client, '/api/v1/transactions', tag)
+    assert status == 200 and new_tag != tag
+    assert get(client, '/api/v1/transactions', new_tag) == (304, new_tag)
+
+
+def test_student_balance_tag_moves_with_their_own_postings(app, client):
+    log_in(client, 'student@Kimberley.com')
+    status, tag = get(client, '/api/v1/balance')
+    assert status == 200
+    assert get(client, '/api/v1/balance', tag) == (304, tag)
+
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        post_award(staff(teacher_id), student_id, 5)
+
+    status, new_tag = get(client, '/api/v1/balance', tag)
+    assert status == 200 and new_tag != tag
+
+
+def test_maintenance_bump_invalidates_every_tag(app, client):
+    log_in(client, 'admin@Kimberley.com')
+    _, tag = get(client, '/api/v1/quota')
+    with app.app_context():
+        versions.bump_all()
+        db.session.commit()
+    status, new_tag = get(client, '/api/v1/quota', tag)
+    assert status == 200 and new_tag != tag
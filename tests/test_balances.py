@@ -0,0 +1,102 @@
+import threading
+from types import SimpleNamespace
+
+from website import db, ledger
+from website.models import User, Account, Transactions
+from website.posting import post_award
+
+from conftest import log_in
+
+
+# Function to get the seeded teacher, with a limit high enough for every test, and the seeded student's id and account id
+def award_parties():
+    teacher_id = db.session.query(User.id).filter_by(email='teacher@Kimberley.com').scalar()
+    db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': 100000})
+    db.session.commit()
+    student_id, account_id = db.session.query(Account.user_id, Account.id).join(User, User.id == Account.user_id).filter(User.email == 'student@Kimberley.com').one()
+    return SimpleNamespace(id=teacher_id, is_admin=lambda: False), student_id, account_id
+
+
+def test_balance_adds_the_rows_after_the_latest_snapshot(app):
+    with app.app_context():
+        teacher, student_id, account_id = award_parties()
+        post_award(teacher, student_id, 10)
+        assert ledger.take_snapshots() >= 1
+        post_award(teacher, student_id, 5)
+        assert ledger.current_balance(account_id) == 15
+        # Nothing new for the student's account, so no second snapshot of it
+        ledger.take_snapshots()
+        assert ledger.take_snapshots() == 0
+        assert ledger.current_balance(account_id) == 15
+
+
+def test_snapshots_taken_during_postings_lose_nothing(app):
+    with app.app_context():
+        teacher, student_id, account_id = award_parties()
+    done = threading.Event()
+
+    def award():
+        with app.app_context():
+            for _ in range(40):
+                post_award(teacher, student_id, 1)
+            db.session.remove()
+
+    def snapshot():
+        with app.app_context():
+            while not done.is_set():
+                ledger.take_snapshots()
+            db.session.remove()
+
+    awarders = [threading.Thread(target=award) for _ in range(3)]
+    snapshotter = threading.Thread(target=snapshot)
+    snapshotter.start()
+    for thread in awarders:
+        thread.start()
+    for thread in awarders:
+        thread.join()
+    done.set()
+    snapshotter.join()
+
+    with app.app_context():
+        assert ledger.current_balance(account_id) == 120
+        assert db.session.query(Account.balance).filter_by(id=account_id).scalar() == 120
+
+
+def test_rebuild_corrects_drifted_balances_from_the_ledger(app):
+    with app.app_context():
+        teacher, student_id, account_id = award_parties()
+        post_award(teacher, student_id, 7)
+        db.session.query(Account).filter_by(id=account_id).update({'balance': 999})
+        db.session.commit()
+
+        _, mismatches = ledger.rebuild_balances(dry_run=True)
+        assert [(m['account_id'], m['stored_balance'], m['ledger_balance']) for m in mismatches] == [(account_id, 999, 7)]
+        assert db.session.query(Account.balance).filter_by(id=account_id).scalar() == 999
+
+        ledger.rebuild_balances()
+        assert db.session.query(Account.balance).filter_by(id=account_id).scalar() == 7
+        assert ledger.current_balance(account_id) == 7
+        assert ledger.rebuild_balances(dry_run=True)[1] == []
+
+
+def test_rebuild_fills_in_missing_account_ids_of_old_awards(app):
+    with app.app_context():
+        _, student_id, account_id = award_parties()
+        db.session.add(Transactions(amount=4, to_account_id=student_id, account_id=None))
+        db.session.commit()
+        backfilled, _ = ledger.rebuild_balances()
+        assert backfilled == 1
+        assert db.session.query(Account.balance).filter_by(id=account_id).scalar() == 4
+
+
+def test_rewards_page_shows_the_ledger_balance_like_the_dashboard(app, client):
+    with app.app_context():
+        teacher, student_id, _ = award_parties()
+        post_award(teacher, student_id, 20)
+        # A drifted cached balance is not what the student is shown
+        db.session.query(Account).filter_by(user_id=student_id).update({'balance': 500})
+        db.session.commit()
+    log_in(client, 'student@Kimberley.com')
+    page = client.get('/student_rewards').get_data(as_text=True)
+    # Only the two rewards of 20 points or less can be bought with the ledger's 20 points
+    assert page.count('name="item_index"') == 2
@@ -0,0 +1,109 @@
+import pytest
+
+from website import cache as cache_module, create_app, db
+from website.cache import Cache, MemoryBackend
+from website.models import User, Subject
+from website.seed import seed
+
+from conftest import log_in
+
+
+# The seeded application with the in-process cache turned on, which the other tests leave off
+@pytest.fixture
+def cached_app(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'CACHE_BACKEND': 'memory',
+        'JOBS_INLINE': False,
+        'TESTING': True,
+    })
+    with app.app_context():
+        seed()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+# Function to make a memory cache with the given capacity
+def memory_cache(max_entries=1024):
+    cache = Cache()
+    cache.backend = MemoryBackend(max_entries)
+    return cache
+
+
+def test_loads_once_then_hits():
+    cache = memory_cache()
+    loads = []
+    for _ in range(3):
+        assert cache.get_or_load('subjects', (), lambda: loads.append(1) or ['Math']) == ['Math']
+    assert len(loads) == 1
+    assert cache.stats() == {'subjects': {'hits': 2, 'misses': 1}}
+
+
+def test_keys_within_a_namespace_are_cached_apart():
+    cache = memory_cache()
+    assert cache.get_or_load('classes', (7, None, None), lambda: 'year 7') == 'year 7'
+    assert cache.get_or_load('classes', (8, None, None), lambda: 'year 8') == 'year 8'
+    assert cache.get_or_load('classes', (7, None, None), lambda: 'reloaded') == 'year 7'
+
+
+def test_invalidating_a_namespace_reloads_only_that_namespace():
+    cache = memory_cache()
+    cache.get_or_load('classes', (), lambda: 'old classes')
+    cache.get_or_load('subjects', (), lambda: 'subjects')
+    cache.invalidate('classes')
+    assert cache.get_or_load('classes', (), lambda: 'new classes') == 'new classes'
+    assert cache.get_or_load('subjects', (), lambda: 'reloaded') == 'subjects'
+
+
+def test_invalidating_a_stamp_reloads_only_the_stamped_entry():
+    cache = memory_cache()
+    cache.get_or_load('identity', 1, lambda: 'first', stamp='user:1')
+    cache.get_or_load('identity', 2, lambda: 'second', stamp='user:2')
+    cache.invalidate('user:1')
+    assert cache.get_or_load('identity', 1, lambda: 'first again', stamp='user:1') == 'first again'
+    assert cache.get_or_load('identity', 2, lambda: 'reloaded', stamp='user:2') == 'second'
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, 'monotonic', lambda: now[0])
+    cache = memory_cache()
+    cache.get_or_load('subjects', (), lambda: 'old', ttl=60)
+    now[0] += 59
+    assert cache.get_or_load('subjects', (), lambda: 'new', ttl=60) == 'old'
+    now[0] += 2
+    assert cache.get_or_load('subjects', (), lambda: 'new', ttl=60) == 'new'
+
+
+def test_the_least_recently_used_entry_is_evicted():
+    cache = memory_cache(max_entries=2)
+    cache.get_or_load('classes', 'a', lambda: 'a')
+    cache.get_or_load('classes', 'b', lambda: 'b')
+    # Reading a makes b the least recently used
+    cache.get_or_load('classes', 'a', lambda: 'reloaded a')
+    cache.get_or_load('classes', 'c', lambda: 'c')
+    assert cache.get_or_load('classes', 'a', lambda: 'reloaded a') == 'a'
+    assert cache.get_or_load('classes', 'b', lambda: 'reloaded b') == 'reloaded b'
+
+
+def test_unknown_backend_is_refused(app):
+    app.config['CACHE_BACKEND'] = 'disk'
+    with pytest.raises(RuntimeError, match='Unknown CACHE_BACKEND disk'):
+        Cache().init_app(app)
+
+
+def test_creating_a_class_invalidates_the_cached_catalogue(cached_app):
+    client = cached_app.test_client()
+    log_in(client, 'student@Kimberley.com')
+    with cached_app.app_context():
+        student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+        math_id = db.session.query(Subject.id).filter_by(name='Math').scalar()
+    assert b'7MTL' not in client.get(f'/student/{student_id}').data
+
+    teacher = cached_app.test_client()
+    log_in(teacher, 'teacher@Kimberley.com')
+    teacher.post('/create_class', data={'subject': math_id, 'year_group': 7})
+    assert b'7MTL' in client.get(f'/student/{student_id}').data
@@ -0,0 +1,112 @@
+from website import db
+from website.models import User, Class, Subject, JoinRequest
+from website.roles import roles
+
+from conftest import log_in
+
+
+# Function to give the seeded teacher the given number of Math classes, returning their ids
+def add_classes(count, start=0):
+    teacher_id = db.session.query(User.id).filter_by(email='teacher@Kimberley.com').scalar()
+    math_id = db.session.query(Subject.id).filter_by(name='Math').scalar()
+    classes = [Class(name=f'class{n}', subject_id=math_id, year_group=7 + n % 5, teacher_id=teacher_id) for n in range(start, start + count)]
+    db.session.add_all(classes)
+    db.session.commit()
+    return [each.id for each in classes]
+
+
+# Function to get the student page for the seeded student and return the response
+def student_page(client):
+    student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+    return client.get(f'/student/{student_id}')
+
+
+def test_student_catalogue_query_count_does_not_grow_with_the_classes(app, client):
+    log_in(client, 'student@Kimberley.com')
+    with app.app_context():
+        add_classes(2)
+        # Measure from the second page, as the first one after logging in also makes one-off lookups
+        student_page(client)
+        few = student_page(client)
+        add_classes(30, start=2)
+        many = student_page(client)
+    assert few.status_code == many.status_code == 200
+    assert many.data.count(b'7MTL') == 7
+    assert 'X-SQL-N-Plus-One' not in many.headers
+    assert many.headers['X-SQL-Queries'] == few.headers['X-SQL-Queries']
+
+
+def test_student_catalogue_marks_the_classes_the_student_asked_to_join(app, client):
+    log_in(client, 'student@Kimberley.com')
+    with app.app_context():
+        requested, open_class = add_classes(2)
+        student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+        db.session.add(JoinRequest(student_id=student_id, class_id=requested, status='pending'))
+        db.session.commit()
+        response = student_page(client)
+    assert response.data.count(b'Requested') == 1
+    assert f'/request_join_class/{student_id}/{open_class}"'.encode() in response.data
+    assert f'/request_join_class/{student_id}/{requested}"'.encode() not in response.data
+
+
+def test_student_catalogue_filters_by_year_group(app, client):
+    log_in(client, 'student@Kimberley.com')
+    with app.app_context():
+        add_classes(5)
+        student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+        response = client.get(f'/student/{student_id}?year_group=8')
+    assert b'8MTL' in response.data
+    assert b'7MTL' not in response.data
+
+
+# Function to add a second approved teacher with one class that the seeded student has asked to join
+def other_teachers_request():
+    other = User(email='other@Kimberley.com', first_name='Other', last_name='Teacher', user_name='OTHER',
+                 role_id=roles.id('teacher'), role_approved=True)
+    db.session.add(other)
+    db.session.flush()
+    theirs = Class(name='theirs', year_group=9, teacher_id=other.id)
+    db.session.add(theirs)
+    db.session.flush()
+    student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+    db.session.add(JoinRequest(student_id=student_id, class_id=theirs.id, status='pending'))
+    db.session.commit()
+    return theirs.id
+
+
+def test_teacher_dashboard_shows_only_the_teachers_own_classes_and_requests(app, client):
+    log_in(client, 'teacher@Kimberley.com')
+    with app.app_context():
+        own_id, _ = add_classes(2)
+        other_teachers_request()
+        student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+        db.session.add(JoinRequest(student_id=student_id, class_id=own_id, status='pending'))
+        db.session.commit()
+    response = client.get('/teacher')
+    assert response.status_code == 200
+    assert b'7MTL' in response.data and b'8MTL' in response.data
+    assert b'class0' in response.data
+    assert b'theirs' not in response.data
+    assert response.data.count(b'/respond_join_request/') == 2
+
+    everything = client.get('/join_request?filter=all')
+    assert b'class0' in everything.data
+    assert b'theirs' not in everything.data
+
+
+def test_teacher_dashboard_query_count_does_not_grow_with_the_requests(app, client):
+    log_in(client, 'teacher@Kimberley.com')
+    with app.app_context():
+        class_ids = add_classes(3)
+        client.get('/teacher')
+        few = client.get('/teacher')
+        for n in range(20):
+            applicant = User(email=f'pupil{n}@school', first_name='Pu', last_name=f'Pil{n}', user_name=f'PUP{n}', role_id=roles.id('student'))
+            db.session.add(applicant)
+            db.session.flush()
+            db.session.add(JoinRequest(student_id=applicant.id, class_id=class_ids[n % 3], status='pending'))
+        db.session.commit()
+        many = client.get('/teacher')
+    assert many.data.count(b'/respond_join_request/') == 40
+    assert 'X-SQL-N-Plus-One' not in many.headers
+    assert many.headers['X-SQL-Queries'] == few.headers['X-SQL-Queries']
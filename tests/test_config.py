@@ -0,0 +1,36 @@
+from flask import Flask
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from website import db
+from website.config import configure_app
+
+
+def test_missing_app_env_means_production(monkeypatch):
+    monkeypatch.delenv('APP_ENV', raising=False)
+    app = Flask(__name__)
+    configure_app(app)
+    assert (app.config['DEBUG'], app.config['METRICS_PUBLIC'], app.config['JOBS_INLINE'], app.config['SQL_HEADERS']) == (False, False, False, False)
+
+
+def test_unknown_app_env_is_refused(monkeypatch):
+    monkeypatch.setenv('APP_ENV', 'staging')
+    with pytest.raises(RuntimeError, match='Unknown APP_ENV staging'):
+        configure_app(Flask(__name__))
+
+
+def test_sqlite_pragmas_run_on_every_new_connection(app):
+    with app.app_context():
+        # Open two connections at once, so the second is a new one rather than the first back from the pool
+        with db.engine.connect() as first, db.engine.connect() as second:
+            for connection in (first, second):
+                assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+                assert connection.exec_driver_sql('PRAGMA busy_timeout').scalar() == 5000
+                # NORMAL
+                assert connection.exec_driver_sql('PRAGMA synchronous').scalar() == 1
+                assert connection.exec_driver_sql('PRAGMA cache_size').scalar() == -20000
+
+
+def test_sqlite_file_databases_keep_a_connection_pool(app):
+    with app.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from website import db, coupons, jobs, versions
+from website.models import Account, Coupon, CouponCode, EntityVersion, Job, Transactions
+from website.jobs import Worker
+from website.posting import post_award, post_purchase, PostingError
+
+from test_posting import seeded_ids, staff, run_concurrently
+
+
+def test_concurrent_claims_issue_unique_codes(app):
+    with app.app_context():
+        coupons.fill_pool(40)
+    claimed = []
+
+    def claim(index):
+        for _ in range(5):
+            claimed.append(coupons.claim_code())
+            db.session.commit()
+
+    # Eight threads claim five codes each from a pool of forty, so every code is issued exactly once
+    assert run_concurrently(app, claim, threads=8) == []
+    assert None not in claimed
+    assert len(set(claimed)) == 40
+    with app.app_context():
+        assert db.session.query(CouponCode).count() == 0
+
+
+def test_rolled_back_claim_returns_the_code_to_the_pool(app):
+    with app.app_context():
+        coupons.fill_pool(1)
+        code = coupons.claim_code()
+        db.session.rollback()
+        assert db.session.query(CouponCode.code).scalar() == code
+
+
+def test_purchase_with_an_empty_pool_fails_and_queues_a_fill(app):
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        post_award(staff(teacher_id), student_id, 30)
+        with pytest.raises(PostingError):
+            post_purchase(SimpleNamespace(id=student_id), 'Pen', 'A pen', 10)
+        # Nothing of the purchase is left behind, and the pool is refilled by a job rather than by the buyer
+        assert db.session.query(Account.balance).filter_by(user_id=student_id).scalar() == 30
+        assert db.session.query(Coupon).count() == 0
+        assert db.session.query(Transactions).filter(Transactions.coupon_id.isnot(None)).count() == 0
+        assert db.session.query(CouponCode).count() == 0
+        assert db.session.query(Job).filter_by(kind=coupons.FILL_JOB, status='queued').count() == 1
+
+
+def test_fill_job_tops_the_pool_up_and_queues_the_next_fill(app):
+    app.config['COUPON_POOL_SIZE'] = 50
+    with app.app_context():
+        coupons.fill_pool(20)
+        coupons.schedule_fill()
+        assert Worker(app.config).work(once=True) == 1
+        assert db.session.query(CouponCode).count() == 50
+        assert db.session.query(Job).filter_by(kind=coupons.FILL_JOB, status='queued').count() == 1
+
+
+def test_sweep_expires_exactly_the_due_coupons(app):
+    now = datetime.utcnow()
+    with app.app_context():
+        _, student_id = seeded_ids()
+        rows = [
+            ('DUE00001', 'redeemed', now - timedelta(days=1)),
+            ('DUE00002', 'redeemed', now),
+            ('LIVE0001', 'redeemed', now + timedelta(seconds=1)),
+            ('ACTIVE01', 'active', None),
+            ('GONE0001', 'expired', now - timedelta(days=5)),
+        ]
+        for code, status, expires_at in rows:
+            db.session.execute(Coupon.__table__.insert().values(
+                student_id=student_id, name='Pen', description='A pen', points_cost=10, code=code, redeemed=status != 'active',
+                redeem_date=expires_at - timedelta(days=2) if expires_at else None, status=status, expires_at=expires_at,
+            ))
+        db.session.commit()
+
+        assert coupons.expire_coupons(now) == 2
+        db.session.commit()
+        assert dict(db.session.query(Coupon.code, Coupon.status)) == {
+            'DUE00001': 'expired', 'DUE00002': 'expired', 'LIVE0001': 'redeemed', 'ACTIVE01': 'active', 'GONE0001': 'expired',
+        }
+        # The student's API responses get new tags, and a second sweep finds nothing to do
+        assert db.session.get(EntityVersion, versions.user_entity(student_id)).version == 1
+        assert coupons.expire_coupons(now) == 0
+
+
+def test_sweep_job_recurs(app):
+    with app.app_context():
+        jobs.schedule(coupons.SWEEP_JOB)
+        db.session.commit()
+        assert Worker(app.config).work(once=True) == 1
+        queued = db.session.query(Job).filter_by(kind=coupons.SWEEP_JOB, status='queued').one()
+        assert queued.run_at > datetime.utcnow() + timedelta(seconds=app.config['COUPON_SWEEP_INTERVAL'] - 60)
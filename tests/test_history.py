@@ -0,0 +1,29 @@
+from datetime import datetime
+
+from website import db, history
+from website.jobs import Worker
+from website.models import User
+from website.roles import roles
+
+from conftest import log_in
+
+
+def test_teacher_request_history_query_count_does_not_grow_with_the_history(app, client):
+    with app.app_context():
+        admin_id = db.session.query(User.id).filter_by(email='admin@Kimberley.com').scalar()
+        for n in range(12):
+            applicant = User(email=f'applicant{n}@school', first_name='Ap', last_name=f'Plicant{n}', user_name=f'APP{n}',
+                             role_id=roles.id('teacher'), role_request=True, role_requested_on=datetime.utcnow())
+            db.session.add(applicant)
+            db.session.flush()
+            history.record_teacher_request(applicant.id, 'pending')
+            history.record_teacher_request(applicant.id, 'accepted', admin_id, datetime.utcnow())
+        db.session.commit()
+        Worker(app.config).work(once=True)
+
+    log_in(client, 'admin@Kimberley.com')
+    response = client.get('/teacher_requests_history')
+    assert response.status_code == 200
+    assert b'APP11' in response.data
+    assert 'X-SQL-N-Plus-One' not in response.headers
+    assert int(response.headers['X-SQL-Queries']) < 8
@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+
+from website import create_app, db
+from website.identity import identities, load_identity
+from website.models import User
+from website.roles import roles
+from website.seed import seed
+
+from conftest import log_in
+
+
+# The seeded application with the identity cache kept in memory, which the other tests leave off
+@pytest.fixture
+def cached_app(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'CACHE_BACKEND': 'none',
+        'IDENTITY_CACHE_BACKEND': 'memory',
+        'JOBS_INLINE': False,
+        'TESTING': True,
+    })
+    with app.app_context():
+        seed()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+# Function to add a teacher whose role request is still waiting for an admin, returning their id
+def pending_teacher():
+    applicant = User(email='applicant@Kimberley.com', first_name='Ap', last_name='Plicant', user_name='APLICANT',
+                     role_id=roles.id('teacher'), role_request=True, role_approved=False, role_requested_on=datetime.utcnow())
+    db.session.add(applicant)
+    db.session.commit()
+    return applicant.id
+
+
+def test_identity_is_read_from_the_cache_until_the_user_changes(cached_app):
+    with cached_app.app_context():
+        teacher_id = db.session.query(User.id).filter_by(email='teacher@Kimberley.com').scalar()
+        misses = identities.misses['identity']
+        first = load_identity(teacher_id)
+        again = load_identity(teacher_id)
+        assert identities.misses['identity'] == misses + 1
+        assert (again.email, again.is_teacher(), again.role_approved) == (first.email, True, True)
+
+
+def test_approving_a_teacher_request_reloads_the_teachers_identity(cached_app):
+    with cached_app.app_context():
+        applicant_id = pending_teacher()
+        assert load_identity(applicant_id).role_approved is False
+
+    admin = log_in(cached_app.test_client(), 'admin@Kimberley.com')
+    admin.post('/admin/update-teacher-request', data={'user_id': applicant_id, 'action': 'approve'})
+
+    with cached_app.app_context():
+        reloaded = load_identity(applicant_id)
+        assert (reloaded.role_approved, reloaded.role_request) == (True, False)
+
+
+def test_rejecting_a_teacher_request_reloads_the_teachers_identity(cached_app):
+    with cached_app.app_context():
+        applicant_id = pending_teacher()
+        assert load_identity(applicant_id).role_request is True
+
+    admin = log_in(cached_app.test_client(), 'admin@Kimberley.com')
+    admin.post('/admin/update-teacher-request', data={'user_id': applicant_id, 'action': 'reject'})
+
+    with cached_app.app_context():
+        assert load_identity(applicant_id).role_request is False
+
+
+def test_awarding_points_reloads_the_teachers_identity(cached_app):
+    with cached_app.app_context():
+        teacher_id = db.session.query(User.id).filter_by(email='teacher@Kimberley.com').scalar()
+        student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+        load_identity(teacher_id)
+        misses = identities.misses['identity']
+
+    teacher = log_in(cached_app.test_client(), 'teacher@Kimberley.com')
+    response = teacher.post('/award_points', data={'award_to': 'student', 'student_id': student_id, 'amount': 5})
+    assert response.status_code == 302
+
+    # The request itself was served from the cache, and the next load after the award reads the record again
+    assert identities.misses['identity'] == misses
+    with cached_app.app_context():
+        load_identity(teacher_id)
+    assert identities.misses['identity'] == misses + 1
+
+
+def test_unknown_users_have_no_identity(cached_app):
+    with cached_app.app_context():
+        assert load_identity(10**6) is None
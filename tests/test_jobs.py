@@ -0,0 +1,103 @@
+import logging
+
+import pytest
+
+from website import create_app, db, jobs, coupons
+from website.jobs import Worker, enqueue, retry_failed
+from website.models import Job
+
+# Kind of the jobs run by the test handler
+FLAKY_JOB = 'test_flaky'
+
+
+# A handler that fails for every payload asking to, as long as it has failures left
+@pytest.fixture
+def flaky():
+    failures = {}
+    ran = []
+
+    def run(payloads):
+        for payload in payloads:
+            if failures.get(payload['name'], 0) > 0:
+                failures[payload['name']] -= 1
+                raise RuntimeError(f"{payload['name']} failed")
+        ran.extend(payload['name'] for payload in payloads)
+
+    jobs.HANDLERS[FLAKY_JOB] = (run, None)
+    yield failures, ran
+    del jobs.HANDLERS[FLAKY_JOB]
+
+
+# Function to build a worker that retries straight away, so one run of work(once=True) sees every retry
+def eager_worker(app, attempts=3):
+    return Worker({**app.config, 'JOB_RETRY_DELAY': 0, 'JOB_MAX_ATTEMPTS': attempts})
+
+
+def test_failed_job_is_retried_until_it_succeeds(app, flaky):
+    failures, ran = flaky
+    failures['a'] = 2
+    with app.app_context():
+        enqueue(FLAKY_JOB, {'name': 'a'})
+        db.session.commit()
+        assert eager_worker(app).work(once=True) == 1
+        assert ran == ['a']
+        assert db.session.query(Job).filter_by(kind=FLAKY_JOB).count() == 0
+
+
+def test_bad_job_does_not_hold_back_its_batch(app, flaky):
+    failures, ran = flaky
+    failures['bad'] = 99
+    with app.app_context():
+        for name in ('a', 'bad', 'b'):
+            enqueue(FLAKY_JOB, {'name': name})
+        db.session.commit()
+        assert eager_worker(app).work(once=True) == 2
+        assert sorted(ran) == ['a', 'b']
+        failed = db.session.query(Job).filter_by(kind=FLAKY_JOB).one()
+        assert (failed.status, failed.attempts, failed.last_error) == ('failed', 3, 'RuntimeError: bad failed')
+
+        # Queued again with fresh attempts, it runs once the handler succeeds
+        failures['bad'] = 0
+        assert retry_failed() == 1
+        assert eager_worker(app).work(once=True) == 1
+        assert sorted(ran) == ['a', 'b', 'bad']
+
+
+def test_startup_warns_about_jobs_no_worker_has_taken(app, caplog):
+    with app.app_context():
+        enqueue(FLAKY_JOB, {'name': 'a'}, delay=-3600)
+        db.session.commit()
+    with caplog.at_level(logging.WARNING, logger='website.jobs'):
+        create_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'], 'METRICS_DIR': app.config['METRICS_DIR'], 'JOBS_INLINE': False})
+    assert "1 jobs have been waiting" in caplog.text
+
+
+def test_inline_runner_only_runs_the_jobs_its_request_queued(tmp_path, flaky):
+    _, ran = flaky
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'), 'METRICS_DIR': str(tmp_path / 'metrics'), 'JOBS_INLINE': True,
+    })
+
+    @app.route('/queue/<name>')
+    def queue(name):
+        enqueue(FLAKY_JOB, {'name': name})
+        db.session.commit()
+        return 'queued'
+
+    with app.app_context():
+        # A job queued elsewhere and a recurring job, both due, are left for the worker
+        enqueue(FLAKY_JOB, {'name': 'elsewhere'})
+        enqueue(coupons.SWEEP_JOB, {})
+        db.session.commit()
+    try:
+        client = app.test_client()
+        assert client.get('/login').status_code == 200
+        assert ran == []
+        assert client.get('/queue/mine').status_code == 200
+        assert ran == ['mine']
+        with app.app_context():
+            assert sorted(kind for (kind,) in db.session.query(Job.kind)) == [coupons.SWEEP_JOB, FLAKY_JOB]
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+from website import db, ledger
+from website.models import Transactions
+
+from conftest import log_in
+
+
+# Function to add ledger rows with the given dateTimes, returning their ids in insertion order
+def add_rows(date_times, account_id=1, **columns):
+    rows = [Transactions(dateTime=date_time, amount=1, account_id=account_id, **columns) for date_time in date_times]
+    db.session.add_all(rows)
+    db.session.commit()
+    return [row.id for row in rows]
+
+
+# Function to read every page of the ledger, returning the ids in the order they were shown
+def read_all_pages(filters, page_size):
+    ids, cursor = [], None
+    while True:
+        rows, next_cursor = ledger.ledger_page(filters, cursor, page_size)
+        ids.extend(row.id for row in rows)
+        if next_cursor is None:
+            return ids
+        cursor = ledger.decode_cursor(next_cursor)
+
+
+def test_pages_cover_every_row_once_across_equal_timestamps(app):
+    with app.app_context():
+        now = datetime(2024, 1, 1, 12)
+        # Several rows share a timestamp, so page boundaries fall inside a run of equal dateTimes
+        ids = add_rows([now] * 5 + [now - timedelta(minutes=1)] * 4 + [now + timedelta(minutes=1)])
+        pages = read_all_pages({}, page_size=3)
+        assert sorted(pages) == sorted(ids)
+        assert len(pages) == len(set(pages))
+        expected = [row.id for row in Transactions.query.order_by(Transactions.dateTime.desc(), Transactions.id.desc())]
+        assert pages == expected
+
+
+def test_pages_include_rows_without_a_date_after_the_dated_rows(app):
+    with app.app_context():
+        dated = add_rows([datetime(2024, 1, 1), datetime(2024, 1, 2)])
+        undated = add_rows([None, None, None])
+        pages = read_all_pages({}, page_size=2)
+        assert pages == sorted(dated, reverse=True) + sorted(undated, reverse=True)
+
+
+def test_export_reads_every_row_in_chunks(app):
+    with app.app_context():
+        ids = add_rows([datetime(2024, 1, 1)] * 7 + [None] * 3)
+        exported = [row.id for row in ledger.iter_ledger({}, chunk_size=4)]
+        assert sorted(exported) == sorted(ids)
+        assert len(exported) == len(set(exported))
+
+
+def test_account_filter_ignores_user_ids_in_award_columns(app):
+    with app.app_context():
+        # An award to user 5 from user 2 recorded against account 9, and a row that belongs to account 5
+        award = add_rows([datetime(2024, 1, 1)], account_id=9, from_account_id=2, to_account_id=5)
+        own = add_rows([datetime(2024, 1, 2)], account_id=5)
+        rows, _ = ledger.ledger_page({'account_id': 5})
+        assert [row.id for row in rows] == own
+        rows, _ = ledger.ledger_page({'account_id': 9})
+        assert [row.id for row in rows] == award
+
+
+def test_cursor_round_trips_and_rejects_garbage():
+    stamp = datetime(2024, 1, 1, 8, 30)
+    assert ledger.decode_cursor(ledger.encode_cursor(stamp, 42)) == (stamp, 42)
+    assert ledger.decode_cursor(ledger.encode_cursor(None, 7)) == (None, 7)
+    assert ledger.decode_cursor('not a cursor') is None
+
+
+def test_only_admins_see_the_admin_page(app, client):
+    anonymous = client.get('/admin')
+    assert anonymous.status_code == 302
+    assert '/login' in anonymous.headers['Location']
+    assert log_in(app.test_client(), 'student@Kimberley.com').get('/admin').status_code == 403
+    assert log_in(app.test_client(), 'teacher@Kimberley.com').get('/admin').status_code == 403
+    assert log_in(app.test_client(), 'admin@Kimberley.com').get('/admin').status_code == 200
@@ -0,0 +1,89 @@
+import os
+
+from website import create_app, db
+from website.metrics import EXITED_FILE, ValueFile, metric_key, metrics
+from website.seed import seed
+
+from conftest import log_in
+
+# A process id no process can have, standing in for a worker process that has exited
+EXITED_PID = 4194304 + 1
+
+
+# Function to get the value of one sample line from the exposition, or None if it is missing
+def sample_value(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+def test_metrics_add_up_every_process_and_drop_gauges_of_exited_ones(app, client):
+    # The file an exited worker process left behind, with two requests and one still in flight when it died
+    exited = ValueFile(os.path.join(app.config['METRICS_DIR'], f'metrics_{EXITED_PID}.db'))
+    exited.add(metric_key('http_requests_total', endpoint='auth.login', method='GET', status='200'), 2)
+    exited.add(metric_key('http_requests_in_flight', endpoint='auth.login'), 1)
+    exited.add(metric_key('http_request_duration_seconds_bucket', endpoint='auth.login', le='0.005'), 2)
+    exited.add(metric_key('http_request_duration_seconds_count', endpoint='auth.login'), 2)
+    exited.close()
+
+    for _ in range(3):
+        assert client.get('/login').status_code == 200
+    text = client.get('/metrics').get_data(as_text=True)
+
+    assert sample_value(text, 'http_requests_total{endpoint="auth.login",method="GET",status="200"}') == 5.0
+    assert sample_value(text, 'http_request_duration_seconds_count{endpoint="auth.login"}') == 5.0
+    assert sample_value(text, 'http_request_duration_seconds_bucket{endpoint="auth.login",le="+Inf"}') == 5.0
+    assert sample_value(text, 'http_requests_in_flight{endpoint="auth.login"}') == 0.0
+
+
+def test_files_of_exited_processes_are_folded_and_deleted(app, client):
+    directory = app.config['METRICS_DIR']
+    for pid, requests in ((EXITED_PID, 2), (EXITED_PID + 1, 4)):
+        exited = ValueFile(os.path.join(directory, f'metrics_{pid}.db'))
+        exited.add(metric_key('http_requests_total', endpoint='auth.login', method='GET', status='200'), requests)
+        exited.add(metric_key('http_requests_in_flight', endpoint='auth.login'), 1)
+        exited.close()
+
+    assert client.get('/login').status_code == 200
+    # Reading the metrics again must not count the folded values twice
+    for _ in range(2):
+        text = client.get('/metrics').get_data(as_text=True)
+        assert sample_value(text, 'http_requests_total{endpoint="auth.login",method="GET",status="200"}') == 7.0
+        assert sample_value(text, 'http_requests_in_flight{endpoint="auth.login"}') == 0.0
+    assert sorted(name for name in os.listdir(directory) if name.endswith('.db')) == sorted([EXITED_FILE, f'metrics_{os.getpid()}.db'])
+
+    # A process exiting later is folded into the same file
+    exited = ValueFile(os.path.join(directory, f'metrics_{EXITED_PID + 2}.db'))
+    exited.add(metric_key('http_requests_total', endpoint='auth.login', method='GET', status='200'), 10)
+    exited.close()
+    text = client.get('/metrics').get_data(as_text=True)
+    assert sample_value(text, 'http_requests_total{endpoint="auth.login",method="GET",status="200"}') == 17.0
+    assert not os.path.exists(os.path.join(directory, f'metrics_{EXITED_PID + 2}.db'))
+
+    with app.app_context():
+        assert metrics.clear() == 2
+    assert not any(name.endswith('.db') for name in os.listdir(directory))
+
+
+def test_private_metrics_need_the_token_or_an_admin(tmp_path):
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + str(tmp_path / 'test.db'),
+        'METRICS_DIR': str(tmp_path / 'metrics'),
+        'METRICS_PUBLIC': False,
+        'METRICS_TOKEN': 'scrape-me',
+        'CACHE_BACKEND': 'none',
+        'TESTING': True,
+    })
+    with app.app_context():
+        seed()
+    try:
+        assert app.test_client().get('/metrics').status_code == 403
+        assert app.test_client().get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+        assert app.test_client().get('/metrics', headers={'Authorization': 'Bearer scrape-me'}).status_code == 200
+        assert log_in(app.test_client(), 'student@Kimberley.com').get('/metrics').status_code == 403
+        assert log_in(app.test_client(), 'admin@Kimberley.com').get('/metrics').status_code == 200
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+from website import db, coupons, rollups
+from website.migrations import points_rollups, coupon_expiry
+from website.models import Coupon, Job, StudentPoints, ClassPoints, YearGroupPoints
+from website.posting import post_award, post_purchase
+
+from conftest import log_in
+from test_posting import seeded_ids, staff, two_classes
+
+
+# Function to read every rollup table as sorted tuples
+def rollup_rows():
+    return (
+        sorted(db.session.query(StudentPoints.student_id, StudentPoints.points_earned, StudentPoints.points_spent, StudentPoints.awards)),
+        sorted(db.session.query(ClassPoints.class_id, ClassPoints.points_awarded, ClassPoints.awards)),
+        sorted(db.session.query(YearGroupPoints.year_group, YearGroupPoints.points_awarded, YearGroupPoints.awards)),
+    )
+
+
+def test_rollup_backfill_matches_a_rebuild(app):
+    with app.app_context():
+        teacher_id, student_id, class_id, _ = two_classes()
+        post_award(staff(teacher_id), student_id, 7, class_id=class_id)
+        post_award(staff(teacher_id), student_id, 5)
+        coupons.fill_pool(1)
+        post_purchase(staff(student_id), 'Pen', 'A pen', 10)
+
+        points_rollups()
+        db.session.commit()
+        backfilled = rollup_rows()
+        rollups.rebuild()
+        assert backfilled == rollup_rows()
+        assert backfilled[0] == [(student_id, 12, 10, 2)]
+        assert db.session.query(Job).filter_by(kind=rollups.ROLLUP_JOB).count() == 0
+
+
+def test_coupon_backfill_sets_expiry_and_queues_nothing(app):
+    now = datetime.utcnow()
+    with app.app_context():
+        _, student_id = seeded_ids()
+        # Coupons as they were before the migration, redeemed without a status or expiry
+        for code, redeemed, redeem_date in (('OLD00001', True, now - timedelta(days=3)), ('NEW00001', True, now - timedelta(hours=1)),
+                                            ('UNDATED1', True, None), ('UNUSED01', False, None)):
+            db.session.execute(Coupon.__table__.insert().values(
+                student_id=student_id, name='Pen', description='A pen', points_cost=10, code=code, redeemed=redeemed, redeem_date=redeem_date,
+            ))
+        db.session.commit()
+
+        coupon_expiry()
+        db.session.commit()
+        statuses = dict(db.session.query(Coupon.code, Coupon.status))
+        assert statuses == {'OLD00001': 'expired', 'NEW00001': 'redeemed', 'UNDATED1': 'expired', 'UNUSED01': 'active'}
+        assert db.session.query(Coupon.expires_at).filter_by(code='NEW00001').scalar() > now
+        assert db.session.query(Job).filter_by(kind=coupons.SWEEP_JOB).count() == 0
+
+
+def test_coupon_backfill_invalidates_cached_coupon_lists(app, client):
+    with app.app_context():
+        _, student_id = seeded_ids()
+        db.session.execute(Coupon.__table__.insert().values(
+            student_id=student_id, name='Pen', description='A pen', points_cost=10, code='OLD00001', redeemed=True,
+            redeem_date=datetime.utcnow() - timedelta(days=3),
+        ))
+        db.session.commit()
+    log_in(client, 'student@Kimberley.com')
+    tag = client.get('/api/v1/coupons').headers['ETag']
+    assert client.get('/api/v1/coupons', headers={'If-None-Match': tag}).status_code == 304
+
+    with app.app_context():
+        coupon_expiry()
+        db.session.commit()
+    response = client.get('/api/v1/coupons', headers={'If-None-Match': tag})
+    assert response.status_code == 200
+    assert response.json['coupons'] == []
@@ -0,0 +1,61 @@
+import threading
+
+from website import db
+from website.models import User
+from website.naming import allocate_username, allocate_usernames, allocate_class_name, highest_suffix
+
+
+def test_concurrent_sign_ups_never_share_a_username(app):
+    names = []
+    errors = []
+
+    def sign_up(thread):
+        with app.app_context():
+            try:
+                for n in range(5):
+                    user_name = allocate_username('Jonas', 'Smith')
+                    db.session.add(User(email=f'jonas{thread}.{n}@school', first_name='Jonas', last_name='Smith', user_name=user_name))
+                    db.session.commit()
+                    names.append(user_name)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=sign_up, args=(thread,)) for thread in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(names) == sorted(['jonsmi'] + [f'jonsmi{suffix}' for suffix in range(1, 30)])
+
+
+def test_concurrent_class_names_are_unique(app):
+    names = []
+
+    def create(thread):
+        with app.app_context():
+            for _ in range(5):
+                names.append(allocate_class_name('7MJS'))
+                db.session.commit()
+            db.session.remove()
+
+    threads = [threading.Thread(target=create, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(names)) == len(names) == 20
+
+
+def test_counting_starts_after_names_made_before_the_counter(app):
+    with app.app_context():
+        for n, user_name in enumerate(['annlee', 'annlee4', 'annleeX', 'annlee2b', 'carroe']):
+            db.session.add(User(email=f'ann{n}@school', first_name='Ann', last_name='Lee', user_name=user_name))
+        db.session.commit()
+        assert highest_suffix(User.user_name, 'annlee') == 4
+        assert highest_suffix(User.user_name, 'carroe') == 0
+        assert highest_suffix(User.user_name, 'bobkay') == -1
+        assert allocate_usernames([('Ann', 'Lee'), ('Ann', 'Lee'), ('Bob', 'Kay')]) == ['annlee5', 'annlee6', 'bobkay']
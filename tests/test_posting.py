@@ -0,0 +1,205 @@
+import threading
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+from website import db, quota, coupons
+from website.models import User, Account, Transactions, Class, TeacherQuota, student_class
+from website.posting import post_award, post_bulk_award, post_purchase, PostingError
+from website.roles import roles
+
+
+# Function to get the ids of the seeded teacher and student
+def seeded_ids():
+    teacher_id = db.session.query(User.id).filter_by(email='teacher@Kimberley.com').scalar()
+    student_id = db.session.query(User.id).filter_by(email='student@Kimberley.com').scalar()
+    return teacher_id, student_id
+
+
+# Function to stand in for the signed-in user that the posting service is given
+def staff(user_id, admin=False):
+    return SimpleNamespace(id=user_id, is_admin=lambda: admin)
+
+
+# Function to run work(index) in several threads at once, each inside its own application context, counting what raised
+def run_concurrently(app, work, threads):
+    start = threading.Barrier(threads)
+    failures = []
+
+    def run(index):
+        with app.app_context():
+            start.wait()
+            try:
+                work(index)
+            except PostingError:
+                failures.append(index)
+            finally:
+                db.session.remove()
+
+    workers = [threading.Thread(target=run, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return failures
+
+
+def test_concurrent_awards_lose_no_updates(app):
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': 10000})
+        db.session.commit()
+    teacher = staff(teacher_id)
+
+    def award(index):
+        for _ in range(10):
+            post_award(teacher, student_id, 3)
+
+    assert run_concurrently(app, award, threads=6) == []
+    with app.app_context():
+        assert db.session.query(Account.balance).filter_by(user_id=student_id).scalar() == 6 * 10 * 3
+        assert db.session.query(Transactions).filter_by(to_account_id=student_id).count() == 60
+        assert quota.teacher_quota(teacher_id).points_awarded == 180
+
+
+def test_concurrent_awards_never_exceed_the_weekly_quota(app):
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': 50})
+        db.session.commit()
+    teacher = staff(teacher_id)
+
+    # Twenty awards of 5 points against a limit of 50, so exactly ten can succeed
+    failures = run_concurrently(app, lambda index: post_award(teacher, student_id, 5), threads=20)
+    assert len(failures) == 10
+    with app.app_context():
+        assert db.session.query(Account.balance).filter_by(user_id=student_id).scalar() == 50
+        assert quota.teacher_quota(teacher_id).points_awarded == 50
+
+
+def test_concurrent_purchases_never_overdraw(app):
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        post_award(staff(teacher_id), student_id, 30)
+        coupons.fill_pool(10)
+    student = SimpleNamespace(id=student_id)
+
+    # Six purchases of 10 points against a balance of 30, so exactly three can succeed
+    failures = run_concurrently(app, lambda index: post_purchase(student, 'Pen', 'A pen', 10), threads=6)
+    assert len(failures) == 3
+    with app.app_context():
+        assert db.session.query(Account.balance).filter_by(user_id=student_id).scalar() == 0
+
+
+def test_award_to_a_non_student_changes_nothing(app):
+    with app.app_context():
+        teacher_id, _ = seeded_ids()
+        with pytest.raises(PostingError):
+            post_award(staff(teacher_id), teacher_id, 5)
+        assert quota.teacher_quota(teacher_id).points_awarded == 0
+        assert db.session.query(Transactions).count() == 0
+
+
+# Function to create a second teacher and one class for each teacher in year group 7, with the student enrolled in both
+def two_classes():
+    teacher_id, student_id = seeded_ids()
+    other = User(email='other@Kimberley.com', first_name='Other', last_name='Teacher', role_id=roles.id('teacher'), role_approved=True)
+    db.session.add(other)
+    db.session.flush()
+    db.session.add(Account(user_id=other.id, balance=0, points_awarded=0))
+    own = Class(name='own', year_group=7, teacher_id=teacher_id)
+    theirs = Class(name='theirs', year_group=7, teacher_id=other.id)
+    db.session.add_all([own, theirs])
+    db.session.flush()
+    db.session.execute(student_class.insert(), [{'student_id': student_id, 'class_id': own.id}, {'student_id': student_id, 'class_id': theirs.id}])
+    db.session.commit()
+    return teacher_id, student_id, own.id, theirs.id
+
+
+def test_teachers_cannot_award_to_another_teachers_class(app):
+    with app.app_context():
+        teacher_id, student_id, own, theirs = two_classes()
+        with pytest.raises(PostingError):
+            post_award(staff(teacher_id), student_id, 5, class_id=theirs)
+        with pytest.raises(PostingError):
+            post_bulk_award(staff(teacher_id), 5, class_id=theirs)
+        assert db.session.query(Account.balance).filter_by(user_id=student_id).scalar() == 0
+
+        post_award(staff(teacher_id), student_id, 5, class_id=own)
+        assert post_bulk_award(staff(teacher_id), 5, class_id=own) == 1
+
+
+def test_year_group_awards_only_reach_the_teachers_own_classes(app):
+    with app.app_context():
+        teacher_id, student_id, own, theirs = two_classes()
+        # An unrelated student only in the other teacher's class
+        outsider = User(email='outsider@Kimberley.com', first_name='Out', last_name='Sider', role_id=roles.id('student'))
+        db.session.add(outsider)
+        db.session.flush()
+        db.session.add(Account(user_id=outsider.id, balance=0))
+        db.session.execute(student_class.insert(), [{'student_id': outsider.id, 'class_id': theirs}])
+        db.session.commit()
+
+        assert post_bulk_award(staff(teacher_id), 5, year_group=7) == 1
+        assert db.session.query(Account.balance).filter_by(user_id=outsider.id).scalar() == 0
+        with pytest.raises(PostingError):
+            post_bulk_award(staff(teacher_id), 5, year_group=8)
+
+        # An admin may award to the whole year group
+        admin_id = db.session.query(User.id).filter_by(email='admin@Kimberley.com').scalar()
+        db.session.add(Account(user_id=admin_id, balance=0, points_awarded=0))
+        db.session.query(User).filter_by(id=admin_id).update({'weekly_point_limit': 1000})
+        db.session.commit()
+        assert post_bulk_award(staff(admin_id, admin=True), 5, year_group=7) == 2
+
+
+# Function to set the seeded teacher's weekly limit and return their id
+def teacher_with_limit(limit):
+    teacher_id, _ = seeded_ids()
+    db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': limit})
+    db.session.commit()
+    return teacher_id
+
+
+def test_week_keys_follow_the_iso_year_across_new_year():
+    assert quota.week_key(date(2026, 12, 31)) == (2026, 53)
+    assert quota.week_key(date(2027, 1, 1)) == (2026, 53)
+    assert quota.week_key(date(2027, 1, 4)) == (2027, 1)
+    assert quota.week_key(date(2024, 12, 30)) == (2025, 1)
+
+
+def test_first_charge_of_a_week_creates_the_row_then_charges_it(app):
+    with app.app_context():
+        teacher_id = teacher_with_limit(10)
+        assert db.session.query(TeacherQuota).count() == 0
+        assert quota.charge(teacher_id, 4, date(2026, 12, 31))
+        assert quota.charge(teacher_id, 6, date(2027, 1, 1))
+        db.session.commit()
+        assert db.session.query(TeacherQuota.iso_year, TeacherQuota.iso_week, TeacherQuota.points_awarded).all() == [(2026, 53, 10)]
+
+
+def test_charge_is_refused_once_over_the_limit_and_a_new_iso_week_starts_afresh(app):
+    with app.app_context():
+        teacher_id = teacher_with_limit(10)
+        assert quota.charge(teacher_id, 10, date(2026, 12, 31))
+        # New Year's Day 2027 is still in ISO week 53 of 2026, so the limit is already used up
+        assert not quota.charge(teacher_id, 1, date(2027, 1, 1))
+        assert quota.charge(teacher_id, 10, date(2027, 1, 4))
+        db.session.commit()
+        assert sorted(db.session.query(TeacherQuota.iso_year, TeacherQuota.iso_week, TeacherQuota.points_awarded)) == [(2026, 53, 10), (2027, 1, 10)]
+
+
+def test_concurrent_first_charges_of_a_week_never_overcharge(app):
+    with app.app_context():
+        teacher_id = teacher_with_limit(50)
+
+    # Eight charges of 10 against a limit of 50 in a week with no row yet, so they all race to create it and five can succeed
+    def charge(index):
+        if not quota.charge(teacher_id, 10, date(2027, 1, 4)):
+            raise PostingError('over the limit')
+        db.session.commit()
+
+    assert len(run_concurrently(app, charge, threads=8)) == 3
+    with app.app_context():
+        assert db.session.query(TeacherQuota.points_awarded).scalar() == 50
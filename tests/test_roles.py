@@ -0,0 +1,33 @@
+from website import db
+from website.models import Role
+from website.roles import roles
+
+
+def test_seeded_roles_resolve_both_ways(app):
+    with app.app_context():
+        teacher_id = roles.id('teacher')
+        assert teacher_id is not None
+        assert roles.name(teacher_id) == 'teacher'
+
+
+def test_role_created_after_startup_is_found_by_reloading(app):
+    with app.app_context():
+        role = Role(name='librarian')
+        db.session.add(role)
+        db.session.commit()
+        assert 'librarian' not in roles.ids_by_name
+        assert roles.id('librarian') == role.id
+        assert roles.name(role.id) == 'librarian'
+
+
+def test_unknown_role_reloads_and_resolves_to_none(app, monkeypatch):
+    with app.app_context():
+        loads = []
+        load = roles.load
+        monkeypatch.setattr(roles, 'load', lambda: loads.append(1) or load())
+        assert roles.id('janitor') is None
+        assert roles.name(-1) is None
+        assert len(loads) == 2
+        # Known names are answered from memory
+        roles.id('student')
+        assert len(loads) == 2
@@ -0,0 +1,34 @@
+import threading
+
+from website import db, rollups
+from website.jobs import Worker
+from website.models import StudentPoints, User
+from website.posting import post_award
+
+from test_posting import seeded_ids, staff
+
+
+def test_rebuild_during_postings_loses_and_doubles_nothing(app):
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': 10000})
+        db.session.commit()
+    teacher = staff(teacher_id)
+    done = threading.Event()
+
+    def award():
+        with app.app_context():
+            for _ in range(60):
+                post_award(teacher, student_id, 2)
+            db.session.remove()
+        done.set()
+
+    poster = threading.Thread(target=award)
+    poster.start()
+    with app.app_context():
+        while not done.is_set():
+            rollups.rebuild()
+        poster.join()
+        # Whatever the rebuilds kept of the queue, applying it brings the rollups level with the ledger
+        Worker(app.config).work(once=True)
+        assert db.session.query(StudentPoints.points_earned, StudentPoints.awards).filter_by(student_id=student_id).one() == (120, 60)
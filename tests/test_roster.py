@@ -0,0 +1,109 @@
+import csv
+
+from werkzeug.security import check_password_hash
+
+from website import db, roster
+from website.models import User, Account, Class, student_class
+from website.roster import import_roster
+
+
+# Function to build a roster row for a student with the given email and password
+def student_row(email, password):
+    return {'email': email, 'first_name': 'Rosa', 'last_name': 'Parks', 'password': password, 'role': 'student'}
+
+
+def test_weak_passwords_are_reported_and_not_imported(app):
+    with app.app_context():
+        result = import_roster([student_row('strong@school', 'Secret!123'), student_row('weak@school', 'password1')], workers=1)
+        assert [error['email'] for error in result.errors] == ['weak@school']
+        assert 'uppercase letter' in result.errors[0]['error']
+        assert db.session.query(User.email).filter(User.email.in_(['strong@school', 'weak@school'])).all() == [('strong@school',)]
+
+
+# Function to build a roster of count students with distinct emails and names
+def students(count, classes=''):
+    return [
+        {'email': f'pupil{n}@school', 'first_name': 'Pupil', 'last_name': 'Number' + 'abcdefghij'[n % 10] * (1 + n // 10),
+         'password': 'Secret!123', 'role': 'student', 'classes': classes}
+        for n in range(count)
+    ]
+
+
+def test_large_rosters_hash_passwords_in_worker_processes(monkeypatch):
+    pools = []
+
+    class RecordingPool(roster.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            pools.append(kwargs)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(roster, 'ProcessPoolExecutor', RecordingPool)
+    passwords = [f'Secret!{n}' for n in range(roster.POOL_THRESHOLD)]
+    hashes = roster.hash_passwords(passwords, workers=2)
+    assert pools == [{'max_workers': 2}]
+    assert len(hashes) == len(passwords)
+    assert check_password_hash(hashes[0], passwords[0]) and check_password_hash(hashes[-1], passwords[-1])
+
+    # Smaller rosters, or a single worker, hash in this process
+    roster.hash_passwords(passwords[:roster.POOL_THRESHOLD - 1], workers=2)
+    roster.hash_passwords(passwords, workers=1)
+    assert len(pools) == 1
+
+
+def test_rows_are_inserted_and_looked_up_in_batches(app, monkeypatch):
+    monkeypatch.setattr(roster, 'INSERT_BATCH_SIZE', 3)
+    monkeypatch.setattr(roster, 'LOOKUP_CHUNK_SIZE', 2)
+    with app.app_context():
+        db.session.add_all([Class(name='7MTL', year_group=7), Class(name='8MTL', year_group=8)])
+        db.session.commit()
+        result = import_roster(students(8, classes='7MTL; 8MTL'), workers=1)
+        assert (result.imported, result.errors) == (8, [])
+
+        imported = User.query.filter(User.email.like('pupil%@school')).all()
+        assert len(imported) == 8
+        assert len({user.user_name for user in imported}) == 8
+        assert all(user.account_id is not None for user in imported)
+        assert db.session.query(Account).filter(Account.user_id.in_([user.id for user in imported])).count() == 8
+        assert db.session.query(student_class).count() == 16
+
+
+def test_a_roster_above_the_pool_threshold_imports_every_row(app, monkeypatch):
+    monkeypatch.setattr(roster, 'INSERT_BATCH_SIZE', 200)
+    with app.app_context():
+        result = import_roster(students(roster.POOL_THRESHOLD + 20), workers=2)
+        assert (result.imported, result.errors) == (roster.POOL_THRESHOLD + 20, [])
+        user = User.query.filter_by(email='pupil519@school').one()
+        assert check_password_hash(user.password, 'Secret!123')
+
+
+def test_problem_rows_are_written_to_the_errors_file(app, tmp_path):
+    rows = students(2) + [
+        {'email': 'pupil0@school', 'first_name': 'Again', 'last_name': 'Again', 'password': 'Secret!123'},
+        {'email': 'student@Kimberley.com', 'first_name': 'Taken', 'last_name': 'Email', 'password': 'Secret!123'},
+        {'email': 'nobody', 'first_name': 'N0', 'last_name': 'Body', 'password': 'Secret!123', 'role': 'janitor'},
+        {'email': 'lost@school', 'first_name': 'Lost', 'last_name': 'Pupil', 'password': 'Secret!123', 'classes': '9XYZ'},
+    ]
+    path = tmp_path / 'roster.csv'
+    with path.open('w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['email', 'first_name', 'last_name', 'password', 'role', 'classes'])
+        writer.writeheader()
+        writer.writerows(rows)
+    errors_path = tmp_path / 'errors.csv'
+
+    result = app.test_cli_runner().invoke(args=['import-roster', str(path), '--errors', str(errors_path), '--workers', '1'])
+    assert result.exit_code == 0
+    assert 'imported 2 users' in result.output
+
+    with errors_path.open() as file:
+        errors = list(csv.DictReader(file))
+    assert [(error['line'], error['email']) for error in errors] == [
+        ('4', 'pupil0@school'),
+        ('5', 'student@Kimberley.com'),
+        ('6', 'nobody'),
+        ('6', 'nobody'),
+        ('6', 'nobody'),
+        ('7', 'lost@school'),
+    ]
+    assert errors[0]['error'] == 'this email address is listed more than once'
+    assert errors[1]['error'] == 'a user with this email address already exists'
+    assert errors[-1]['error'] == 'unknown class 9XYZ'
@@ -0,0 +1,32 @@
+import json
+
+import click
+import pytest
+
+from website.seed import load_seed_file
+
+
+# Function to write a seed file with the given staff and return its path
+def seed_file(tmp_path, staff):
+    path = tmp_path / 'seed.json'
+    path.write_text(json.dumps({'subjects': ['Latin'], 'staff': staff}))
+    return str(path)
+
+
+def test_teacher_without_a_last_name_is_rejected(tmp_path):
+    path = seed_file(tmp_path, [{'email': 't@school', 'password': 'pw', 'first_name': 'Tess', 'role': 'teacher'}])
+    with pytest.raises(click.BadParameter, match='last_name'):
+        load_seed_file(path)
+
+
+def test_admin_without_a_last_name_is_accepted(tmp_path):
+    path = seed_file(tmp_path, [{'email': 'a@school', 'password': 'pw', 'first_name': 'Ada', 'role': 'admin'}])
+    subjects, people = load_seed_file(path)
+    assert subjects == ['Latin']
+    assert [person['email'] for person in people] == ['a@school']
+
+
+def test_unknown_role_is_rejected(tmp_path):
+    path = seed_file(tmp_path, [{'email': 'x@school', 'password': 'pw', 'first_name': 'X', 'last_name': 'Y', 'role': 'janitor'}])
+    with pytest.raises(click.BadParameter, match='unknown role'):
+        load_seed_file(path)
@@ -0,0 +1,108 @@
+import csv
+import io
+import json
+from types import SimpleNamespace
+
+from website import db, coupons, statements
+from website.models import User, Account, Coupon
+from website.posting import post_award, post_purchase
+from website.roles import roles
+
+from conftest import log_in
+from test_posting import seeded_ids, staff
+
+
+# Function to give the seeded student 30 points and two purchases, and a second student 7 points, returning both account ids
+def two_histories():
+    teacher_id, student_id = seeded_ids()
+    db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': 1000})
+    other = User(email='second@Kimberley.com', first_name='Second', last_name='Student', user_name='SSTUDENT', role_id=roles.id('student'))
+    db.session.add(other)
+    db.session.flush()
+    db.session.add(Account(user_id=other.id, balance=0, points_awarded=0))
+    db.session.commit()
+    coupons.fill_pool(5)
+    post_award(staff(teacher_id), student_id, 30)
+    post_purchase(SimpleNamespace(id=student_id), 'Pen', 'A pen', 10)
+    post_purchase(SimpleNamespace(id=student_id), 'Book', 'A book', 5)
+    post_award(staff(teacher_id), other.id, 7)
+    account_id = db.session.query(Account.id).filter_by(user_id=student_id).scalar()
+    other_account_id = db.session.query(Account.id).filter_by(user_id=other.id).scalar()
+    return account_id, other_account_id
+
+
+def test_rows_carry_the_running_balance_and_the_coupon_of_each_purchase(app):
+    with app.app_context():
+        account_id, _ = two_histories()
+        # Redeem the book, so its code may be shown
+        db.session.query(Coupon).filter_by(name='Book').update({'redeemed': True})
+        db.session.commit()
+        rows = statements.statement_rows(account_id)
+    assert [(row['amount'], row['balance'], row['coupon_name']) for row in rows] == [(30, 30, None), (-10, 20, 'Pen'), (-5, 15, 'Book')]
+    # The code of a coupon is only shown once it has been redeemed
+    assert rows[1]['coupon_code'] is None
+    assert rows[2]['coupon_code'] is not None
+
+
+def test_running_balances_start_again_for_each_account(app):
+    with app.app_context():
+        account_id, other_account_id = two_histories()
+        rows = list(statements.iter_statement_rows())
+    assert [(row['account_id'], row['balance']) for row in rows] == [(account_id, 30), (account_id, 20), (account_id, 15), (other_account_id, 7)]
+
+
+def test_students_download_only_their_own_statement(app, client):
+    with app.app_context():
+        account_id, _ = two_histories()
+    log_in(client, 'student@Kimberley.com')
+    response = client.get(f'/statements?format=csv&account_id={account_id + 1}')
+    assert response.status_code == 200
+    assert f'statement-{account_id}.csv' in response.headers['Content-Disposition']
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert {row['account_id'] for row in rows} == {str(account_id)}
+    assert rows[-1]['balance'] == '15'
+
+
+def test_admins_download_every_statement(app, client):
+    with app.app_context():
+        account_id, other_account_id = two_histories()
+    log_in(client, 'admin@Kimberley.com')
+    lines = client.get('/statements?format=jsonl').get_data(as_text=True).splitlines()
+    assert [json.loads(line)['account_id'] for line in lines] == [account_id] * 3 + [other_account_id]
+
+    page = client.get(f'/statements?format=html&account_id={other_account_id}').get_data(as_text=True)
+    assert page.count('<section>') == 1
+    assert 'Closing balance: 7' in page
+    assert client.get('/statements?format=xml').status_code == 400
+
+
+def test_export_command_writes_the_statements(app, tmp_path):
+    with app.app_context():
+        account_id, _ = two_histories()
+    output = tmp_path / 'statements.csv'
+    result = app.test_cli_runner().invoke(args=['export-statements', '--account-id', str(account_id), '--output', str(output)])
+    assert result.exit_code == 0
+    rows = list(csv.DictReader(output.open()))
+    assert [row['balance'] for row in rows] == ['30', '20', '15']
+
+
+def test_dashboard_query_count_does_not_grow_with_the_purchases(app, client):
+    with app.app_context():
+        teacher_id, student_id = seeded_ids()
+        db.session.query(User).filter_by(id=teacher_id).update({'weekly_point_limit': 1000})
+        db.session.commit()
+        coupons.fill_pool(20)
+        post_award(staff(teacher_id), student_id, 100)
+    log_in(client, 'student@Kimberley.com')
+    client.get('/dashboard')
+    with app.app_context():
+        post_purchase(SimpleNamespace(id=student_id), 'Pen', 'A pen', 1)
+    few = client.get('/dashboard')
+    with app.app_context():
+        for n in range(15):
+            post_purchase(SimpleNamespace(id=student_id), f'Item {n}', 'Something', 1)
+    many = client.get('/dashboard')
+    assert many.status_code == 200
+    assert b'Item 14' in many.data
+    assert 'X-SQL-N-Plus-One' not in many.headers
+    assert many.headers['X-SQL-Queries'] == few.headers['X-SQL-Queries']
@@ -0,0 +1,55 @@
+import pytest
+
+from website import db
+from website.models import Class, User
+from website.timetable import create_timetable, TimetableError
+
+
+# Function to approve the seeded teacher, or withdraw their approval
+def approve_teacher(approved=True):
+    db.session.query(User).filter_by(email='teacher@Kimberley.com').update({'role_approved': approved})
+    db.session.commit()
+
+
+def row(year_group, subject, teacher_email='teacher@Kimberley.com'):
+    return {'year_group': year_group, 'subject': subject, 'teacher_email': teacher_email}
+
+
+def test_timetable_creates_every_class_with_allocated_names(app):
+    with app.app_context():
+        approve_teacher()
+        names = create_timetable([row('7', 'Math'), row('8', 'Math'), row('7', 'Music')])
+        assert names == ['7MTL', '8MTL', '7MTL1']
+        assert sorted(name for (name,) in db.session.query(Class.name)) == sorted(names)
+
+
+def test_any_bad_row_creates_nothing_and_every_problem_is_reported(app):
+    with app.app_context():
+        approve_teacher()
+        with pytest.raises(TimetableError) as error:
+            create_timetable([row('7', 'Math'), row('7', 'Latin'), row('x', 'Art'), row('9', 'Art', 'nobody@school')])
+        assert error.value.problems == [
+            'line 3: unknown subject Latin', 'line 4: invalid year group x', 'line 5: unknown teacher nobody@school',
+        ]
+        assert db.session.query(Class).count() == 0
+
+
+def test_duplicate_classes_are_refused_within_the_file_and_on_reimport(app):
+    with app.app_context():
+        approve_teacher()
+        with pytest.raises(TimetableError) as error:
+            create_timetable([row('7', 'Math'), row('7', 'Math')])
+        assert error.value.problems == ['line 3: the same class as line 2']
+
+        create_timetable([row('7', 'Math')])
+        with pytest.raises(TimetableError) as error:
+            create_timetable([row('7', 'Math')])
+        assert error.value.problems == ['line 2: teacher@Kimberley.com already teaches year 7 Math']
+        assert db.session.query(Class).count() == 1
+
+
+def test_unapproved_teachers_are_refused(app):
+    with app.app_context():
+        approve_teacher(False)
+        with pytest.raises(TimetableError, match='has not been approved'):
+            create_timetable([row('7', 'Math')])
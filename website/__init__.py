@@ -3,8 +3,8 @@ from flask import Flask, session
 from flask_sqlalchemy import SQLAlchemy
 from os import path
 from flask_login import LoginManager, login_user
-from werkzeug.security import generate_password_hash
 import secrets
+from .config import configure_app, init_engine
 
 # Initialize SQLAlchemy
 db = SQLAlchemy()
@@ -21,15 +21,23 @@ def generate_csrf_token():
     return session['_csrf_token']
 
 # Create a Flask application instance
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
 
-    # Set application configuration
-    app.config['SECRET_KEY'] = 'hjshjhdjah kjshkjdhjs'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB_NAME  #store database inside the directory of the init.py file
+    # Set application configuration for the environment, see config.py
+    configure_app(app, test_config)
 
-    # Initialize database
+    # Initialize database, applying the SQLite pragmas to every connection before anything connects,
+    # and count the statements each request sends, see instrumentation.py
     db.init_app(app)
+    from .instrumentation import instrumentation
+    with app.app_context():
+        init_engine(app, db.engine)
+        instrumentation.init_app(app, db.engine)
+
+    # Time every request and serve the totals of all worker processes at /metrics, see metrics.py
+    from .metrics import metrics
+    metrics.init_app(app)
 
     # Make the CSRF token generator available in templates
     app.jinja_env.globals['csrf_token'] = generate_csrf_token
@@ -40,100 +48,65 @@ def create_app():
     login_manager.init_app(app)
     login_manager.login_message_category = 'info'
 
-    # Load user data from database for user authentication
+    # Load the current user from the identity cache, which only queries the database when the user's record is missing or stale
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
-
-    # Create admin, teacher, and student users with corresponding roles and accounts
-    @app.before_first_request
-    def create_admin_user():
-        # Create the admin role if it doesn't exist
-        admin_role = Role.query.filter_by(name='admin').first()
-        if not admin_role:
-            admin_role = Role(name='admin')
-            db.session.add(admin_role)
-            db.session.commit()
-
-        # Create the teacher role if it doesn't exist
-        teacher_role = Role.query.filter_by(name='teacher').first()
-        if not teacher_role:
-            teacher_role = Role(name='teacher')
-            db.session.add(teacher_role)
-            db.session.commit()
-
-        # Create the student role if it doesn't exist
-        student_role = Role.query.filter_by(name='student').first()
-        if not student_role:
-            student_role = Role(name='student')
-            db.session.add(student_role)
-            db.session.commit()
-
-        # Create the admin user if it doesn't exist
-        admin = User.query.filter_by(email='admin@Kimberley.com').first()
-        if not admin:
-            admin = User(email='admin@Kimberley.com', password=generate_password_hash('secret', method='sha256'), first_name='Admin', role_id=admin_role.id)
-            db.session.add(admin)
-            db.session.commit()
-
-        # Create the teacher user if it doesn't exist
-        teacher = User.query.filter_by(email='teacher@Kimberley.com').first()
-        if not teacher:
-            teacher = User(email='teacher@Kimberley.com', password=generate_password_hash('secret', method='sha256'), first_name='Teacher', last_name='LastName', role_id=teacher_role.id)
-            teacher.user_name = generate_username(teacher.first_name, teacher.last_name)
-            db.session.add(teacher)
-            db.session.commit()
-
-        # Create the teacher account if it doesn't exist
-        teacher_account = Account.query.filter_by(user_id=teacher.id).first()
-        if not teacher_account:
-            teacher_account = Account(user=teacher, balance=0)
-            db.session.add(teacher_account)
-            db.session.commit()
-
-        # Check if a user with email 'student@Kimberley.com' exists, and create one if not
-        student = User.query.filter_by(email='student@Kimberley.com').first()
-        if not student:
-            student = User(email='student@Kimberley.com', password=generate_password_hash('secret', method='sha256'), first_name='Student', last_name='LastName', role_id=student_role.id)
-            student.user_name = generate_username(student.first_name, student.last_name)
-            db.session.add(student)
-            db.session.commit()
-        
-        # Check if a corresponding account for the student exists, and create one if not
-        student_account = Account.query.filter_by(user_id=student.id).first()
-        if not student_account:
-            student_account = Account(user=student, balance=0)
-            db.session.add(student_account)
-            db.session.commit()
-
-
-        # Set the appropriate properties for the teacher and student accounts and commit changes to the database
-        teacher.role_approved = True
-        teacher.account_id = teacher_account.id
-        student.account_id = student_account.id
-        db.session.commit()
-    
-        # Create the Subject records for the default list of subjects if they don't exist
-        subjects_list = ['Math', 'English', 'Science', 'History', 'Geography', 'Art', 'Physical Education', 'Music']
-        for subject_name in subjects_list:
-            subject = Subject.query.filter_by(name=subject_name).first()
-            if not subject:
-                new_subject = Subject(name=subject_name)
-                db.session.add(new_subject)
-                db.session.commit()
+        return load_identity(int(id))
+
+    # The default roles, users and subjects are created by the 'flask seed' command, not on the request path
 
     # Import necessary models and blueprints inside of the function to avoid calling databases before they have been made 
-    from .models import User, Role, Subject, Account   
+    from .roles import roles
+    from .cache import cache
+    from .identity import identities, load_identity
     from .auth import auth as auth_blueprint
     app.register_blueprint(auth_blueprint)
-    from .auth import generate_username
     from .views import views as views_blueprint
     app.register_blueprint(views_blueprint)
+    from .api import api as api_blueprint
+    app.register_blueprint(api_blueprint)
+
+    # Register the command line tools for migrating and seeding the database, filling the coupon code pool, expiring coupons, importing timetables and rosters, rolling over weekly quotas, maintaining account balances and points rollups, exporting statements, clearing metrics and running the job worker
+    from .migrations import migrate_command, explain_hot_queries_command
+    from .seed import seed_command
+    from .coupons import fill_coupon_codes_command, expire_coupons_command
+    from .timetable import import_timetable_command
+    from .roster import import_roster_command
+    from .quota import rollover_quotas_command
+    from .ledger import rebuild_balances_command, snapshot_balances_command
+    from .statements import export_statements_command
+    from .rollups import rebuild_rollups_command
+    from .metrics import clear_metrics_command
+    from .jobs import worker_command, inline_jobs
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(explain_hot_queries_command)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(fill_coupon_codes_command)
+    app.cli.add_command(expire_coupons_command)
+    app.cli.add_command(import_timetable_command)
+    app.cli.add_command(import_roster_command)
+    app.cli.add_command(rollover_quotas_command)
+    app.cli.add_command(rebuild_balances_command)
+    app.cli.add_command(snapshot_balances_command)
+    app.cli.add_command(export_statements_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(clear_metrics_command)
+    app.cli.add_command(worker_command)
         
     # Create all necessary tables in the database
     with app.app_context():
         db.create_all()
 
+    # Load the role names and ids into memory once, so role checks do not query the database
+    roles.init_app(app)
+
+    # Choose the backends of the lookup list cache and the identity cache
+    cache.init_app(app)
+    identities.init_app(app)
+
+    # Run queued jobs at the end of each request instead of in 'flask worker' when JOBS_INLINE is on, see jobs.py
+    inline_jobs.init_app(app)
+
     return app
 
 # Define a function to create the database if it doesn't exist
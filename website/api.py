@@ -0,0 +1,154 @@
+from flask import Blueprint, request, jsonify, Response, abort
+from flask_login import current_user
+from . import ledger, quota, catalogue, statements, versions, coupons as coupon_service
+
+# Version 1 of the JSON API behind the dashboards. Every response carries an ETag built from the version stamps of the
+# data it contains (see versions.py), so a client sending If-None-Match gets a 304 from one primary key lookup
+# while nothing has changed, and the balance, ledger and quota queries only run when something has.
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+# Every API route needs a logged in user, answered with a JSON 401 instead of a redirect to the login page
+@api.before_request
+def require_login():
+    if not current_user.is_authenticated:
+        response = jsonify({'error': 'authentication required'})
+        response.status_code = 401
+        return response
+
+
+# Function to answer a GET with a 304 if the client's ETag is still current, or with the JSON from load() and the new ETag
+def conditional_json(entities, load, *extra):
+    # The user is part of the tag, so an admin's response is never reused for a student sharing the browser
+    tag = versions.etag(entities, current_user.id, *extra)
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        response = jsonify(load())
+    response.set_etag(tag)
+    # The browser must check with the server before reusing its copy, which is what the ETag makes cheap
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# Function to get the id of the current user's account, or a 404 if they do not have one
+def current_account_id():
+    # The account id is part of the cached identity, so this costs no query
+    account_id = current_user.account_id
+    if account_id is None:
+        abort(404)
+    return account_id
+
+
+# Route to get the current user's balance
+@api.route('/balance')
+def balance():
+    def load():
+        account_id = current_account_id()
+        return {'account_id': account_id, 'balance': ledger.current_balance(account_id)}
+    return conditional_json([versions.user_entity(current_user.id)], load)
+
+
+# Route to get transactions. Admins get one page of the whole ledger with the same filters and cursor as the admin page,
+# everyone else gets the history of their own account with the running balance
+@api.route('/transactions')
+def transactions():
+    if current_user.is_admin():
+        def load():
+            rows, next_cursor = ledger.ledger_page(ledger.parse_filters(request.args), ledger.decode_cursor(request.args.get('cursor')))
+            return {'transactions': [ledger.row_to_dict(row) for row in rows], 'next_cursor': next_cursor}
+        # New postings move the high-water mark and changes to existing rows the ledger stamp
+        return conditional_json([versions.LEDGER], load, ledger.high_water_mark(), sorted(request.args.items()))
+
+    def load():
+        return {'transactions': [statements.record_to_json(record) for record in statements.iter_statement_rows(current_account_id())]}
+    return conditional_json([versions.user_entity(current_user.id)], load)
+
+
+# Route to get the current user's live coupons, with the code only shown once a coupon has been redeemed, as on the dashboard.
+# Coupons are expired by the sweep, which bumps the student's stamp, so a client may see an expired coupon for up to one sweep interval
+@api.route('/coupons')
+def coupons():
+    def load():
+        return {'coupons': [
+            {'id': coupon.id, 'name': coupon.name, 'description': coupon.description, 'points_cost': coupon.points_cost,
+             'status': coupon.status, 'redeemed': coupon.redeemed, 'code': coupon.code if coupon.redeemed else None,
+             'redeem_date': coupon.redeem_date.isoformat() if coupon.redeem_date else None,
+             'expires_at': coupon.expires_at.isoformat() if coupon.expires_at else None}
+            for coupon in coupon_service.live_coupons(current_user.id)
+        ]}
+    return conditional_json([versions.user_entity(current_user.id)], load)
+
+
+# Route for staff to check a code a student shows them, found through the code's unique index. Only a redeemed coupon
+# that has not expired is valid, and the answer is never cached as it changes with time rather than with a write
+@api.route('/coupons/verify/<string:code>')
+def verify_coupon(code):
+    if not (current_user.is_admin() or current_user.is_teacher()):
+        abort(403)
+    coupon = coupon_service.verify_code(code.strip().upper())
+    if coupon is None:
+        response = jsonify({'valid': False})
+    else:
+        response = jsonify({
+            'valid': True, 'coupon_id': coupon.id, 'name': coupon.name, 'student_id': coupon.student_id,
+            'student_name': f"{coupon.first_name or ''} {coupon.last_name or ''}".strip(),
+            'redeem_date': coupon.redeem_date.isoformat(), 'expires_at': coupon.expires_at.isoformat(),
+        })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+
+# Route to get join requests. Teachers get the requests for their classes, optionally filtered by ?status=pending,
+# students get the status of their own requests keyed by class id
+@api.route('/join_requests')
+def join_requests():
+    if current_user.is_teacher():
+        status = request.args.get('status')
+
+        def load():
+            return {'join_requests': [
+                {'id': join_request.id, 'status': join_request.status, 'class_id': join_request.class_id, 'class_name': join_request.class_.name,
+                 'student_id': join_request.student_id, 'student_name': f'{join_request.student.first_name} {join_request.student.last_name}'}
+                for join_request in catalogue.teacher_join_requests(current_user.id, [status] if status else None)
+            ]}
+        return conditional_json([versions.user_entity(current_user.id)], load, status)
+
+    if current_user.is_student():
+        def load():
+            return {'join_statuses': {str(class_id): status for class_id, status in catalogue.join_statuses(current_user.id).items()}}
+        return conditional_json([versions.user_entity(current_user.id)], load)
+
+    abort(403)
+
+
+# Route to get this week's points quota. Teachers get their own, admins get the report for every teacher
+@api.route('/quota')
+def teacher_quota():
+    # A new week starts a new quota without any write, so the week is part of the tag
+    week = quota.week_key()
+    if current_user.is_admin():
+        def load():
+            return {'week': list(week), 'quotas': [quota_to_dict(row) for row in quota.quota_report()]}
+        # Every award adds a ledger row, so the high-water mark moves whenever a teacher's points awarded do
+        return conditional_json([versions.LEDGER, versions.TEACHERS], load, week, ledger.high_water_mark())
+
+    if current_user.is_teacher():
+        def load():
+            return {'week': list(week), 'quota': quota_to_dict(quota.teacher_quota(current_user.id))}
+        return conditional_json([versions.user_entity(current_user.id)], load, week)
+
+    abort(403)
+
+
+# Function to convert a quota report row into a dictionary
+def quota_to_dict(row):
+    return {
+        'teacher_id': row.teacher_id,
+        'email': row.email,
+        'first_name': row.first_name,
+        'last_name': row.last_name,
+        'point_limit': row.point_limit,
+        'points_awarded': row.points_awarded,
+        'remaining_points': row.remaining_points,
+    }
@@ -1,14 +1,27 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, Response, stream_with_context, abort
 from flask_login import login_user, current_user, logout_user, login_required
 from werkzeug.security import check_password_hash, generate_password_hash
 from .models import User, Role, Transactions, TeacherRequestHistory, Account, Class, Subject, JoinRequest, Coupon
 from . import db
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, selectinload
 from datetime import datetime
-from sqlalchemy import and_
+import csv
+import io
+import logging
+from . import ledger, quota, catalogue, statements, rollups, versions, identity, history, coupons
+from .roles import roles
+from .cache import cache
+from .instrumentation import instrumentation
+from .naming import allocate_username, allocate_class_name, class_name_prefix
+from .posting import post_award, post_bulk_award, post_purchase, PostingError
+from .roster import import_roster
+from .passwords import password_strength
 
 auth = Blueprint('auth', __name__) #defines auth blueprint to create url
 
+logger = logging.getLogger(__name__)
+
 #//login and sign-up-------------------------------------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -24,14 +37,14 @@ def login():
         if user:
             # Check if the entered password matches the stored hashed password
             if check_password_hash(user.password, password):
-                role = user.role
+                role_name = roles.name(user.role_id)
                 # If user is an admin
-                if role.name == "admin":
+                if role_name == "admin":
                     flash('Logged in as admin successfully!', category='success')
                     login_user(user, remember=True)
                     return redirect(url_for('auth.admin_page'))
                 # If user is a teacher
-                elif role.name == "teacher":
+                elif role_name == "teacher":
                     # If teacher's role is not yet approved
                     if not user.role_approved:
                         flash('Teacher role not approved yet.', category='error')
@@ -41,7 +54,7 @@ def login():
                         login_user(user, remember=True)
                         return redirect(url_for('auth.award_points'))
                 # If user is a student
-                elif role.name == "student":
+                elif role_name == "student":
                     flash('Logged in as student successfully!', category='success')
                     login_user(user, remember=True)
                     return redirect(url_for('auth.student', student_id=user.id))
@@ -53,42 +66,10 @@ def login():
     # Render the login page template
     return render_template('login.html', user=current_user)
 
-# Function to calculate password strength
-def password_strength(password):
-    score = 0
-    if len(password) >= 8:
-        score += 1
-    if any(char.isdigit() for char in password):
-        score += 1
-    if any(char.isupper() for char in password):
-        score += 1
-    if any(char in set(r"!@#$%^&*()/") for char in password):
-        score += 1
-    if score >= 4:
-        return score, "Password is strong."
-    else:
-        missing_requirements = []
-        if len(password) < 8:
-            missing_requirements.append("Password must be at least 8 characters.")
-        if not any(char.isdigit() for char in password):
-            missing_requirements.append("Password must contain at least one digit.")
-        if not any(char.isupper() for char in password):
-            missing_requirements.append("Password must contain at least one uppercase letter.")
-        if not any(char in set(r"!@#$%^&*()/") for char in password):
-            missing_requirements.append("Password must contain at least one symbol (!@#$%^&*()/).")
-        return score, ", ".join(missing_requirements)
-
 # Function to generate a unique username
 def generate_username(first_name, last_name):
-    base_username = first_name[:3].lower() + last_name[:3].lower()
-    username = base_username
-    counter = 1
-
-    while User.query.filter_by(user_name=username).first() is not None:
-        username = base_username + str(counter)
-        counter += 1
-
-    return username
+    # Reserve the next free suffix for the name's prefix, which takes a fixed number of queries however many names are taken
+    return allocate_username(first_name, last_name)
 
 # Define a function to check if a string contains any digit
 def contains_digit(s):
@@ -125,9 +106,9 @@ def sign_up():
             if score < 4:
                 flash(message, category='error')
             else:
-                # Retrieve the role object with the given name from the database
-                role = Role.query.filter_by(name=role).first()
-                if role is None:
+                # Look up the id of the role with the given name in the role registry
+                role_id = roles.id(role)
+                if role_id is None:
                     flash('Invalid role selected', category='error')
                     return redirect(url_for('auth.sign_up'))
 
@@ -136,19 +117,25 @@ def sign_up():
 
                 # Check if the user has requested a teacher role
                 role_request = request.form.get('role') == 'teacher'
-                print(role_request)
 
                 # Create a new user object with the given information
-                new_user = User(email=email, first_name=first_name, last_name=last_name, user_name=user_name, password=generate_password_hash(password1, method='sha256'), role=role, role_request=role_request, role_requested_on=datetime.now())
+                new_user = User(email=email, first_name=first_name, last_name=last_name, user_name=user_name, password=generate_password_hash(password1, method='sha256'), role_id=role_id, role_request=role_request, role_requested_on=datetime.now())
 
                 try:
-                    # Add the new user object to the database
+                    # Add the new user object to the database, flushed to get its id for the history job
                     db.session.add(new_user)
-                    db.session.commit()
+                    db.session.flush()
 
                     # Create a new account for the user
                     account = Account(user=new_user, balance=0)
                     db.session.add(account)
+                    # The admin quota report lists every teacher
+                    if role_id == roles.id('teacher'):
+                        versions.bump(versions.TEACHERS)
+                    # If the user has requested a teacher role, queue a history entry with the status set to 'Pending'
+                    if role_request:
+                        history.record_teacher_request(new_user.id, 'Pending')
+                    # Commit the user, their account and the history job together
                     db.session.commit()
 
                 except IntegrityError:
@@ -157,11 +144,12 @@ def sign_up():
                     flash('Email address already exists', category='error')
                     return redirect(url_for('auth.sign_up'))
 
+                # The teacher and student lists shown on other pages now include the new user, and SQLite can reuse the id of a
+                # deleted user, so drop any identity cached under it
+                cache.invalidate('teachers', 'students')
+                identity.invalidate(new_user.id)
+
                 if role_request:
-                    # If the user has requested a teacher role, create a new TeacherRequestHistory object with the user_id and status set to 'Pending'
-                    teacher_request = TeacherRequestHistory(user_id=new_user.id, status='Pending')
-                    db.session.add(teacher_request)
-                    db.session.commit()
                     flash('Teacher role request sent. Please wait for approval.', category='success')
                     return redirect(url_for('auth.sign_up'))  # Redirect to sign-up page
                 else:
@@ -169,8 +157,7 @@ def sign_up():
                     login_user(new_user)
                     return redirect(url_for('views.home'))
 
-    roles = Role.query.all()
-    return render_template('sign_up.html', user=current_user, roles=roles)
+    return render_template('sign_up.html', user=current_user)
 
 
 @auth.route('/logout')
@@ -188,15 +175,91 @@ def logout():
 
 # Route for the admin page
 @auth.route('/admin')
+@login_required
 def admin_page():
-    # Get all transactions
-    transactions = db.session.query(Transactions).all()
+    # Only admins can see the ledger, teacher requests and quotas
+    if not current_user.is_admin():
+        abort(403)
+
+    # Get the ledger filters and the cursor for the requested page
+    filters = ledger.parse_filters(request.args)
+    cursor = ledger.decode_cursor(request.args.get('cursor'))
+
+    # Get one page of transactions, newest first, and the cursor for the next page
+    transactions, next_cursor = ledger.ledger_page(filters, cursor)
 
     # Get all pending teacher requests
-    teacher_requests = User.query.filter(User.role.has(name='teacher'), User.role_request==True).all()
+    teacher_requests = User.query.filter(User.role_id == roles.id('teacher'), User.role_request==True).all()
+
+    # Get this week's points quota for every teacher in one query
+    quotas = quota.quota_report()
+
+    # Render the admin page and pass in the transactions, paging cursor, filters, teacher_requests and quotas
+    return render_template('admin.html', user=current_user, transactions=transactions, next_cursor=next_cursor, filters=request.args, teacher_requests=teacher_requests, quotas=quotas)
+
+
+# Route to export the filtered transaction ledger as CSV or JSON lines
+@auth.route('/admin/transactions/export')
+@login_required
+def export_transactions():
+    # Only admins can export the ledger
+    if not current_user.is_admin():
+        abort(403)
+
+    # Get the export format and the ledger filters
+    export_format = request.args.get('format', 'csv')
+    filters = ledger.parse_filters(request.args)
+
+    # Stream the rows in chunks instead of building the whole export in memory
+    if export_format == 'csv':
+        return Response(stream_with_context(ledger.export_csv(filters)), mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename=transactions.csv'})
+    elif export_format == 'jsonl':
+        return Response(stream_with_context(ledger.export_jsonl(filters)), mimetype='application/x-ndjson', headers={'Content-Disposition': 'attachment; filename=transactions.jsonl'})
+    else:
+        abort(400)
 
-    # Render the admin page and pass in the transactions and teacher_requests
-    return render_template('admin.html', user=current_user, transactions=transactions, teacher_requests=teacher_requests)
+
+# Route for admins to import a CSV roster of students and teachers
+@auth.route('/admin/import_roster', methods=['GET', 'POST'])
+@login_required
+def import_roster_page():
+    # Only admins can import users
+    if not current_user.is_admin():
+        abort(403)
+
+    result = None
+    if request.method == 'POST':
+        roster = request.files.get('roster')
+        if not roster or not roster.filename:
+            flash('Please choose a roster file to upload.', category='error')
+            return redirect(url_for('auth.import_roster_page'))
+        # Read the uploaded file as text, skipping the byte order mark spreadsheet programs add
+        result = import_roster(csv.DictReader(io.TextIOWrapper(roster.stream, encoding='utf-8-sig')))
+        flash(f'Imported {result.imported} users in {result.seconds:.1f}s ({result.rows_per_second:.0f} rows/s).', category='success')
+        if result.errors:
+            flash(f'{len(result.errors)} problems were found, the rows with problems were not imported.', category='error')
+
+    return render_template('import_roster.html', user=current_user, result=result)
+
+
+# Route to report the lookup cache's hits and misses per namespace in this process
+@auth.route('/admin/cache_stats')
+@login_required
+def cache_stats():
+    # Only admins can see the cache statistics
+    if not current_user.is_admin():
+        abort(403)
+    return jsonify(cache.stats())
+
+
+# Route to list the likely N+1 query patterns each route has shown in this process, see instrumentation.py
+@auth.route('/admin/sql_stats')
+@login_required
+def sql_stats():
+    # Only admins can see the query statistics
+    if not current_user.is_admin():
+        abort(403)
+    return jsonify(instrumentation.report())
 
 
 # Route to update a teacher request
@@ -209,14 +272,14 @@ def update_teacher_request():
     user = User.query.get(user_id)
 
     # Check if the user is valid and has a pending teacher role request
-    if user is None or not user.role_request or user.role.name != 'teacher':
+    if user is None or not user.role_request or not user.is_teacher():
         flash('Invalid request.', 'error')
         return redirect(url_for('auth.admin_page'))
 
     # Check if the current user is an admin
     if not current_user.is_admin():
         flash('You are not authorized to approve or reject teacher requests.', 'error')
-        return redirect(url_for('auth.admin_page'))
+        return redirect(url_for('views.home'))
 
     # Get the action (approve/reject) from the form
     action = request.form['action']
@@ -224,32 +287,25 @@ def update_teacher_request():
         # Set the role_approved flag to True and role_request flag to False
         user.role_approved = True
         user.role_request = False
-        # Commit the changes to the database
-        db.session.commit()
-        flash(f'Teacher role request for {user.email} has been approved.', 'success')
         status = 'accepted'
     elif action == 'reject':
         # Set the role_rejected flag to True and role_request flag to False
         user.role_rejected = True
         user.role_request = False
-        # Commit the changes to the database
-        db.session.commit()
-        flash(f'Teacher role request for {user.email} has been rejected.', 'success')
         status = 'rejected'
+    else:
+        flash('Invalid request.', 'error')
+        return redirect(url_for('auth.admin_page'))
 
-    # Get the date_requested from the user object
-    date_requested = user.role_requested_on
+    # Queue the history entry for the teacher request, current_user is a cached identity rather than a User row, so link the admin by id
+    history.record_teacher_request(user.id, status, resolved_by_id=current_user.id, resolved_at=datetime.utcnow())
 
-    # Create a new history entry for the teacher request
-    history_entry = TeacherRequestHistory(
-        user=user,
-        status=status,
-        date_resolved=datetime.utcnow(),
-        resolved_by=current_user
-    )
-    # Add the history entry to the database and commit the changes
-    db.session.add(history_entry)
+    # Commit the decision and the history job together
     db.session.commit()
+    flash(f'Teacher role request for {user.email} has been {"approved" if status == "accepted" else "rejected"}.', 'success')
+
+    # The user's cached identity no longer matches their row
+    identity.invalidate(user.id)
     
     # Redirect to the admin page
     return redirect(url_for('auth.admin_page'))
@@ -259,8 +315,14 @@ def update_teacher_request():
 @auth.route('/teacher_requests_history')
 @login_required
 def view_teacher_requests():
-    # Query the teacher request history entries and order them by the date requested
-    requests = TeacherRequestHistory.query.join(User, TeacherRequestHistory.user_id == User.id).order_by(User.role_requested_on).all()
+    # Query the teacher request history entries and order them by the date requested, loading the requesting user from the
+    # join and every resolving user with one more query, so the page costs the same number of queries however long the history is
+    requests = (
+        TeacherRequestHistory.query.join(User, TeacherRequestHistory.user_id == User.id)
+        .options(contains_eager(TeacherRequestHistory.user), selectinload(TeacherRequestHistory.resolved_by))
+        .order_by(User.role_requested_on, TeacherRequestHistory.id)
+        .all()
+    )
     # Render the teacher requests history page and pass in the requests and the current user
     return render_template('teacher_requests_history.html', requests=requests, user=current_user)
 
@@ -274,11 +336,12 @@ def view_teacher_requests():
 @auth.route('/teacher')
 @login_required
 def teacher():
-    # Query join requests and classes from database
-    join_requests = JoinRequest.query.join(User).filter(User.id == 3).all()
-    classes = Class.query.all()
+    # Query the current teacher's classes, the number of pending join requests for each, and the pending requests themselves
+    classes = catalogue.class_catalogue(teacher_id=current_user.id)
+    pending_counts = catalogue.pending_request_counts(current_user.id)
+    join_requests = catalogue.teacher_join_requests(current_user.id, ['pending'])
     # Render the teacher.html template and pass the queried data to it as arguments
-    return render_template('teacher_dashboard.html', user=current_user, join_requests=join_requests, classes=classes)
+    return render_template('teacher_dashboard.html', user=current_user, join_requests=join_requests, classes=classes, pending_counts=pending_counts)
 
 # Define a route for join request
 @auth.route('/join_request')
@@ -287,13 +350,13 @@ def join_request():
     # Get the value of filter query parameter, default to 'all'
     filter = request.args.get('filter', 'all')
 
-    # Based on the value of filter, query join requests from database
+    # Based on the value of filter, query the join requests for the current teacher's classes
     if filter == 'pending':
-        join_requests = JoinRequest.query.join(User).filter(User.id == 3, JoinRequest.status == 'pending').all()
+        join_requests = catalogue.teacher_join_requests(current_user.id, ['pending'])
     elif filter == 'accepted_rejected':
-        join_requests = JoinRequest.query.join(User).filter(User.id == 3, (JoinRequest.status == 'accepted') | (JoinRequest.status == 'rejected')).all()
+        join_requests = catalogue.teacher_join_requests(current_user.id, ['accepted', 'rejected'])
     else:  # Default: Show all requests
-        join_requests = JoinRequest.query.join(User).filter(User.id == 3).all()
+        join_requests = catalogue.teacher_join_requests(current_user.id)
 
     # Render the join_request.html template and pass the queried data and filter value to it as arguments
     return render_template('join_request.html', user=current_user, join_requests=join_requests, filter=filter)
@@ -322,6 +385,7 @@ def respond_join_request(join_request_id, action):
     else:
         flash('Invalid action!', category='error')
         return redirect(url_for('auth.join_request'))
+    versions.bump(versions.user_entity(join_request.student_id), versions.user_entity(current_user.id))
 
     # Commit the changes to the database
     db.session.commit()
@@ -337,83 +401,50 @@ def award_points():
     
     # Check if the user is an admin or a teacher
     if current_user.is_admin() or current_user.is_teacher():
-        
-        # Query the database for the year groups
-        year_groups = db.session.query(Class.year_group).distinct().all()
-        
-        # Query the database for the classes that the current user is teaching
-        classes = Class.query.filter_by(teacher=current_user).all()
-        
-        # Query the database for all students
-        students = User.query.filter_by(role_id=3).all()
 
         # Check if the user has submitted a form
         if request.method == 'POST':
             
-            # Retrieve form data
-            year_group = request.form['year_group']
-            class_id = request.form['class_id']
-            student_id = request.form['student_id']
+            # Retrieve form data, the year group, class and student are only needed for the chosen award mode
+            award_to = request.form.get('award_to', 'student')
+            year_group = request.form.get('year_group', type=int)
+            class_id = request.form.get('class_id', type=int)
+            student_id = request.form.get('student_id', type=int)
             points = int(request.form['amount'])
 
-            # Check if the user has enough points to award
-            if current_user.remaining_points < points:
-                flash('You do not have enough points to award.', 'danger')
+            # Apply the balance, quota and ledger changes together in one transaction
+            try:
+                if award_to == 'class':
+                    awarded = post_bulk_award(current_user, points, class_id=class_id)
+                elif award_to == 'year_group':
+                    awarded = post_bulk_award(current_user, points, year_group=year_group)
+                else:
+                    post_award(current_user, student_id, points, class_id=class_id)
+                    awarded = 1
+            except PostingError as error:
+                flash(str(error), 'danger')
                 return redirect(url_for('auth.award_points'))
 
-            # Check if the user has exceeded their weekly point limit
-            if current_user.points_awarded_this_week >= current_user.weekly_point_limit:
-                flash('You have exceeded your weekly point limit.', 'danger')
-                return redirect(url_for('auth.award_points'))
+            # The teacher's cached identity carries their quota settings, so reload it after an award
+            identity.invalidate(current_user.id)
 
-            # Retrieve the student from the database
-            student = User.query.filter_by(id=student_id, role_id=3).first()
-
-            # Check if the student exists
-            if student:
-                
-                # Retrieve the student's account from the database
-                student_account = Account.query.filter_by(user_id=student.id).first()
-                
-                if student_account:
-                    
-                    # Update the student's account balance
-                    student_account.balance += points
-                    db.session.commit()
-
-                    # Update the teacher's account points_awarded, points_awarded_this_week, and last_award_date fields
-                    teacher_account = Account.query.filter_by(user_id=current_user.id).first()
-                    teacher_account.points_awarded += points
-                    current_user.points_awarded_this_week += points
-                    current_user.last_award_date = datetime.utcnow().date()  # Update last_award_date
-                    db.session.commit()
-
-                    # Add a new transaction to the Transactions table in the database
-                    transaction = Transactions(
-                        sequence=1,
-                        from_account_id=current_user.id,
-                        dateTime=datetime.utcnow(),
-                        to_account_id=student.id,
-                        amount=points
-                    )
-                    db.session.add(transaction)
-                    db.session.commit()
-
-                    # Display a success message and redirect the user to the 'award_points' page
-                    flash('Transaction successful!', 'success')
-                    return redirect(url_for('auth.award_points'))
-                
-                else:
-                    flash('Invalid student ID', 'danger')
+            # Display a success message and redirect the user to the 'award_points' page
+            if awarded > 1:
+                flash(f'Transaction successful! {points} points awarded to {awarded} students.', 'success')
             else:
-                flash('Invalid student name or class name', 'danger')
+                flash('Transaction successful!', 'success')
+            return redirect(url_for('auth.award_points'))
+
+        # Get the year groups, the classes that the current user is teaching and all students from the lookup cache
+        year_groups = catalogue.year_group_options()
+        classes = catalogue.class_catalogue(teacher_id=current_user.id)
+        students = catalogue.student_options()
 
-        # Retrieve the remaining points and remaining point percentage for the current user
-        remaining_points = current_user.remaining_points
-        remaining_point_percentage = current_user.remaining_point_percentage
+        # Retrieve this week's limit, points awarded and points remaining for the current user, computed in one query
+        teacher_quota = quota.teacher_quota(current_user.id)
 
-        # Render the 'award_points.html' template with the year groups, classes, students, user, remaining_points, and remaining_point_percentage variables
-        return render_template('award_points.html', year_groups=year_groups, classes=classes, students=students, user=current_user, remaining_points=remaining_points, remaining_point_percentage=remaining_point_percentage)
+        # Render the 'award_points.html' template with the year groups, classes, students, user and quota variables
+        return render_template('award_points.html', year_groups=year_groups, classes=classes, students=students, user=current_user, quota=teacher_quota)
     else:
         return "You are not authorized to access this page."
 
@@ -425,13 +456,13 @@ def award_points():
 @login_required
 def create_class():
     # Check if the current user has the role of 'teacher'
-    if current_user.role.name != 'teacher':
+    if not current_user.is_teacher():
         # If not, display an error message and redirect to the home page
         flash('You must be a teacher to create a class', category='error')
         return redirect(url_for('views.home'))
 
-    # Get a list of all the subjects
-    subjects = Subject.query.all()
+    # Get a list of all the subjects from the lookup cache
+    subjects = catalogue.subject_options()
 
     # Check if the request method is POST
     if request.method == 'POST':
@@ -451,21 +482,19 @@ def create_class():
             subject = Subject.query.get(subject_id)
 
             # Create a base class name using the year group, subject name, and teacher's initials
-            base_class_name = f"{year_group}{subject.name[0]}{current_user.first_name[0]}{current_user.last_name[0]}"
-            class_name = base_class_name
-            counter = 1
+            base_class_name = class_name_prefix(year_group, subject.name, current_user.first_name, current_user.last_name)
 
-            # Check if a class with the same name already exists
-            while Class.query.filter_by(name=class_name).first() is not None:
-                # If a class with the same name exists, append a counter to the name and check again
-                class_name = base_class_name + str(counter)
-                counter += 1
+            # Reserve the next free suffix for the base name, which takes a fixed number of queries however many classes share it
+            class_name = allocate_class_name(base_class_name)
 
             # Create a new class with the generated name, subject ID, year group, and teacher ID
             new_class = Class(name=class_name, subject_id=subject_id, year_group=year_group, teacher_id=current_user.id)
             db.session.add(new_class)
             db.session.commit()
 
+            # The class lists and year groups shown on other pages now include the new class
+            cache.invalidate('classes', 'year_groups')
+
             # Display a success message
             flash('Class created successfully', category='success')
         else:
@@ -487,7 +516,7 @@ def create_class():
 @login_required
 def student(student_id):
     # Get the student object by the current user's id and role
-    student = User.query.filter_by(id=current_user.id, role_id=3).first()
+    student = User.query.filter_by(id=current_user.id, role_id=roles.id('student')).first()
 
     # If the current user is a student
     if student:
@@ -496,31 +525,16 @@ def student(student_id):
         search_subject_id = request.args.get('subject_id', type=int)
         search_teacher_id = request.args.get('teacher_id', type=int)  # New filter
         
-        # Create an empty list for search filters
-        search_filters = []
-
-        # Add search filters based on request arguments
-        if search_year_group:
-            search_filters.append(Class.year_group == search_year_group)
-        if search_subject_id:
-            search_filters.append(Class.subject_id == search_subject_id)
-        if search_teacher_id:  # Add the filter for teacher_id
-            search_filters.append(Class.teacher_id == search_teacher_id)
-        
-        # If there are search filters, filter the classes using AND operator
-        if search_filters:
-            classes = Class.query.filter(and_(*search_filters)).all()
-        # Else fetch all classes
-        else:
-            classes = Class.query.all()
-        
-        # Fetch all subjects, teachers and join requests for the student
-        subjects = Subject.query.all()
-        teachers = User.query.filter_by(role_id=2).all()
-        join_requests = JoinRequest.query.filter_by(student_id=student_id).all()
+        # Fetch the matching classes with their subject and teacher names in one query
+        classes = catalogue.class_catalogue(search_year_group, search_subject_id, search_teacher_id)
+
+        # Fetch the subjects and teachers for the search form, and the status of the student's join requests by class
+        subjects = catalogue.subject_options()
+        teachers = catalogue.teacher_options()
+        join_statuses = catalogue.join_statuses(student.id)
         
         # Render the student.html template with the required data
-        return render_template('student.html', student=student, classes=classes, user=current_user, search_year_group=search_year_group, search_subject_id=search_subject_id, search_teacher_id=search_teacher_id, subjects=subjects, teachers=teachers)
+        return render_template('student.html', student=student, classes=classes, join_statuses=join_statuses, user=current_user, search_year_group=search_year_group, search_subject_id=search_subject_id, search_teacher_id=search_teacher_id, subjects=subjects, teachers=teachers)
 
     # If the current user is not a student
     else:
@@ -544,8 +558,10 @@ def request_join_class(student_id, class_id):
     # Create a new join request object
     join_request = JoinRequest(student_id=student_id, class_id=class_id, status='pending')
 
-    # Add the join request to the database and commit changes
+    # Add the join request to the database and commit changes, with the request lists of the student and the class's teacher
     db.session.add(join_request)
+    teacher_id = db.session.query(Class.teacher_id).filter_by(id=class_id).scalar()
+    versions.bump(versions.user_entity(student_id), versions.user_entity(teacher_id))
     db.session.commit()
 
     # Flash a message and redirect to the student page
@@ -559,7 +575,7 @@ def request_join_class(student_id, class_id):
 @login_required  # Only allow authenticated users to access this route
 def student_rewards():
     # Retrieve the current user's information
-    student = User.query.filter_by(id=current_user.id, role_id=3).first()
+    student = User.query.filter_by(id=current_user.id, role_id=roles.id('student')).first()
     
     # If the user is a student, display the available items and process the purchase if the form is submitted
     if student:
@@ -574,34 +590,22 @@ def student_rewards():
         if request.method == 'POST':
             item_index = int(request.form.get('item_index'))
             item = available_items[item_index]
-            student_account = student.account  # Retrieve the student's account information
-            
-            # Check if the student has enough points to purchase the item
-            if student_account.balance >= item['points']:
-                # Deduct points from the student's account
-                student_account.balance -= item['points']
-                db.session.commit()
-
-                # Generate a unique coupon code and create a coupon object to add to the database
-                coupon_code = None  # TODO: Generate unique 8-digit code
-                coupon = Coupon(student_id=student.id, name=item['name'], description=item['description'], points_cost=item['points'], code=coupon_code, redeemed=False, redeem_date=None)
-                db.session.add(coupon)
-                db.session.commit()
-                
-                # Create a transaction object to track the purchase in the database
-                transaction = Transactions(sequence=1, from_account_id=student_account.id, dateTime=datetime.utcnow(), to_account_id=None, amount=-item['points'], account_id=student_account.id, code=coupon_code)
-                db.session.add(transaction)
-                db.session.commit()
-                
+
+            # Debit the points, issue the coupon and record the purchase in the ledger in one transaction
+            try:
+                post_purchase(student, item['name'], item['description'], item['points'])
                 # Display a success message to the user
                 flash('Coupon purchased successfully!', 'success')
-            
             # If the student does not have enough points, display an error message
-            else:
-                flash('You do not have enough points to purchase this item', 'error')
+            except PostingError as error:
+                flash(str(error), 'error')
         
+        # Show the balance worked out from the ledger, as the dashboard does. Account.balance is only the guard that
+        # post_purchase debits atomically, so the two pages can never show students different balances
+        balance = ledger.current_balance(student.account_id) if student.account_id else 0
+
         # Render the template with the available items and the student's information
-        return render_template('student_rewards.html', available_items=available_items, student=student, user=current_user)
+        return render_template('student_rewards.html', available_items=available_items, student=student, balance=balance, user=current_user)
     
     # If the user is not a student, display an error message and redirect to the home page
     else:
@@ -612,14 +616,62 @@ def student_rewards():
 @auth.route('/dashboard')
 @login_required  # Only allow authenticated users to access this route
 def dashboard():
-    # Retrieve the current user's information and account details
-    user = current_user
-    account = user.account
-    balance = account.balance
-    transactions = account.transactions
-    
-    # Render the template with the account balance and transaction history
-    return render_template('student_dashboard.html', balance=balance, transactions=transactions, user=current_user)
+    # The current user's account id is part of their cached identity, so the account row itself is not needed
+    account_id = current_user.account_id
+    if account_id is None:
+        flash('You do not have an account yet.', category='error')
+        return redirect(url_for('views.home'))
+    # Work out the balance from the ledger, starting from the latest balance snapshot
+    balance = ledger.current_balance(account_id)
+    # Load the transaction history with the coupon names joined in, instead of loading each coupon separately
+    transactions = statements.statement_rows(account_id)
+    # Load only the live coupons, through the (student_id, status) index, instead of every coupon the student has had
+    live_coupons = coupons.live_coupons(current_user.id)
+
+    # Render the template with the account balance, transaction history and coupons
+    return render_template('student_dashboard.html', balance=balance, transactions=transactions, coupons=live_coupons, user=current_user)
+
+
+# Route to download statements as CSV, JSON lines or printable HTML. Admins can export one account or every account,
+# everyone else gets the statement of their own account
+@auth.route('/statements')
+@login_required
+def export_statements():
+    export_format = request.args.get('format', 'csv')
+    if export_format not in statements.EXPORT_FORMATS:
+        abort(400)
+    export, mimetype, extension = statements.EXPORT_FORMATS[export_format]
+
+    if current_user.is_admin():
+        account_id = request.args.get('account_id', type=int)
+    else:
+        account_id = db.session.query(Account.id).filter_by(user_id=current_user.id).scalar()
+        if account_id is None:
+            abort(404)
+
+    # Stream the statements row by row instead of building them in memory
+    filename = f"statement-{account_id if account_id is not None else 'all'}.{extension}"
+    return Response(stream_with_context(export(account_id)), mimetype=mimetype, headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+# Route for the leaderboards of students, classes and year groups, read from the points rollups
+@auth.route('/leaderboard')
+@login_required
+def leaderboard():
+    # Get each leaderboard with one indexed top-k query, the ledger is never scanned
+    boards = {scope: top(rollups.LEADERBOARD_SIZE) for scope, top in rollups.LEADERBOARDS.items()}
+    return render_template('leaderboard.html', user=current_user, boards=boards)
+
+
+# Route to get one leaderboard as JSON for charts, e.g. /leaderboard/data?scope=classes&limit=20
+@auth.route('/leaderboard/data')
+@login_required
+def leaderboard_data():
+    scope = request.args.get('scope', 'students')
+    if scope not in rollups.LEADERBOARDS:
+        abort(400)
+    limit = request.args.get('limit', rollups.LEADERBOARD_SIZE, type=int)
+    return jsonify({'scope': scope, 'entries': rollups.LEADERBOARDS[scope](limit)})
 
 
 # Create a new route for redeeming a coupon, which is accessed via a POST request
@@ -631,34 +683,34 @@ def redeem_coupon():
     # Retrieve the coupon_id from the POST request's form data
     coupon_id = request.form.get('coupon_id')
 
-    # Print a message indicating that a redeem_coupon request has been received for the given coupon ID
-    print("Received redeem_coupon request for coupon ID:", coupon_id)
-
     # Get the Coupon object with the given ID from the database
     coupon = Coupon.query.get(coupon_id)
 
     # Check if the coupon exists and has not been redeemed yet
-    if coupon and not coupon.redeemed:
-        # Generate a code for the coupon and mark it as redeemed
-        coupon.code = coupon.generate_code()
+    if coupon and coupon.status == 'active':
+        # Mark the coupon as redeemed, the code it was issued with at purchase is revealed to the student
+        if not coupon.code:
+            coupon.code = coupon.generate_code()
+            if coupon.code is None:
+                db.session.rollback()
+                coupons.schedule_fill()
+                logger.warning('coupon %s could not be redeemed as the code pool is empty', coupon_id)
+                return jsonify({'message': 'Coupons cannot be redeemed right now, please try again in a few minutes', 'success': False})
         coupon.redeem()
 
-        # Find the transaction record associated with the coupon and update its redeem date
-        transaction = Transactions.query.filter_by(coupon_id=coupon_id).first()
-        if transaction:
-            transaction.date_redeemed = datetime.utcnow()
+        # Queue copying the redeem date onto the coupon's transaction record, which the worker does off the request path
+        coupons.record_redemption(coupon.id, coupon.student_id, coupon.redeem_date)
+        versions.bump_ledger(coupon.student_id)
 
-        # Commit the changes to the database
+        # Commit the redemption and the job together
         db.session.commit()
+        logger.info('coupon %s redeemed by student %s', coupon.id, coupon.student_id)
 
-        # Print a message indicating that the coupon has been updated with a new code and redeem date
-        print("Coupon updated with code and redeem date:", coupon.code)
-
-        # Return a JSON response with the new coupon code and a success flag
-        return jsonify({'code': coupon.code, 'success': True})
+        # Return a JSON response with the new coupon code, when it expires and a success flag
+        return jsonify({'code': coupon.code, 'expires_at': coupon.expires_at.strftime('%Y-%m-%d %H:%M'), 'success': True})
     else:
         # If the coupon does not exist or has already been redeemed, return a JSON response with an error message and a failure flag
-        print("Failed to redeem coupon")
+        logger.info('coupon %s could not be redeemed', coupon_id)
         return jsonify({'message': 'Failed to redeem coupon', 'success': False})
 
 
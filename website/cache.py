@@ -0,0 +1,153 @@
+from collections import OrderedDict, Counter
+import pickle
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Read-through cache for lookup lists that change a few times a term, such as subjects, teachers and the class catalogue.
+# Entries are grouped into namespaces. Each namespace has a generation number that is part of every key, so invalidating
+# a namespace only bumps its generation and the old entries are never read again. They expire or are evicted later.
+
+
+# Backend that keeps entries in this process, evicting the least recently used entry once it holds max_entries
+class MemoryBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = Counter()
+        self.lock = threading.Lock()
+
+    # Get the value stored under key, returning (found, value)
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    # Store a value under key for ttl seconds
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Get the current generation of a namespace
+    def generation(self, namespace):
+        with self.lock:
+            return self.generations[namespace]
+
+    # Move a namespace on to its next generation
+    def bump(self, namespace):
+        with self.lock:
+            self.generations[namespace] += 1
+
+
+# Backend that shares entries and generations between processes through Redis, which evicts by TTL and its own LRU policy
+class RedisBackend:
+    def __init__(self, url, prefix='website:cache:'):
+        if redis is None:
+            raise RuntimeError('CACHE_BACKEND is redis but the redis package is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + repr(key))
+        if value is None:
+            return False, None
+        return True, pickle.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + repr(key), pickle.dumps(value), ex=max(int(ttl), 1))
+
+    def generation(self, namespace):
+        return int(self.client.get(self.prefix + 'generation:' + namespace) or 0)
+
+    def bump(self, namespace):
+        self.client.incr(self.prefix + 'generation:' + namespace)
+
+
+# Backend that stores nothing, so every lookup goes to the database
+class NullBackend:
+    def get(self, key):
+        return False, None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def generation(self, namespace):
+        return 0
+
+    def bump(self, namespace):
+        pass
+
+
+# A cache used by the application, with hit and miss counters per namespace. Its settings are read with the given prefix,
+# falling back to the CACHE_ settings, so a second cache such as the identity cache can be sized separately
+class Cache:
+    def __init__(self, prefix='CACHE_', redis_prefix='website:cache:'):
+        self.prefix = prefix
+        self.redis_prefix = redis_prefix
+        self.backend = MemoryBackend()
+        self.default_ttl = 300
+        self.hits = Counter()
+        self.misses = Counter()
+
+    # Get one of this cache's settings
+    def setting(self, app, name, default=None):
+        return app.config.get(self.prefix + name, app.config.get('CACHE_' + name, default))
+
+    # Choose the backend from the application's configuration
+    def init_app(self, app):
+        kind = self.setting(app, 'BACKEND', 'memory')
+        if kind == 'memory':
+            self.backend = MemoryBackend(self.setting(app, 'MAX_ENTRIES', 1024))
+        elif kind == 'redis':
+            self.backend = RedisBackend(self.setting(app, 'REDIS_URL'), self.redis_prefix)
+        elif kind == 'none':
+            self.backend = NullBackend()
+        else:
+            raise RuntimeError(f'Unknown {self.prefix}BACKEND {kind}, expected memory, redis or none')
+        self.default_ttl = self.setting(app, 'DEFAULT_TTL', 300)
+
+    # Get the value cached under the namespace and key, calling load and caching its result if there is none.
+    # A stamp is an extra generation for just this entry, so invalidate(stamp) drops it without touching the rest of the namespace
+    def get_or_load(self, namespace, key, load, ttl=None, stamp=None):
+        full_key = (namespace, self.backend.generation(namespace), key)
+        if stamp is not None:
+            full_key += (self.backend.generation(stamp),)
+        found, value = self.backend.get(full_key)
+        if found:
+            self.hits[namespace] += 1
+            return value
+        self.misses[namespace] += 1
+        value = load()
+        self.backend.set(full_key, value, ttl or self.default_ttl)
+        return value
+
+    # Drop every entry in the given namespaces or with the given stamps, to be called after a write that changes them
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.bump(namespace)
+
+    # Get the hit and miss counts of every namespace seen by this process
+    def stats(self):
+        return {
+            namespace: {'hits': self.hits[namespace], 'misses': self.misses[namespace]}
+            for namespace in sorted(set(self.hits) | set(self.misses))
+        }
+
+
+# Initialize the cache
+cache = Cache()
+
@@ -0,0 +1,106 @@
+from . import db
+from .models import User, Class, Subject, JoinRequest, class_display_name
+from .roles import roles
+from .cache import cache
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, joinedload
+
+
+# How long each cached lookup list is kept, in seconds, on top of being invalidated by the writes that change it
+SUBJECTS_TTL = 3600
+PEOPLE_TTL = 600
+CLASSES_TTL = 300
+
+
+# Function to get the classes matching the search filters, with the subject and teacher columns the page needs, cached per filter
+def class_catalogue(year_group=None, subject_id=None, teacher_id=None):
+    return cache.get_or_load('classes', (year_group, subject_id, teacher_id), lambda: load_class_catalogue(year_group, subject_id, teacher_id), CLASSES_TTL)
+
+
+# Function to load the classes matching the search filters in one query
+def load_class_catalogue(year_group, subject_id, teacher_id):
+    filters = []
+    if year_group:
+        filters.append(Class.year_group == year_group)
+    if subject_id:
+        filters.append(Class.subject_id == subject_id)
+    if teacher_id:
+        filters.append(Class.teacher_id == teacher_id)
+
+    rows = (
+        db.session.query(Class.id, Class.name, Class.year_group, Subject.name.label('subject_name'), User.first_name, User.last_name)
+        .outerjoin(Subject, Subject.id == Class.subject_id)
+        .outerjoin(User, User.id == Class.teacher_id)
+        .filter(*filters)
+        .order_by(Class.year_group, Class.name)
+        .all()
+    )
+    return [
+        {
+            'id': row.id,
+            'name': row.name,
+            'display_name': class_display_name(row.year_group, row.subject_name, row.first_name, row.last_name),
+            'year_group': row.year_group,
+            'subject_name': row.subject_name,
+            'teacher_name': f"{row.first_name or ''} {row.last_name or ''}".strip(),
+        }
+        for row in rows
+    ]
+
+
+# Function to get the status of each of a student's join requests keyed by class id, in one query
+def join_statuses(student_id):
+    return dict(db.session.query(JoinRequest.class_id, JoinRequest.status).filter(JoinRequest.student_id == student_id))
+
+
+# Function to get the subjects for the forms as dicts with id and name
+def subject_options():
+    return cache.get_or_load('subjects', (), lambda: [
+        {'id': row.id, 'name': row.name} for row in db.session.query(Subject.id, Subject.name).order_by(Subject.name)
+    ], SUBJECTS_TTL)
+
+
+# Function to get the teachers for the search form as dicts with id, first_name and last_name
+def teacher_options():
+    return cache.get_or_load('teachers', (), lambda: people_options('teacher'), PEOPLE_TTL)
+
+
+# Function to get the students for the award form as dicts with id, first_name and last_name
+def student_options():
+    return cache.get_or_load('students', (), lambda: people_options('student'), PEOPLE_TTL)
+
+
+# Function to load the users with the given role as dicts with id, first_name and last_name, ordered by name
+def people_options(role):
+    rows = db.session.query(User.id, User.first_name, User.last_name).filter(User.role_id == roles.id(role)).order_by(User.last_name, User.first_name)
+    return [{'id': row.id, 'first_name': row.first_name, 'last_name': row.last_name} for row in rows]
+
+
+# Function to get the year groups that have at least one class, in order
+def year_group_options():
+    return cache.get_or_load('year_groups', (), lambda: [
+        year_group for (year_group,) in db.session.query(Class.year_group).distinct().order_by(Class.year_group)
+    ], CLASSES_TTL)
+
+
+# Function to get the join requests for a teacher's classes, optionally only those with the given statuses, with the student and class loaded
+def teacher_join_requests(teacher_id, statuses=None):
+    query = (
+        JoinRequest.query
+        .join(Class, Class.id == JoinRequest.class_id)
+        .filter(Class.teacher_id == teacher_id)
+        .options(contains_eager(JoinRequest.class_), joinedload(JoinRequest.student))
+    )
+    if statuses:
+        query = query.filter(JoinRequest.status.in_(statuses))
+    return query.order_by(JoinRequest.id).all()
+
+
+# Function to count the pending join requests of each of a teacher's classes, keyed by class id, in one query
+def pending_request_counts(teacher_id):
+    return dict(
+        db.session.query(JoinRequest.class_id, func.count(JoinRequest.id))
+        .join(Class, Class.id == JoinRequest.class_id)
+        .filter(Class.teacher_id == teacher_id, JoinRequest.status == 'pending')
+        .group_by(JoinRequest.class_id)
+    )
@@ -0,0 +1,195 @@
+from . import db, jobs, versions
+from .models import Coupon, CouponCode, Transactions, User
+from .sql import insert_ignore
+from sqlalchemy import select, update, delete, func, bindparam, or_, text
+from flask.cli import with_appcontext
+from flask import current_app
+from datetime import datetime
+import click
+import logging
+import random
+import string
+
+logger = logging.getLogger(__name__)
+
+# Characters and length of a coupon code
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+CODE_LENGTH = 8
+
+# Number of codes generated and inserted per statement when filling the pool
+FILL_BATCH_SIZE = 10000
+
+# Number of codes checked against the coupon table per query, kept below SQLite's bound parameter limit
+LOOKUP_CHUNK_SIZE = 900
+
+# Random number generator backed by the operating system, so codes cannot be predicted
+generator = random.SystemRandom()
+
+# Kind of the jobs that copy the redeem date of a coupon onto its ledger row
+REDEMPTION_JOB = 'coupon_redemptions'
+
+# Kind of the job that tops the code pool up to COUPON_POOL_SIZE, which recurs every COUPON_POOL_FILL_INTERVAL seconds
+FILL_JOB = 'fill_coupon_codes'
+
+# Kind of the job that expires coupons, which recurs every COUPON_SWEEP_INTERVAL seconds
+SWEEP_JOB = 'expire_coupons'
+
+# Statuses of the coupons a student can still use, unredeemed or redeemed and not yet expired
+LIVE_STATUSES = ('active', 'redeemed')
+
+
+# Function to generate a batch of random codes that are not already used by a coupon
+def generate_codes(count):
+    codes = {''.join(generator.choices(CODE_ALPHABET, k=CODE_LENGTH)) for _ in range(count)}
+    # Issued codes have left the pool, so check the candidates against the coupon table's unique index
+    candidates = list(codes)
+    for start in range(0, len(candidates), LOOKUP_CHUNK_SIZE):
+        chunk = candidates[start:start + LOOKUP_CHUNK_SIZE]
+        codes.difference_update(code for (code,) in db.session.query(Coupon.code).filter(Coupon.code.in_(chunk)))
+    return codes
+
+
+# Function to top the pool up until it holds at least target codes, returning how many were added. Each batch is committed
+# unless commit is False, which leaves the whole fill to the caller's transaction, as in the fill job
+def fill_pool(target, batch_size=FILL_BATCH_SIZE, commit=True):
+    pooled = db.session.query(func.count(CouponCode.code)).scalar()
+    added = 0
+    while pooled + added < target:
+        codes = generate_codes(min(batch_size, target - pooled - added))
+        # Codes already in the pool are skipped by the primary key, so count what actually went in
+        added += db.session.execute(insert_ignore(CouponCode), [{'code': code} for code in codes]).rowcount
+        if commit:
+            db.session.commit()
+    return added
+
+
+# Statements deleting one code from the pool and returning it, so a code is chosen and claimed in a single statement and two
+# transactions can never claim the same one. SKIP LOCKED lets concurrent purchases on PostgreSQL pass over each other's rows
+CLAIM_STATEMENTS = {
+    'sqlite': 'DELETE FROM coupon_code WHERE code = (SELECT code FROM coupon_code LIMIT 1) RETURNING code',
+    'postgresql': 'DELETE FROM coupon_code WHERE code = (SELECT code FROM coupon_code LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING code',
+}
+
+
+# Function to issue one code from the pool in the caller's transaction, returning None if the pool is empty. The pool is only
+# refilled by the fill job or 'flask fill-coupon-codes', never on the request path
+def claim_code():
+    statement = CLAIM_STATEMENTS.get(db.session.get_bind().dialect.name)
+    if statement is not None:
+        return db.session.execute(text(statement)).scalar()
+    # MySQL has no DELETE ... RETURNING, so lock a row no one else holds and delete it in the same transaction
+    code = db.session.execute(select(CouponCode.code).limit(1).with_for_update(skip_locked=True)).scalar()
+    if code is not None:
+        db.session.execute(delete(CouponCode).where(CouponCode.code == code).execution_options(synchronize_session=False))
+    return code
+
+
+# Function to queue a fill now unless one is already waiting, committing it on its own as it is called after a failed purchase
+def schedule_fill():
+    try:
+        jobs.schedule(FILL_JOB)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Job handler topping the pool up in the job's transaction
+@jobs.handler(FILL_JOB, batch_size=1, every='COUPON_POOL_FILL_INTERVAL')
+def fill(payloads):
+    added = fill_pool(current_app.config.get('COUPON_POOL_SIZE', 10000), commit=False)
+    if added:
+        logger.info('added %d coupon codes to the pool', added)
+
+
+# Function to queue copying a coupon's redeem date onto the ledger row of its purchase
+def record_redemption(coupon_id, student_id, redeemed_at):
+    jobs.enqueue(REDEMPTION_JOB, {'coupon_id': coupon_id, 'student_id': student_id, 'redeemed_at': redeemed_at.isoformat()})
+
+
+# Job handler writing the redeem dates of a batch of coupons with one executemany UPDATE
+@jobs.handler(REDEMPTION_JOB)
+def write_redemptions(redemptions):
+    db.session.execute(
+        update(Transactions)
+        .where(Transactions.coupon_id == bindparam('redeemed_coupon_id'))
+        .values(date_redeemed=bindparam('redeemed_at'))
+        .execution_options(synchronize_session=False),
+        [{'redeemed_coupon_id': redemption['coupon_id'], 'redeemed_at': datetime.fromisoformat(redemption['redeemed_at'])} for redemption in redemptions],
+    )
+    # The students' statements and the admin ledger now show the redeem dates
+    versions.bump(versions.LEDGER, *(versions.user_entity(redemption['student_id']) for redemption in redemptions))
+
+
+# Function to build the condition for live coupons. A redeemed coupon past expires_at is left out even if the sweep has
+# not marked it yet, so the sweep interval never lets an expired coupon through
+def live_condition(now=None):
+    return (Coupon.status.in_(LIVE_STATUSES), or_(Coupon.expires_at.is_(None), Coupon.expires_at > (now or datetime.utcnow())))
+
+
+# Function to get a student's live coupons through the (student_id, status) index
+def live_coupons(student_id):
+    return Coupon.query.filter(Coupon.student_id == student_id, *live_condition()).order_by(Coupon.id).all()
+
+
+# Function to look up a redeemed coupon by its code for staff checking it, returning the coupon and the student's name,
+# or None if no live redeemed coupon has that code
+def verify_code(code):
+    return db.session.execute(
+        select(Coupon.id, Coupon.name, Coupon.student_id, Coupon.redeem_date, Coupon.expires_at, User.first_name, User.last_name)
+        .join(User, User.id == Coupon.student_id)
+        .where(Coupon.code == code, Coupon.status == 'redeemed', Coupon.expires_at > datetime.utcnow())
+    ).first()
+
+
+# Function to mark every redeemed coupon past its expiry time as expired with one UPDATE, returning how many were expired
+def expire_coupons(now=None):
+    now = now or datetime.utcnow()
+    due = (Coupon.status == 'redeemed', Coupon.expires_at <= now)
+    # The students' coupon lists change, so their API responses need new tags
+    student_ids = [student_id for (student_id,) in db.session.execute(select(Coupon.student_id).where(*due).distinct())]
+    if not student_ids:
+        return 0
+    expired = db.session.execute(
+        update(Coupon).where(*due).values(status='expired').execution_options(synchronize_session=False)
+    ).rowcount
+    versions.bump(*(versions.user_entity(student_id) for student_id in student_ids))
+    return expired
+
+
+# Job handler running the sweep
+@jobs.handler(SWEEP_JOB, batch_size=1, every='COUPON_SWEEP_INTERVAL')
+def sweep(payloads):
+    expired = expire_coupons()
+    if expired:
+        logger.info('expired %d coupons', expired)
+
+
+# Command to fill the coupon code pool now, meant to be run at deploy time, or with --schedule to queue a fill for the worker
+@click.command('fill-coupon-codes')
+@click.option('--target', type=int, help='Number of unissued codes the pool should hold, COUPON_POOL_SIZE by default.')
+@click.option('--schedule', is_flag=True, help='Queue a fill for the worker instead of filling now.')
+@with_appcontext
+def fill_coupon_codes_command(target, schedule):
+    if schedule:
+        schedule_fill()
+        click.echo('the coupon code fill is queued')
+        return
+    click.echo(f"added {fill_pool(target or current_app.config['COUPON_POOL_SIZE'])} coupon codes to the pool")
+
+
+# Command to expire the coupons past their expiry time now, or with --schedule to queue the sweep job for the worker
+@click.command('expire-coupons')
+@click.option('--schedule', is_flag=True, help='Queue a sweep for the worker instead of sweeping now.')
+@with_appcontext
+def expire_coupons_command(schedule):
+    try:
+        if schedule:
+            jobs.schedule(SWEEP_JOB)
+        else:
+            expired = expire_coupons()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    click.echo('the coupon sweep is queued' if schedule else f'expired {expired} coupons')
@@ -0,0 +1,30 @@
+from . import db, jobs
+from .models import TeacherRequestHistory
+from sqlalchemy import insert
+from datetime import datetime
+
+# The teacher request history is only read by the admin's history page, so routes queue its rows as jobs instead of
+# inserting them on the request path, and the worker writes a batch of them with one statement
+
+# Kind of the jobs that add teacher request history rows
+TEACHER_REQUEST_JOB = 'teacher_request_history'
+
+
+# Function to queue a history row for a teacher role request, with the time it happened rather than the time it is written
+def record_teacher_request(user_id, status, resolved_by_id=None, resolved_at=None):
+    jobs.enqueue(TEACHER_REQUEST_JOB, {
+        'user_id': user_id,
+        'status': status,
+        'resolved_by_id': resolved_by_id,
+        'date_resolved': resolved_at.isoformat() if resolved_at else None,
+    })
+
+
+# Job handler inserting a batch of teacher request history rows, in the order they were queued
+@jobs.handler(TEACHER_REQUEST_JOB)
+def write_teacher_requests(entries):
+    db.session.execute(insert(TeacherRequestHistory), [
+        {'user_id': entry['user_id'], 'status': entry['status'], 'resolved_by_id': entry['resolved_by_id'],
+         'date_resolved': datetime.fromisoformat(entry['date_resolved']) if entry['date_resolved'] else None}
+        for entry in entries
+    ])
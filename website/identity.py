@@ -0,0 +1,72 @@
+from . import db
+from .models import User, Account
+from .roles import roles
+from .cache import Cache
+from flask_login import UserMixin
+from sqlalchemy import select, func
+
+# Flask-Login loads the current user on every authenticated request. Instead of a User row, the user loader returns an
+# Identity built from a compact record kept in the identity cache, so serving a request normally costs no identity queries.
+# Each user's record has its own version stamp, bumped by invalidate() whenever a route writes that user.
+# Anything not in the record, such as a relationship, falls back to loading the User row once for the request.
+
+# Columns kept in the record, everything the pages read from current_user on a typical request
+IDENTITY_FIELDS = [
+    'id', 'email', 'first_name', 'last_name', 'user_name', 'role_id', 'role_approved', 'role_request',
+    'account_id', 'weekly_point_limit', 'points_awarded_this_week', 'last_award_date',
+]
+
+# Cache of the records, sized and timed by the IDENTITY_CACHE_ settings, falling back to the CACHE_ settings
+identities = Cache('IDENTITY_CACHE_', 'website:identity:')
+
+
+# The current user as seen by Flask-Login and the routes, built from a cached record
+class Identity(UserMixin):
+    def __init__(self, record):
+        self.__dict__.update(record)
+
+    # Role checks use the in-process role registry, as on User
+    def is_admin(self):
+        return roles.name(self.role_id) == 'admin'
+
+    def is_teacher(self):
+        return roles.name(self.role_id) == 'teacher'
+
+    def is_student(self):
+        return roles.name(self.role_id) == 'student'
+
+    # Any other attribute, e.g. a relationship, is read from the User row, loaded the first time one is needed
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'user_row':
+            raise AttributeError(name)
+        if 'user_row' not in self.__dict__:
+            self.__dict__['user_row'] = db.session.get(User, self.id)
+        return getattr(self.__dict__['user_row'], name)
+
+    def __repr__(self):
+        return f'<Identity {self.id}>'
+
+
+# Function to get the stamp of a user's record
+def stamp(user_id):
+    return f'user:{user_id}'
+
+
+# Function to read a user's record with one query, or None if there is no such user. Users created by sign-up have no
+# account_id set, so the id of their account is looked up from the account table instead
+def load_record(user_id):
+    account_id = func.coalesce(User.account_id, select(Account.id).where(Account.user_id == User.id).limit(1).scalar_subquery())
+    columns = [getattr(User, field) for field in IDENTITY_FIELDS if field != 'account_id']
+    row = db.session.execute(select(*columns, account_id.label('account_id')).where(User.id == user_id)).first()
+    return dict(row._mapping) if row is not None else None
+
+
+# Function to get the current user for Flask-Login, from the cache when the record is there and its stamp is current
+def load_identity(user_id):
+    record = identities.get_or_load('identity', user_id, lambda: load_record(user_id), stamp=stamp(user_id))
+    return Identity(record) if record is not None else None
+
+
+# Function to drop the cached records of the given users, to be called after a write to them
+def invalidate(*user_ids):
+    identities.invalidate(*(stamp(user_id) for user_id in user_ids))
@@ -0,0 +1,140 @@
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from collections import Counter, defaultdict
+import json
+import logging
+import re
+import threading
+import time
+
+# Counts the SQL statements each request sends, and the time spent on them, from the engine's cursor events.
+# Statements are reduced to fingerprints with the literal values taken out, so the same lookup run once per row of a page
+# shows up as one fingerprint with a high count, the usual sign of an N+1 query. Every request ends with one JSON log
+# line, requests with a fingerprint at or above SQL_N_PLUS_ONE_THRESHOLD are logged as warnings and kept per route,
+# and the counts are added to the response as X-SQL-* headers when SQL_HEADERS is on.
+
+logger = logging.getLogger(__name__)
+
+# Patterns that turn a statement into its fingerprint
+PARAMETERS = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+|\$\d+')
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+VALUE_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+SELECT_LIST = re.compile(r'^SELECT .*? FROM ')
+
+# Longest fingerprint written to the log
+FINGERPRINT_LENGTH = 300
+
+
+# Function to shorten a fingerprint for the log, leaving out the column list so the FROM and WHERE clauses fit
+def summary(statement):
+    return SELECT_LIST.sub('SELECT ... FROM ', statement, count=1)[:FINGERPRINT_LENGTH]
+
+
+# Function to reduce a statement to its fingerprint, e.g. "SELECT ... WHERE coupon.id = ?" for every coupon id
+def fingerprint(statement):
+    statement = PARAMETERS.sub('?', statement)
+    statement = LITERALS.sub('?', statement)
+    # IN lists of different lengths are the same statement
+    statement = VALUE_LISTS.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+# The statements sent while handling one request
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    # Get the fingerprints run at least threshold times, most repeated first
+    def repeated(self, threshold):
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+# Hooks the engine and request events of an application, and keeps the likely N+1 patterns seen by each route
+class Instrumentation:
+    def __init__(self):
+        self.threshold = 10
+        self.headers = True
+        self.flagged = defaultdict(Counter)
+        self.lock = threading.Lock()
+
+    def init_app(self, app, engine):
+        if not app.config.get('SQL_INSTRUMENTATION', True):
+            return
+        self.threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 10)
+        self.headers = app.config.get('SQL_HEADERS', True)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+        app.before_request(self.start_request)
+        app.after_request(self.add_headers)
+        # Streamed responses keep running queries after after_request, so the log line waits for the teardown
+        app.teardown_request(self.finish_request)
+
+    # Get the statistics of the current request, or None outside a request, e.g. in a command
+    def current(self):
+        if not has_request_context():
+            return None
+        return g.get('sql_stats')
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.current() is not None:
+            conn.info.setdefault('sql_started', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self.current()
+        started = conn.info.get('sql_started')
+        if stats is None or not started:
+            return
+        stats.seconds += time.perf_counter() - started.pop()
+        stats.queries += 1
+        stats.statements[fingerprint(statement)] += 1
+
+    def start_request(self):
+        g.sql_stats = RequestStats()
+
+    def add_headers(self, response):
+        stats = self.current()
+        if stats is not None and self.headers:
+            response.headers['X-SQL-Queries'] = str(stats.queries)
+            response.headers['X-SQL-Time'] = f'{stats.seconds * 1000:.2f}'
+            repeated = stats.repeated(self.threshold)
+            if repeated:
+                response.headers['X-SQL-N-Plus-One'] = str(len(repeated))
+        return response
+
+    def finish_request(self, error=None):
+        # The statistics stay on g until the request ends, as metrics.py also reads them in its teardown
+        stats = g.get('sql_stats')
+        if stats is None:
+            return
+        route = request.endpoint or request.path
+        repeated = stats.repeated(self.threshold)
+        record = {
+            'event': 'sql',
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'queries': stats.queries,
+            'sql_ms': round(stats.seconds * 1000, 2),
+            'n_plus_one': [{'statement': summary(statement), 'count': count} for statement, count in repeated],
+        }
+        if repeated:
+            with self.lock:
+                self.flagged[route].update({statement: 1 for statement, _ in repeated})
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+
+    # Get the likely N+1 patterns seen by each route in this process, with the number of requests that showed them
+    def report(self):
+        with self.lock:
+            return {
+                route: [{'statement': summary(statement), 'requests': requests} for statement, requests in statements.most_common()]
+                for route, statements in sorted(self.flagged.items())
+            }
+
+
+# Initialize the instrumentation
+instrumentation = Instrumentation()
@@ -0,0 +1,290 @@
+from . import db
+from .models import Job
+from sqlalchemy import select, insert, update, delete, func
+from flask.cli import with_appcontext
+from flask import current_app, g, has_request_context
+from datetime import datetime, timedelta
+import click
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import time
+import uuid
+
+# A job queue kept in the application's own database, for writes that do not need to happen before the response is sent,
+# such as history rows and points rollups. A route queues a job with enqueue() in the same transaction as its own changes,
+# so the job exists exactly when the change it follows from was committed. 'flask worker' takes due jobs in batches of one
+# kind, runs the kind's handler on the whole batch and deletes the jobs in the handler's transaction, so a batch is applied
+# once or not at all. A failed job is retried with exponential backoff until JOB_MAX_ATTEMPTS, then left as failed.
+# A recurring kind, such as the coupon sweep, queues its next run in the transaction of the run that finished, and is
+# first queued when the worker starts. With JOBS_INLINE on, a request runs the jobs it queued itself before it returns,
+# leaving recurring kinds to the worker.
+
+logger = logging.getLogger(__name__)
+
+# Registered handlers as kind: (function, batch size), a batch size of None uses JOB_BATCH_SIZE
+HANDLERS = {}
+
+# Recurring kinds as kind: name of the setting holding the seconds between runs
+RECURRING = {}
+
+
+# Decorator that registers a function as the handler of a kind of job, called with the payloads of a batch of jobs.
+# With every, the kind recurs every that many seconds, read from the setting of that name
+def handler(kind, batch_size=None, every=None):
+    def register(function):
+        HANDLERS[kind] = (function, batch_size)
+        if every:
+            RECURRING[kind] = every
+        return function
+    return register
+
+
+# Function to queue a job in the current transaction, it is only seen by the worker once the caller commits. The id is
+# noted on the request, so the inline runner only has to look at the jobs this request queued
+def enqueue(kind, payload, delay=0):
+    now = datetime.utcnow()
+    job_id = db.session.execute(insert(Job).values(
+        kind=kind, payload=json.dumps(payload), status='queued', attempts=0, run_at=now + timedelta(seconds=delay), created_at=now,
+    )).inserted_primary_key[0]
+    if has_request_context():
+        g.setdefault('queued_jobs', []).append(job_id)
+
+
+# Function to queue a job with no payload in the current transaction, unless one of that kind is already waiting in one of statuses
+def schedule(kind, delay=0, statuses=('queued', 'running')):
+    if db.session.query(Job.id).filter(Job.kind == kind, Job.status.in_(statuses)).first() is None:
+        enqueue(kind, {}, delay=delay)
+
+
+# Function to make sure every recurring kind has a job queued, committing them, for when a worker starts
+def schedule_recurring():
+    try:
+        for kind in sorted(RECURRING):
+            schedule(kind)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# A batch of jobs of one kind claimed by a worker
+class Batch:
+    def __init__(self, kind, token, jobs):
+        self.kind = kind
+        self.token = token
+        self.jobs = jobs
+
+
+# Takes due jobs from the queue and runs them, until stopped or, with once, until nothing is due
+class Worker:
+    def __init__(self, config):
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self.batch_size = config.get('JOB_BATCH_SIZE', 100)
+        self.max_attempts = config.get('JOB_MAX_ATTEMPTS', 5)
+        self.retry_delay = config.get('JOB_RETRY_DELAY', 5)
+        self.max_retry_delay = config.get('JOB_MAX_RETRY_DELAY', 3600)
+        self.lock_timeout = config.get('JOB_LOCK_TIMEOUT', 300)
+        self.poll_interval = config.get('JOB_POLL_INTERVAL', 1.0)
+        self.stopping = False
+
+    # Ask the worker to stop once the batch it is running is finished
+    def stop(self, *args):
+        self.stopping = True
+
+    # Put back the running jobs of workers that have held them longer than JOB_LOCK_TIMEOUT, e.g. because they were killed
+    def release_stale(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.lock_timeout)
+        released = db.session.execute(
+            update(Job)
+            .where(Job.status == 'running', Job.locked_at < cutoff)
+            .values(status='queued', locked_by=None, locked_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if released:
+            logger.warning('released %d jobs held longer than %d seconds', released, self.lock_timeout)
+        return released
+
+    # Claim the next batch: the oldest due job decides the kind, and up to that kind's batch size of due jobs are taken with it.
+    # With ids, only those jobs are considered, leaving out recurring kinds
+    def claim(self, ids=None):
+        now = datetime.utcnow()
+        due = (Job.status == 'queued', Job.run_at <= now)
+        if ids is not None:
+            due += (Job.id.in_(ids), Job.kind.notin_(sorted(RECURRING)))
+        try:
+            kind = db.session.execute(select(Job.kind).where(*due).order_by(Job.run_at, Job.id).limit(1)).scalar()
+            if kind is None:
+                db.session.rollback()
+                return None
+            size = HANDLERS.get(kind, (None, None))[1] or self.batch_size
+            # The status check in the UPDATE itself makes the claim safe when several workers run at once
+            token = f'{self.name}:{uuid.uuid4().hex[:8]}'
+            ids = select(Job.id).where(*due, Job.kind == kind).order_by(Job.run_at, Job.id).limit(size).scalar_subquery()
+            db.session.execute(
+                update(Job)
+                .where(Job.id.in_(ids), Job.status == 'queued')
+                .values(status='running', locked_by=token, locked_at=now, attempts=Job.attempts + 1)
+                .execution_options(synchronize_session=False)
+            )
+            jobs = db.session.execute(
+                select(Job.id, Job.payload, Job.attempts).where(Job.locked_by == token).order_by(Job.id)
+            ).all()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return Batch(kind, token, jobs)
+
+    # Run a batch, falling back to one job at a time if it fails so one bad job does not hold back the rest
+    def run(self, batch):
+        function = HANDLERS.get(batch.kind, (None, None))[0]
+        try:
+            if function is None:
+                raise LookupError(f'no handler is registered for {batch.kind} jobs')
+            function([json.loads(job.payload) for job in batch.jobs])
+            # Queue the next run of a recurring kind with this run's changes, unless one is already waiting
+            if batch.kind in RECURRING:
+                schedule(batch.kind, delay=current_app.config[RECURRING[batch.kind]], statuses=('queued',))
+            # Delete the jobs with the handler's changes. If they are no longer ours, e.g. another worker took them back
+            # or the rollups were rebuilt, the work belongs to someone else and is undone
+            done = db.session.execute(
+                delete(Job)
+                .where(Job.id.in_([job.id for job in batch.jobs]), Job.locked_by == batch.token)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if done != len(batch.jobs):
+                db.session.rollback()
+                logger.warning('%s batch of %d jobs was taken back before it finished', batch.kind, len(batch.jobs))
+                return 0
+            db.session.commit()
+            return done
+        except Exception as error:
+            db.session.rollback()
+            if len(batch.jobs) > 1:
+                return sum(self.run(Batch(batch.kind, batch.token, [job])) for job in batch.jobs)
+            self.retry(batch, batch.jobs[0], error)
+            return 0
+
+    # Schedule a failed job to run again after a backoff that doubles with each attempt, or fail it after the last attempt
+    def retry(self, batch, job, error):
+        values = {'status': 'queued', 'locked_by': None, 'locked_at': None, 'last_error': f'{type(error).__name__}: {error}'}
+        if job.attempts >= self.max_attempts:
+            values['status'] = 'failed'
+            logger.error('%s job %d failed after %d attempts: %s', batch.kind, job.id, job.attempts, values['last_error'])
+        else:
+            # Jitter spreads out the retries of jobs that failed together
+            delay = min(self.retry_delay * 2 ** (job.attempts - 1), self.max_retry_delay) * random.uniform(0.5, 1.0)
+            values['run_at'] = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning('%s job %d failed, retrying in %.0f seconds: %s', batch.kind, job.id, delay, values['last_error'])
+        try:
+            db.session.execute(
+                update(Job)
+                .where(Job.id == job.id, Job.locked_by == batch.token)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    # Run batches until stopped, waiting JOB_POLL_INTERVAL when nothing is due, or with once until nothing is due.
+    # With ids, only those jobs are run, once, and the jobs of other workers are left alone
+    def work(self, once=False, ids=None):
+        processed = 0
+        if ids is None:
+            self.release_stale()
+        else:
+            once = True
+        while not self.stopping:
+            batch = self.claim(ids)
+            if batch is None:
+                if once:
+                    break
+                time.sleep(self.poll_interval)
+                self.release_stale()
+                continue
+            if batch.jobs:
+                processed += self.run(batch)
+        return processed
+
+
+# Function to get the number of jobs of each kind in each status
+def queue_status():
+    return db.session.query(Job.kind, Job.status, func.count(Job.id), func.min(Job.run_at)).group_by(Job.kind, Job.status).order_by(Job.kind, Job.status).all()
+
+
+# Function to queue the failed jobs again with a fresh set of attempts
+def retry_failed():
+    try:
+        count = db.session.execute(
+            update(Job)
+            .where(Job.status == 'failed')
+            .values(status='queued', attempts=0, run_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        return count
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Function to get the number of jobs that have been due for longer than a worker would leave them, and the oldest due time
+def overdue_jobs(seconds):
+    cutoff = datetime.utcnow() - timedelta(seconds=seconds)
+    return db.session.query(func.count(Job.id), func.min(Job.run_at)).filter(Job.status == 'queued', Job.run_at <= cutoff).one()
+
+
+# Runs the jobs queued by each request before it returns, when JOBS_INLINE is on, so development needs no worker.
+# A request that queued nothing costs nothing, and recurring kinds such as the coupon pool fill wait for 'flask worker'
+class InlineJobs:
+    def init_app(self, app):
+        if app.config.get('JOBS_INLINE', False):
+            app.after_request(self.run_queued)
+            return
+        with app.app_context():
+            # Jobs left waiting longer than a worker holds a batch mean no worker has been taking them
+            count, oldest = overdue_jobs(app.config.get('JOB_LOCK_TIMEOUT', 300))
+            db.session.rollback()
+            if count:
+                logger.warning("%d jobs have been waiting since %s, start 'flask worker' or turn on JOBS_INLINE", count, f'{oldest:%Y-%m-%d %H:%M:%S}')
+
+    def run_queued(self, response):
+        ids = g.pop('queued_jobs', None)
+        if ids:
+            Worker(current_app.config).work(ids=ids)
+        return response
+
+
+# Initialize the inline runner
+inline_jobs = InlineJobs()
+
+
+# Command to run the worker, which stops after its current batch on SIGTERM or Ctrl+C
+@click.command('worker')
+@click.option('--once', is_flag=True, help='Stop once no jobs are due instead of waiting for more.')
+@click.option('--status', is_flag=True, help='Show the number of jobs of each kind in each status and exit.')
+@click.option('--retry-failed', 'retry', is_flag=True, help='Queue the failed jobs again and exit.')
+@with_appcontext
+def worker_command(once, status, retry):
+    if status:
+        for kind, job_status, count, next_run in queue_status():
+            click.echo(f'{kind:30} {job_status:10} {count:8} next {next_run:%Y-%m-%d %H:%M:%S}')
+        return
+    if retry:
+        click.echo(f'queued {retry_failed()} failed jobs again')
+        return
+
+    schedule_recurring()
+    worker = Worker(current_app.config)
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    click.echo(f'worker {worker.name} handling {", ".join(sorted(HANDLERS))}')
+    processed = worker.work(once=once)
+    click.echo(f'processed {processed} jobs')
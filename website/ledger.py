@@ -0,0 +1,317 @@
+from . import db, versions
+from .sql import update_from
+from .models import Transactions, Account, BalanceSnapshot
+from sqlalchemy import and_, or_, func, select, insert, update, delete, literal, text
+from flask.cli import with_appcontext
+from datetime import datetime, timedelta
+import base64
+import click
+import csv
+import io
+import json
+import time
+
+# Number of rows shown on one page of the admin ledger
+PAGE_SIZE = 50
+
+# Number of rows fetched from the database per chunk when exporting
+EXPORT_CHUNK_SIZE = 1000
+
+# Columns included in every ledger row, in the order they are exported
+LEDGER_COLUMNS = ['id', 'sequence', 'from_account_id', 'dateTime', 'to_account_id', 'amount', 'code', 'account_id', 'coupon_id', 'date_redeemed']
+
+
+# Function to turn the (dateTime, id) of the last row on a page into an opaque cursor string
+def encode_cursor(date_time, transaction_id):
+    raw = json.dumps([date_time.isoformat() if date_time else None, transaction_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+# Function to turn a cursor string back into a (dateTime, id) pair, returning None if it is invalid
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        date_time, transaction_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return (datetime.fromisoformat(date_time) if date_time else None, int(transaction_id))
+    except (ValueError, TypeError):
+        return None
+
+
+# Function to read the ledger filters (account, date range and amount range) from the query string
+def parse_filters(args):
+    filters = {
+        'account_id': args.get('account_id', type=int),
+        'date_from': None,
+        'date_to': None,
+        'min_amount': args.get('min_amount', type=int),
+        'max_amount': args.get('max_amount', type=int),
+    }
+    # Dates are given as YYYY-MM-DD and are ignored if they cannot be parsed
+    for key in ('date_from', 'date_to'):
+        value = args.get(key)
+        if value:
+            try:
+                filters[key] = datetime.strptime(value, '%Y-%m-%d')
+            except ValueError:
+                pass
+    return filters
+
+
+# Function to build the list of SQL conditions for the given ledger filters
+def filter_conditions(filters):
+    conditions = []
+    if filters.get('account_id') is not None:
+        # from_account_id and to_account_id of awards hold user ids rather than account ids, so only account_id identifies the account
+        conditions.append(Transactions.account_id == filters['account_id'])
+    if filters.get('date_from') is not None:
+        conditions.append(Transactions.dateTime >= filters['date_from'])
+    if filters.get('date_to') is not None:
+        # The end date is inclusive, so compare against the start of the following day
+        conditions.append(Transactions.dateTime < filters['date_to'] + timedelta(days=1))
+    if filters.get('min_amount') is not None:
+        conditions.append(Transactions.amount >= filters['min_amount'])
+    if filters.get('max_amount') is not None:
+        conditions.append(Transactions.amount <= filters['max_amount'])
+    return conditions
+
+
+# Function to build the condition that selects rows strictly after the cursor in (dateTime DESC NULLS LAST, id DESC) order.
+# Comparisons with NULL are never true, so legacy rows without a dateTime are matched explicitly: they all come after
+# every dated row, ordered by id among themselves
+def after_cursor(cursor):
+    date_time, transaction_id = cursor
+    if date_time is None:
+        return and_(Transactions.dateTime.is_(None), Transactions.id < transaction_id)
+    return or_(
+        Transactions.dateTime < date_time,
+        and_(Transactions.dateTime == date_time, Transactions.id < transaction_id),
+        Transactions.dateTime.is_(None),
+    )
+
+
+# Function to select the ledger columns matching the filters, newest first, starting after the cursor
+def ledger_query(filters, cursor=None, limit=PAGE_SIZE):
+    columns = [getattr(Transactions, name) for name in LEDGER_COLUMNS]
+    query = db.session.query(*columns).filter(*filter_conditions(filters))
+    if cursor is not None:
+        query = query.filter(after_cursor(cursor))
+    # NULLS LAST is SQLite's own order for DESC, so the (dateTime, id) index is still read in order, and PostgreSQL agrees with it
+    return query.order_by(Transactions.dateTime.desc().nullslast(), Transactions.id.desc()).limit(limit)
+
+
+# Function to fetch one page of the ledger, returning the rows and the cursor for the next page (or None)
+def ledger_page(filters, cursor=None, page_size=PAGE_SIZE):
+    # Fetch one extra row to find out whether there is another page without counting the whole table
+    rows = ledger_query(filters, cursor, page_size + 1).all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1].dateTime, rows[-1].id)
+    return rows, next_cursor
+
+
+# Generator that yields the ledger rows matching the filters in chunks, so memory use stays constant
+def iter_ledger(filters, chunk_size=EXPORT_CHUNK_SIZE):
+    cursor = None
+    while True:
+        rows = ledger_query(filters, cursor, chunk_size).all()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        cursor = (rows[-1].dateTime, rows[-1].id)
+
+
+# Function to convert a ledger row into a dictionary of JSON friendly values
+def row_to_dict(row):
+    record = {}
+    for name in LEDGER_COLUMNS:
+        value = getattr(row, name)
+        record[name] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+# Generator that streams the ledger as CSV text, one header line followed by one line per row
+def export_csv(filters):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(LEDGER_COLUMNS)
+    for row in iter_ledger(filters):
+        record = row_to_dict(row)
+        writer.writerow([record[name] for name in LEDGER_COLUMNS])
+        # Flush the buffer once it holds a reasonable amount of text
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+# Generator that streams the ledger as JSON lines, one object per row
+def export_jsonl(filters):
+    lines = []
+    for row in iter_ledger(filters):
+        lines.append(json.dumps(row_to_dict(row)) + '\n')
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+#//balances------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+# The Transactions ledger is the source of truth for balances: every row carries the affected account_id and a signed amount.
+# Account.balance is kept up to date in the same transaction as each ledger row, and can always be rebuilt from the ledger.
+#
+# A snapshot records the balance up to a ledger id, and balances add the rows with higher ids. That needs every row with a
+# lower id to be committed by the time the snapshot is taken. SQLite has one writer at a time, so ids are committed in
+# order there, but on PostgreSQL a posting holding a lower id can commit after another with a higher one. Snapshots and
+# rebuilds therefore lock out postings first, see lock_ledger(), and only cover rows up to the highest id seen under the lock.
+
+
+# Function to wait for the postings in flight to commit and hold off new ones until the current transaction ends.
+# SHARE ROW EXCLUSIVE conflicts with the row locks postings take and with itself, so two maintenance runs also queue up.
+# The tables are locked in the order postings write them, account before transactions, so the lock cannot deadlock with a posting
+def lock_ledger():
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('LOCK TABLE account, transactions IN SHARE ROW EXCLUSIVE MODE'))
+
+
+# Function to get the highest ledger id, which under lock_ledger() is a high-water mark every lower id has been committed below
+def high_water_mark():
+    return db.session.query(func.coalesce(func.max(Transactions.id), 0)).scalar()
+
+
+# Function to get the current balance of an account from its latest snapshot plus the ledger rows added since
+def current_balance(account_id):
+    snapshot = BalanceSnapshot.query.filter_by(account_id=account_id).order_by(BalanceSnapshot.transaction_id.desc()).first()
+    last_transaction_id = snapshot.transaction_id if snapshot else 0
+    tail = db.session.query(func.coalesce(func.sum(Transactions.amount), 0)).filter(Transactions.account_id == account_id, Transactions.id > last_transaction_id).scalar()
+    return (snapshot.balance if snapshot else 0) + tail
+
+
+# Function to build a subquery of the latest snapshot (account_id, transaction_id, balance) of every account
+def latest_snapshots():
+    latest = select(BalanceSnapshot.account_id, func.max(BalanceSnapshot.transaction_id).label('transaction_id')).group_by(BalanceSnapshot.account_id).subquery()
+    return (
+        select(BalanceSnapshot.account_id, BalanceSnapshot.transaction_id, BalanceSnapshot.balance)
+        .join(latest, and_(BalanceSnapshot.account_id == latest.c.account_id, BalanceSnapshot.transaction_id == latest.c.transaction_id))
+        .subquery()
+    )
+
+
+# Function to give every account with new ledger rows a fresh snapshot, in one INSERT ... SELECT over the ledger tails
+def take_snapshots():
+    try:
+        lock_ledger()
+        count = db.session.execute(insert(BalanceSnapshot).from_select(['account_id', 'transaction_id', 'balance', 'taken_at'], snapshot_tails(high_water_mark()))).rowcount
+        db.session.commit()
+        return count
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Function to build the (account_id, last id, balance, taken_at) of every account with ledger rows after its latest snapshot,
+# up to the high-water mark
+def snapshot_tails(last_transaction_id):
+    snapshots = latest_snapshots()
+    return (
+        select(
+            Transactions.account_id,
+            func.max(Transactions.id),
+            func.coalesce(snapshots.c.balance, 0) + func.sum(Transactions.amount),
+            literal(datetime.utcnow()),
+        )
+        .select_from(Transactions)
+        .outerjoin(snapshots, snapshots.c.account_id == Transactions.account_id)
+        .where(Transactions.account_id.isnot(None), Transactions.id > func.coalesce(snapshots.c.transaction_id, 0), Transactions.id <= last_transaction_id)
+        .group_by(Transactions.account_id, snapshots.c.balance)
+    )
+
+
+# Function to fill in the account_id of award rows written before awards recorded it, using the student's user id in to_account_id
+def backfill_account_ids():
+    owner_account = select(Account.id).where(Account.user_id == Transactions.to_account_id).scalar_subquery()
+    return db.session.execute(
+        update(Transactions)
+        .where(Transactions.account_id.is_(None), Transactions.to_account_id.isnot(None))
+        .values(account_id=owner_account)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+# Function to recompute every balance from the ledger in one grouped pass, returning the accounts that did not match
+def rebuild_balances(dry_run=False):
+    try:
+        # Hold off postings, so no posting can commit between reading the ledger and correcting the balances. On SQLite the
+        # backfill's UPDATE takes the single write lock, which has the same effect
+        lock_ledger()
+        backfilled = backfill_account_ids()
+
+        # Sum the whole ledger per account in a single grouped aggregate, up to a fixed last row so the snapshots agree with it.
+        # Accounts without ledger rows are included with a total of 0
+        last_transaction_id = high_water_mark()
+        grouped = (
+            select(Account.id.label('account_id'), func.coalesce(func.sum(Transactions.amount), 0).label('total'))
+            .outerjoin(Transactions, and_(Transactions.account_id == Account.id, Transactions.id <= last_transaction_id))
+            .group_by(Account.id)
+            .subquery('totals')
+        )
+
+        # Compare against the stored balances to find the accounts that have drifted
+        totals = {}
+        mismatches = []
+        for account_id, balance, total in db.session.execute(
+            select(grouped.c.account_id, Account.balance, grouped.c.total).join(Account, Account.id == grouped.c.account_id)
+        ):
+            totals[account_id] = total
+            if balance != total:
+                mismatches.append({'account_id': account_id, 'stored_balance': balance, 'ledger_balance': total})
+
+        if dry_run:
+            db.session.rollback()
+            return backfilled, mismatches
+
+        # Correct the drifted balances with one UPDATE joined to the same grouped totals in SQL (UPDATE ... FROM), rather than
+        # writing back the totals read above, so the balance written is always the ledger's at the moment of the write
+        update_from(Account, grouped, {'balance': grouped.c.total}, [Account.id == grouped.c.account_id, Account.balance.is_distinct_from(grouped.c.total)])
+
+        # Replace the snapshots with one full snapshot per account, taken from the same grouped pass
+        db.session.execute(delete(BalanceSnapshot))
+        now = datetime.utcnow()
+        db.session.execute(insert(BalanceSnapshot), [
+            {'account_id': account_id, 'transaction_id': last_transaction_id, 'balance': balance, 'taken_at': now}
+            for account_id, balance in totals.items()
+        ])
+
+        # Balances may have changed without going through the posting service, so no API response can be reused
+        versions.bump_all()
+        db.session.commit()
+        return backfilled, mismatches
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Command to recompute every account balance from the ledger, for example after an incident
+@click.command('rebuild-balances')
+@click.option('--dry-run', is_flag=True, help='Only report the accounts whose balance does not match the ledger.')
+@with_appcontext
+def rebuild_balances_command(dry_run):
+    started = time.perf_counter()
+    backfilled, mismatches = rebuild_balances(dry_run)
+    for mismatch in mismatches:
+        click.echo(f"account {mismatch['account_id']}: stored {mismatch['stored_balance']}, ledger {mismatch['ledger_balance']}")
+    action = 'found' if dry_run else 'corrected'
+    click.echo(f'{action} {len(mismatches)} mismatched balances, backfilled {backfilled} ledger rows in {time.perf_counter() - started:.2f}s')
+
+
+# Command to snapshot the balance of every account with new ledger rows, meant to be run periodically
+@click.command('snapshot-balances')
+@with_appcontext
+def snapshot_balances_command():
+    click.echo(f'took {take_snapshots()} balance snapshots')
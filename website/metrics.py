@@ -0,0 +1,354 @@
+from flask import g, request, has_request_context, Response, abort
+from flask_login import current_user
+from flask.cli import with_appcontext
+from contextlib import contextmanager
+import click
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Request metrics served at /metrics in the Prometheus text exposition format: requests by endpoint, method and status,
+# a latency histogram per endpoint, requests in flight, and the SQL statements and time counted by instrumentation.py.
+#
+# Each worker process adds to its own memory mapped file in METRICS_DIR, so recording a request is a few in-place float
+# updates with no locking between processes. /metrics reads every process's file and sums them, so it reports the
+# whole server whichever worker answers the scrape. When the metrics are read, the file of each process that has exited
+# is folded into one shared file and deleted: its counters are kept and its in-flight gauges dropped, so restarting
+# workers does not leave a file behind for every process id. Clear the directory with 'flask clear-metrics' before starting the workers.
+
+# Upper bounds of the latency histogram buckets in seconds, +Inf is added when the histogram is written out
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Help text and type of every metric, in the order they are written out
+METRICS = [
+    ('http_requests_total', 'counter', 'Requests handled, by endpoint, method and status.'),
+    ('http_request_duration_seconds', 'histogram', 'Time taken to handle a request, by endpoint.'),
+    ('http_requests_in_flight', 'gauge', 'Requests being handled right now, by endpoint.'),
+    ('http_request_db_queries_total', 'counter', 'SQL statements sent while handling requests, by endpoint.'),
+    ('http_request_db_seconds_total', 'counter', 'Time spent on SQL statements while handling requests, by endpoint.'),
+]
+
+# Gauges describe live processes only, so the values left by a process that has exited are dropped when its file is folded
+GAUGES = {name for name, kind, _ in METRICS if kind == 'gauge'}
+
+# File the counters of exited processes are folded into, and the file locked while the files are folded and read
+EXITED_FILE = 'metrics_exited.db'
+LOCK_FILE = 'metrics.lock'
+
+# Label for requests that matched no route, so unknown paths cannot create new series
+UNMATCHED = 'unmatched'
+
+# Size a value file starts at, it doubles whenever it fills up
+INITIAL_FILE_SIZE = 64 * 1024
+
+# Layout of a value file: the number of bytes used, then entries of (key length, key padded to 8 bytes, value)
+USED = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+
+
+# Function to get the (key, value offset, end of entry) of every entry in a value file's bytes
+def read_entries(data):
+    used = USED.unpack_from(data, 0)[0]
+    position = USED.size
+    while position < used:
+        length = KEY_LENGTH.unpack_from(data, position)[0]
+        key = bytes(data[position + KEY_LENGTH.size:position + KEY_LENGTH.size + length]).decode()
+        offset = position + entry_padding(length)
+        yield key, offset, offset + VALUE.size
+        position = offset + VALUE.size
+
+
+# Function to get where the value of an entry with a key of the given length starts, relative to the entry, so it is 8 byte aligned
+def entry_padding(length):
+    size = KEY_LENGTH.size + length
+    return size + (-size % 8)
+
+
+# The values written by this process, kept in a memory mapped file that other processes read
+class ValueFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+b')
+        if os.fstat(self.file.fileno()).st_size < INITIAL_FILE_SIZE:
+            self.file.truncate(INITIAL_FILE_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), os.fstat(self.file.fileno()).st_size)
+        if USED.unpack_from(self.map, 0)[0] == 0:
+            USED.pack_into(self.map, 0, USED.size)
+        self.offsets = {key: offset for key, offset, _ in read_entries(self.map)}
+
+    # Add an amount to the value stored under key, creating it at zero first
+    def add(self, key, amount):
+        offset = self.offsets.get(key)
+        if offset is None:
+            offset = self.append(key)
+        VALUE.pack_into(self.map, offset, VALUE.unpack_from(self.map, offset)[0] + amount)
+
+    # Add a new entry at the end of the file, growing the file if needed, and return the offset of its value
+    def append(self, key):
+        encoded = key.encode()
+        used = USED.unpack_from(self.map, 0)[0]
+        offset = used + entry_padding(len(encoded))
+        end = offset + VALUE.size
+        if end > len(self.map):
+            self.grow(end)
+        KEY_LENGTH.pack_into(self.map, used, len(encoded))
+        self.map[used + KEY_LENGTH.size:used + KEY_LENGTH.size + len(encoded)] = encoded
+        VALUE.pack_into(self.map, offset, 0.0)
+        # Only count the entry as used once it is complete, so a reader never sees half of it
+        USED.pack_into(self.map, 0, end)
+        self.offsets[key] = offset
+        return offset
+
+    # Double the file until it can hold size bytes
+    def grow(self, size):
+        capacity = len(self.map)
+        while capacity < size:
+            capacity *= 2
+        self.map.close()
+        self.file.truncate(capacity)
+        self.map = mmap.mmap(self.file.fileno(), capacity)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+# Function to build the key a value is stored under from the metric name and its labels
+def metric_key(name, **labels):
+    return json.dumps([name, sorted(labels.items())])
+
+
+# Function to check whether a process is still running
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Function to escape a label value for the exposition format
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Function to write a sample line of the exposition format
+def sample(name, labels, value):
+    label_text = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels)
+    return f'{name}{{{label_text}}} {float(value)!r}' if label_text else f'{name} {float(value)!r}'
+
+
+# Records the requests of every application it is initialised with, and writes out the totals of every process
+class Metrics:
+    def __init__(self):
+        self.directory = None
+        self.token = None
+        self.public = False
+        self.pid = None
+        self.values = None
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+        directory = app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+        if directory != self.directory:
+            # Open a file in the new directory on the next request
+            self.directory = directory
+            self.pid = None
+        os.makedirs(self.directory, exist_ok=True)
+        self.token = app.config.get('METRICS_TOKEN')
+        self.public = app.config.get('METRICS_PUBLIC', False)
+        app.before_request(self.start_request)
+        app.after_request(self.record_status)
+        # The teardown runs once a streamed response has been sent, so the duration covers the whole response
+        app.teardown_request(self.finish_request)
+        app.add_url_rule('/metrics', 'metrics', self.view)
+
+    # Get this process's value file, opening a new one after a fork so worker processes never share a file
+    def value_file(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.values = ValueFile(os.path.join(self.directory, f'metrics_{self.pid}.db'))
+        return self.values
+
+    # Add amounts to several values of this process at once
+    def add(self, amounts):
+        with self.lock:
+            values = self.value_file()
+            for key, amount in amounts:
+                values.add(key, amount)
+
+    # Get the endpoint label of the current request
+    def endpoint(self):
+        return request.endpoint or UNMATCHED
+
+    def start_request(self):
+        if request.endpoint == 'metrics':
+            return
+        g.metrics_started = time.perf_counter()
+        self.add([(metric_key('http_requests_in_flight', endpoint=self.endpoint()), 1)])
+
+    def record_status(self, response):
+        if has_request_context():
+            g.metrics_status = response.status_code
+        return response
+
+    def finish_request(self, error=None):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        endpoint = self.endpoint()
+        # A request that raised never reached after_request, so it is counted as a server error
+        status = 500 if error is not None else g.pop('metrics_status', 500)
+        bucket = next((str(bound) for bound in LATENCY_BUCKETS if duration <= bound), '+Inf')
+        amounts = [
+            (metric_key('http_requests_in_flight', endpoint=endpoint), -1),
+            (metric_key('http_requests_total', endpoint=endpoint, method=request.method, status=str(status)), 1),
+            # Buckets are stored individually and made cumulative when they are written out
+            (metric_key('http_request_duration_seconds_bucket', endpoint=endpoint, le=bucket), 1),
+            (metric_key('http_request_duration_seconds_sum', endpoint=endpoint), duration),
+            (metric_key('http_request_duration_seconds_count', endpoint=endpoint), 1),
+        ]
+        # The SQL counts come from instrumentation.py, when it is turned on
+        stats = g.get('sql_stats')
+        if stats is not None:
+            amounts.append((metric_key('http_request_db_queries_total', endpoint=endpoint), stats.queries))
+            amounts.append((metric_key('http_request_db_seconds_total', endpoint=endpoint), stats.seconds))
+        self.add(amounts)
+
+    # Function to get the process id of every value file in the directory, as (path, pid), leaving out the exited file
+    def process_files(self):
+        files = []
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+            try:
+                files.append((path, int(os.path.basename(path)[len('metrics_'):-len('.db')])))
+            except ValueError:
+                continue
+        return files
+
+    # Function to hold the lock on the metrics directory, so only one process at a time folds or reads the files. Where
+    # there is no fcntl, e.g. on Windows, the files are not locked
+    @contextmanager
+    def directory_lock(self):
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    # Function to add the counters of every process that has exited to the exited file and delete its own file
+    def fold_exited(self):
+        exited = None
+        try:
+            for path, pid in self.process_files():
+                if pid == os.getpid() or process_alive(pid):
+                    continue
+                try:
+                    with open(path, 'rb') as file:
+                        data = file.read()
+                except OSError:
+                    continue
+                if exited is None:
+                    exited = ValueFile(os.path.join(self.directory, EXITED_FILE))
+                for key, offset, end in read_entries(data):
+                    if json.loads(key)[0] not in GAUGES:
+                        exited.add(key, VALUE.unpack_from(data, offset)[0])
+                os.remove(path)
+        finally:
+            if exited is not None:
+                exited.close()
+
+    # Function to sum the values of every process's file and the exited file, after folding the files of exited processes
+    def collect(self):
+        totals = {}
+        with self.directory_lock():
+            self.fold_exited()
+            for path in [path for path, _ in self.process_files()] + [os.path.join(self.directory, EXITED_FILE)]:
+                try:
+                    with open(path, 'rb') as file:
+                        data = file.read()
+                except OSError:
+                    continue
+                for key, offset, end in read_entries(data):
+                    name, labels = json.loads(key)
+                    series = (name, tuple(tuple(label) for label in labels))
+                    totals[series] = totals.get(series, 0.0) + VALUE.unpack_from(data, offset)[0]
+        return totals
+
+    # Function to write out the totals of every process in the text exposition format
+    def exposition(self):
+        totals = self.collect()
+        lines = []
+        for name, kind, help_text in METRICS:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind != 'histogram':
+                for (series, labels), value in sorted(totals.items()):
+                    if series == name:
+                        lines.append(sample(name, labels, value))
+                continue
+
+            # Make the buckets of each endpoint cumulative, ending with +Inf, then add the sum and count
+            endpoints = sorted({dict(labels)['endpoint'] for series, labels in totals if series == f'{name}_count'})
+            for endpoint in endpoints:
+                cumulative = 0.0
+                for bound in [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']:
+                    cumulative += totals.get((f'{name}_bucket', (('endpoint', endpoint), ('le', bound))), 0.0)
+                    lines.append(sample(f'{name}_bucket', [('endpoint', endpoint), ('le', bound)], cumulative))
+                lines.append(sample(f'{name}_sum', [('endpoint', endpoint)], totals.get((f'{name}_sum', (('endpoint', endpoint),)), 0.0)))
+                lines.append(sample(f'{name}_count', [('endpoint', endpoint)], totals.get((f'{name}_count', (('endpoint', endpoint),)), 0.0)))
+        return '\n'.join(lines) + '\n'
+
+    # Function to check whether the current request may read the metrics: a scraper sending METRICS_TOKEN, a logged in
+    # admin, or anyone when METRICS_PUBLIC is on and no token is set
+    def allowed(self):
+        if self.token and request.headers.get('Authorization') == f'Bearer {self.token}':
+            return True
+        if current_user.is_authenticated and current_user.is_admin():
+            return True
+        return self.public and not self.token
+
+    # Route serving the metrics to the requests allowed to read them
+    def view(self):
+        if not self.allowed():
+            abort(403)
+        return Response(self.exposition(), mimetype='text/plain; version=0.0.4')
+
+    # Function to delete every process's value file and the exited file
+    def clear(self):
+        removed = 0
+        with self.lock:
+            if self.values is not None:
+                self.values.close()
+                self.values = None
+                self.pid = None
+            for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+# Initialize the metrics
+metrics = Metrics()
+
+
+# Command to delete the metrics files, meant to be run before the worker processes start so counts begin at zero
+@click.command('clear-metrics')
+@with_appcontext
+def clear_metrics_command():
+    if metrics.directory is None:
+        raise click.ClickException('metrics are turned off by METRICS_ENABLED')
+    click.echo(f'removed {metrics.clear()} metrics files from {metrics.directory}')
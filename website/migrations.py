@@ -0,0 +1,261 @@
+from . import db, ledger, catalogue, rollups, coupons
+from .models import SchemaVersion, User, Account, Transactions, Coupon, Class, JoinRequest, Job, EntityVersion
+from .posting import bulk_targets
+from .sql import add_days, upsert_add
+from .roles import roles
+from sqlalchemy import text, event, func, inspect, update, table, column
+from flask.cli import with_appcontext
+from datetime import datetime
+import click
+import re
+
+# db.create_all() only creates missing tables, so changes to existing tables are made by numbered migrations.
+# Each migration runs once per database and is recorded in the schema_version table. Every statement is written
+# so it can be run again safely (e.g. CREATE INDEX IF NOT EXISTS), as a fresh database already has the whole schema.
+# Data is moved with SQL written out in the migration rather than by calling the application, whose code and models
+# describe the latest schema and may no longer match the one a migration runs against.
+
+# Registered migrations as (version, description, function), in the order they were added
+MIGRATIONS = []
+
+
+# Error raised when a migration cannot be applied to the data in the database
+class MigrationError(Exception):
+    pass
+
+
+# Decorator that registers a function as the migration with the given version
+def migration(version, description):
+    def register(function):
+        MIGRATIONS.append((version, description, function))
+        return function
+    return register
+
+
+# Function to quote a table, column or index name for the database in use, e.g. "user" is a reserved word in PostgreSQL
+def quote(name):
+    return db.session.get_bind().dialect.identifier_preparer.quote(name)
+
+
+# Function to create an index unless it already exists
+def create_index(name, table, columns, unique=False):
+    db.session.execute(text(
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {quote(name)} ON {quote(table)} ({', '.join(quote(column) for column in columns)})"
+    ))
+
+
+# Function to add a column to a table unless it already has it
+def add_column(table, column, column_type):
+    if column not in {existing['name'] for existing in inspect(db.session.connection()).get_columns(table)}:
+        db.session.execute(text(f'ALTER TABLE {quote(table)} ADD COLUMN {quote(column)} {column_type}'))
+
+
+@migration(1, 'Index the ledger for keyset paging and balance snapshots')
+def index_ledger():
+    create_index('ix_transactions_datetime_id', 'transactions', ['dateTime', 'id'])
+    create_index('ix_transactions_account_id_id', 'transactions', ['account_id', 'id'])
+    create_index('ix_balance_snapshot_account_transaction', 'balance_snapshot', ['account_id', 'transaction_id'])
+
+
+@migration(2, 'Make user names unique')
+def unique_user_names():
+    # A unique index cannot be built over duplicates, so list them rather than rename anyone's login
+    duplicates = (
+        db.session.query(User.user_name)
+        .filter(User.user_name.isnot(None))
+        .group_by(User.user_name)
+        .having(func.count(User.id) > 1)
+        .all()
+    )
+    if duplicates:
+        raise MigrationError('these user names are used more than once and must be changed first: ' + ', '.join(name for (name,) in duplicates))
+    create_index('ix_user_user_name', 'user', ['user_name'], unique=True)
+
+
+@migration(3, 'Index foreign keys and lookup columns')
+def index_foreign_keys():
+    # Transactions.account_id is covered by ix_transactions_account_id_id and JoinRequest.class_id by ix_join_request_class_status
+    create_index('ix_transactions_from_account_id', 'transactions', ['from_account_id'])
+    create_index('ix_transactions_to_account_id', 'transactions', ['to_account_id'])
+    create_index('ix_transactions_coupon_id', 'transactions', ['coupon_id'])
+    create_index('ix_coupon_student_id', 'coupon', ['student_id'])
+    create_index('ix_user_role_id', 'user', ['role_id'])
+    create_index('ix_account_user_id', 'account', ['user_id'])
+    create_index('ix_class_teacher_id', 'class', ['teacher_id'])
+    create_index('ix_join_request_class_status', 'join_request', ['class_id', 'status'])
+    create_index('ix_student_class_class_id', 'student_class', ['class_id'])
+
+
+@migration(4, 'Record the class and year group of awards and build the points rollups')
+def points_rollups():
+    add_column('transactions', 'class_id', 'INTEGER')
+    add_column('transactions', 'year_group', 'INTEGER')
+    create_index('ix_transactions_class_id', 'transactions', ['class_id'])
+    # The rollup tables themselves are created by db.create_all(), fill them from the ledger recorded so far.
+    # Awards are positive ledger rows and purchases negative ones, both recorded against the student's account
+    for rollup in ('student_points', 'class_points', 'year_group_points'):
+        db.session.execute(text(f'DELETE FROM {quote(rollup)}'))
+    # The ledger already holds the postings of any rollup jobs still queued, so they are dropped rather than counted twice
+    db.session.execute(text(f"DELETE FROM {quote('job')} WHERE kind = 'points_rollups'"))
+    db.session.execute(text(
+        f"INSERT INTO {quote('student_points')} (student_id, points_earned, points_spent, awards) "
+        f"SELECT a.user_id, "
+        f"COALESCE(SUM(CASE WHEN t.amount > 0 THEN t.amount ELSE 0 END), 0), "
+        f"COALESCE(SUM(CASE WHEN t.amount < 0 THEN -t.amount ELSE 0 END), 0), "
+        f"COALESCE(SUM(CASE WHEN t.amount > 0 THEN 1 ELSE 0 END), 0) "
+        f"FROM {quote('account')} a JOIN {quote('transactions')} t ON t.account_id = a.id JOIN {quote('user')} u ON u.id = a.user_id "
+        f"GROUP BY a.user_id"
+    ))
+    for rollup, key in (('class_points', 'class_id'), ('year_group_points', 'year_group')):
+        db.session.execute(text(
+            f"INSERT INTO {quote(rollup)} ({key}, points_awarded, awards) "
+            f"SELECT {key}, SUM(amount), COUNT(id) FROM {quote('transactions')} "
+            f"WHERE {key} IS NOT NULL AND amount > 0 GROUP BY {key}"
+        ))
+
+
+@migration(5, 'Store the expiry and status of coupons')
+def coupon_expiry():
+    add_column('coupon', 'status', "VARCHAR(20) NOT NULL DEFAULT 'active'")
+    add_column('coupon', 'expires_at', 'TIMESTAMP')
+    create_index('ix_coupon_student_status', 'coupon', ['student_id', 'status'])
+    create_index('ix_coupon_status_expires_at', 'coupon', ['status', 'expires_at'])
+    # The (student_id, status) index starts with student_id, so the index on student_id alone is no longer needed
+    db.session.execute(text(f"DROP INDEX IF EXISTS {quote('ix_coupon_student_id')}"))
+    # Redeemed coupons expire two days after they were redeemed, set for every one of them in one UPDATE
+    coupon = table('coupon', column('redeemed'), column('redeem_date'), column('status'), column('expires_at'))
+    db.session.execute(
+        update(coupon)
+        .where(coupon.c.redeemed == True, coupon.c.redeem_date.isnot(None), coupon.c.expires_at.is_(None))
+        .values(status='redeemed', expires_at=add_days(coupon.c.redeem_date, 2))
+    )
+    # A coupon marked redeemed without a date cannot be checked by staff, so it is expired straight away
+    db.session.execute(update(coupon).where(coupon.c.redeemed == True, coupon.c.status == 'active').values(status='expired'))
+    # Coupons already past their expiry are expired now, later ones by the sweep job the worker queues when it starts
+    db.session.execute(
+        update(coupon).where(coupon.c.status == 'redeemed', coupon.c.expires_at <= datetime.utcnow()).values(status='expired')
+    )
+    # Every student's coupon list may have changed, so every ETag is invalidated through the epoch stamp, creating it if
+    # nothing has bumped it yet
+    db.session.execute(upsert_add(EntityVersion, ['entity'], ['version']), [{'entity': 'epoch', 'version': 1}])
+
+
+# Function to get the versions already applied to this database
+def applied_versions():
+    return {version for (version,) in db.session.query(SchemaVersion.version)}
+
+
+# Function to apply every migration that has not run yet, each in its own transaction, returning the ones applied
+def migrate():
+    applied = applied_versions()
+    ran = []
+    for version, description, function in sorted(MIGRATIONS, key=lambda entry: entry[0]):
+        if version in applied:
+            continue
+        try:
+            function()
+            db.session.add(SchemaVersion(version=version, description=description, applied_at=datetime.utcnow()))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ran.append((version, description))
+    return ran
+
+
+# The lookups behind the busiest pages in auth.py, run once each so the check sees the exact SQL the application sends
+HOT_QUERIES = [
+    ('login by email', lambda: User.query.filter_by(email='hot@query').first()),
+    ('user name lookup', lambda: User.query.filter_by(user_name='HOTQUERY').first()),
+    ('teacher role requests', lambda: User.query.filter(User.role_id == roles.id('teacher'), User.role_request == True).all()),
+    ('admin ledger page', lambda: ledger.ledger_page({})),
+    ('admin ledger for one account', lambda: ledger.ledger_page({'account_id': 1})),
+    ('account balance', lambda: ledger.current_balance(1)),
+    ('dashboard account', lambda: Account.query.filter_by(user_id=1).first()),
+    ('dashboard coupons', lambda: coupons.live_coupons(1)),
+    ('coupon verification', lambda: coupons.verify_code('HOTQUERY')),
+    ('coupons due to expire', lambda: db.session.query(Coupon.student_id).filter(Coupon.status == 'redeemed', Coupon.expires_at <= datetime.utcnow()).distinct().all()),
+    ('coupon transaction', lambda: Transactions.query.filter_by(coupon_id=1).first()),
+    ('awards given by a teacher', lambda: Transactions.query.filter_by(from_account_id=1).all()),
+    ('awards received by a student', lambda: Transactions.query.filter_by(to_account_id=1).all()),
+    ('teacher classes', lambda: Class.query.filter_by(teacher_id=1).all()),
+    ('teacher join requests', lambda: catalogue.teacher_join_requests(1, ['pending'])),
+    ('pending request counts', lambda: catalogue.pending_request_counts(1)),
+    ('student join statuses', lambda: catalogue.join_statuses(1)),
+    ('existing join request', lambda: JoinRequest.query.filter_by(student_id=1, class_id=1).first()),
+    ('students of a class', lambda: db.session.execute(bulk_targets(class_id=1)).all()),
+    ('student leaderboard', lambda: rollups.top_students()),
+    ('class leaderboard', lambda: rollups.top_classes()),
+    ('year group leaderboard', lambda: rollups.top_year_groups()),
+    ('next due job', lambda: db.session.query(Job.kind).filter(Job.status == 'queued', Job.run_at <= datetime.utcnow()).order_by(Job.run_at, Job.id).first()),
+]
+
+# Plan lines that read a whole table without an index, for SQLite ("SCAN user") and PostgreSQL ("Seq Scan on user")
+FULL_SCAN = re.compile(r'^\s*(?:->\s*)?(?:SCAN (?:TABLE )?(\S+)(?: AS \S+)?$|Seq Scan on (\S+))')
+
+
+# Function to get the plan lines of a statement as the database would run it
+def query_plan(statement, parameters):
+    prefix = 'EXPLAIN QUERY PLAN ' if db.session.get_bind().dialect.name == 'sqlite' else 'EXPLAIN '
+    return [row[-1] for row in db.session.connection().exec_driver_sql(prefix + statement, parameters)]
+
+
+# Function to run every hot query and return (name, plan lines, tables read in full) for each SELECT it sent
+def explain_hot_queries():
+    engine = db.session.get_bind()
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    results = []
+    for name, run in HOT_QUERIES:
+        statements.clear()
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            run()
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+        for statement, parameters in list(statements):
+            plan = query_plan(statement, parameters)
+            scanned = [match.group(1) or match.group(2) for match in map(FULL_SCAN.match, plan) if match]
+            results.append((name, plan, scanned))
+    db.session.rollback()
+    return results
+
+
+# Command to apply the pending migrations to the database, then check the hot queries against the new schema
+@click.command('migrate')
+@click.option('--status', is_flag=True, help='Only list the migrations and whether they have been applied.')
+@with_appcontext
+def migrate_command(status):
+    if status:
+        applied = applied_versions()
+        for version, description, _ in sorted(MIGRATIONS, key=lambda entry: entry[0]):
+            click.echo(f"{version:4} {'applied' if version in applied else 'pending':8} {description}")
+        return
+    try:
+        ran = migrate()
+    except MigrationError as error:
+        raise click.ClickException(str(error))
+    for version, description in ran:
+        click.echo(f'applied {version}: {description}')
+    click.echo(f'{len(ran)} migrations applied, the database is at version {max(applied_versions(), default=0)}')
+    scans = [(name, scanned) for name, _, scanned in explain_hot_queries() if scanned]
+    for name, scanned in scans:
+        click.echo(f"warning: {name} still reads {', '.join(scanned)} in full", err=True)
+
+
+# Command to print the query plan of every hot query, failing if any of them reads a whole table
+@click.command('explain-hot-queries')
+@with_appcontext
+def explain_hot_queries_command():
+    failures = 0
+    for name, plan, scanned in explain_hot_queries():
+        click.echo(f"{'FULL SCAN' if scanned else 'ok':9} {name}")
+        for line in plan:
+            click.echo(f'          {line}')
+        failures += bool(scanned)
+    if failures:
+        raise click.ClickException(f'{failures} hot queries read a whole table')
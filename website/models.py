@@ -1,8 +1,7 @@
 from . import db
+from .roles import roles
 from flask_login import UserMixin
 from datetime import datetime, timedelta
-import random
-import string
 
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -14,8 +13,8 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(255))
     first_name = db.Column(db.String(25))
     last_name = db.Column(db.String(25))
-    user_name = db.Column(db.String(25))
-    role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
+    user_name = db.Column(db.String(25), unique=True, index=True)
+    role_id = db.Column(db.Integer, db.ForeignKey('role.id'), index=True)
     role = db.relationship('Role', backref=db.backref('users', lazy=True))
     role_approved = db.Column(db.Boolean, default=False)
     role_request = db.Column(db.Boolean, default=False)
@@ -23,35 +22,44 @@ class User(db.Model, UserMixin):
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
     account = db.relationship('Account', backref='owner', lazy=True, uselist=False, foreign_keys=[account_id])
     weekly_point_limit = db.Column(db.Integer, default=100)
+    # Superseded by TeacherQuota, only read to carry over points awarded before quota rows existed
     last_award_date = db.Column(db.Date)
     points_awarded_this_week = db.Column(db.Integer, default=0)
 
-
-    @property
-    def remaining_points(self):
-        today = datetime.utcnow().date()
-        if self.last_award_date and self.last_award_date.isocalendar()[1] == today.isocalendar()[1]:
-            return max(self.weekly_point_limit - self.points_awarded_this_week, 0)
-        else:
-            return self.weekly_point_limit
-
-    @property
-    def points_awarded_percentage(self):
-        return int(self.points_awarded_this_week / self.weekly_point_limit * 100)
-
-    @property
-    def remaining_point_percentage(self):
-        return int(self.remaining_points / self.weekly_point_limit * 100)
-
+    # Role checks use the in-process role registry instead of loading self.role
     def is_admin(self):
-        return self.role.name == 'admin'
+        return roles.name(self.role_id) == 'admin'
     
     def is_teacher(self):
-        return self.role.name == 'teacher'
+        return roles.name(self.role_id) == 'teacher'
+
+    def is_student(self):
+        return roles.name(self.role_id) == 'student'
+
+class SchemaVersion(db.Model):
+    # One row per migration applied to this database, see migrations.py
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False)
+
+class TeacherQuota(db.Model):
+    # Points a teacher has awarded in one ISO week, and the limit for that week
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    iso_year = db.Column(db.Integer, primary_key=True)
+    iso_week = db.Column(db.Integer, primary_key=True)
+    point_limit = db.Column(db.Integer, nullable=False)
+    points_awarded = db.Column(db.Integer, nullable=False, default=0)
+
+class NameCounter(db.Model):
+    # The kind of name, e.g. 'user_name', and the prefix the suffixes are counted for
+    kind = db.Column(db.String(20), primary_key=True)
+    prefix = db.Column(db.String(100), primary_key=True)
+    # The last suffix handed out, where 0 means the bare prefix
+    last_suffix = db.Column(db.Integer, nullable=False)
 
 class Account(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     user = db.relationship('User', foreign_keys=[user_id], backref=db.backref('account_ref', lazy=True), uselist=False)
     balance = db.Column(db.Integer)
     points_awarded = db.Column(db.Integer, default=0)
@@ -60,16 +68,81 @@ class Account(db.Model, UserMixin):
 class Transactions(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     sequence = db.Column(db.Integer)
-    from_account_id = db.Column(db.Integer)
+    from_account_id = db.Column(db.Integer, index=True)
     dateTime = db.Column(db.DateTime)
-    to_account_id = db.Column(db.Integer)
+    to_account_id = db.Column(db.Integer, index=True)
     amount = db.Column(db.Integer)
     code = db.Column(db.String(8), nullable=True)
     account_id = db.Column(db.Integer, db.ForeignKey('account.id'))
-    coupon_id = db.Column(db.Integer, db.ForeignKey('coupon.id'))
+    coupon_id = db.Column(db.Integer, db.ForeignKey('coupon.id'), index=True)
     coupon = db.relationship('Coupon', backref=db.backref('transactions', lazy=True))
     date_redeemed = db.Column(db.DateTime)
+    # The class and year group an award was made to, so the points rollups can be rebuilt from the ledger
+    class_id = db.Column(db.Integer, db.ForeignKey('class.id'), index=True)
+    year_group = db.Column(db.Integer)
+    # Index used by the keyset paginated admin ledger, which orders by (dateTime, id)
+    # Index used to sum an account's ledger tail after its latest balance snapshot
+    __table_args__ = (
+        db.Index('ix_transactions_datetime_id', 'dateTime', 'id'),
+        db.Index('ix_transactions_account_id_id', 'account_id', 'id'),
+    )
     
+class BalanceSnapshot(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    # The id of the last Transactions row included in the balance
+    transaction_id = db.Column(db.Integer, nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.Index('ix_balance_snapshot_account_transaction', 'account_id', 'transaction_id'),)
+
+class StudentPoints(db.Model):
+    # Running totals of the points each student has earned and spent, kept up to date by the posting service
+    student_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    points_earned = db.Column(db.Integer, nullable=False, default=0)
+    points_spent = db.Column(db.Integer, nullable=False, default=0)
+    awards = db.Column(db.Integer, nullable=False, default=0)
+    # Index used to read the leaderboard's top students without sorting
+    __table_args__ = (db.Index('ix_student_points_leaderboard', 'points_earned', 'student_id'),)
+
+class ClassPoints(db.Model):
+    # Running totals of the points awarded in each class
+    class_id = db.Column(db.Integer, db.ForeignKey('class.id'), primary_key=True)
+    points_awarded = db.Column(db.Integer, nullable=False, default=0)
+    awards = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_class_points_leaderboard', 'points_awarded', 'class_id'),)
+
+class YearGroupPoints(db.Model):
+    # Running totals of the points awarded in each year group
+    year_group = db.Column(db.Integer, primary_key=True)
+    points_awarded = db.Column(db.Integer, nullable=False, default=0)
+    awards = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_year_group_points_leaderboard', 'points_awarded', 'year_group'),)
+
+class EntityVersion(db.Model):
+    # Version stamp of the data behind an API response, bumped by every write to it, see versions.py
+    entity = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class Job(db.Model):
+    # Work queued by a route to be done off the request path by 'flask worker', see jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(64), nullable=False)
+    # Arguments of the job as JSON
+    payload = db.Column(db.Text, nullable=False)
+    # queued, running or failed, jobs are deleted once they are done
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # A job is not picked up before run_at, which is pushed back after each failed attempt
+    run_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    # The worker holding a running job and when it took it, so the jobs of a worker that died can be taken back
+    locked_by = db.Column(db.String(64))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    # Index used by the worker to find the jobs that are due, oldest first
+    __table_args__ = (db.Index('ix_job_status_run_at', 'status', 'run_at'),)
+
 class TeacherRequestHistory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -86,9 +159,18 @@ class Subject(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True)
 
+# Function to build the display name of a class from the year group, subject initial and teacher's initials
+def class_display_name(year_group, subject_name, first_name, last_name):
+    subject_initial = subject_name[0].upper() if subject_name else ''
+    teacher_first_name_initial = first_name[0].upper() if first_name else ''
+    teacher_last_name_initial = last_name[0].upper() if last_name else ''
+    return f"{year_group}{subject_initial}{teacher_first_name_initial}{teacher_last_name_initial}"
+
 student_class = db.Table('student_class',
     db.Column('student_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('class_id', db.Integer, db.ForeignKey('class.id'), primary_key=True)
+    db.Column('class_id', db.Integer, db.ForeignKey('class.id'), primary_key=True),
+    # The primary key starts with student_id, so looking up the students of a class needs its own index
+    db.Index('ix_student_class_class_id', 'class_id')
 )
 
 class Class(db.Model):
@@ -97,15 +179,12 @@ class Class(db.Model):
     subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'))
     subject = db.relationship('Subject', backref=db.backref('classes', lazy=True))
     year_group = db.Column(db.Integer)
-    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    teacher_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     teacher = db.relationship('User', backref=db.backref('classes', lazy=True))
-    students = db.relationship('User', secondary=student_class, lazy='subquery',backref=db.backref('enrolled_classes', lazy=True))
+    students = db.relationship('User', secondary=student_class, lazy=True, backref=db.backref('enrolled_classes', lazy=True))
     
     def class_name(self):
-        subject_initial = self.subject.name[0].upper() if self.subject.name else ''
-        teacher_first_name_initial = self.teacher.first_name[0].upper() if self.teacher.first_name else ''
-        teacher_last_name_initial = self.teacher.last_name[0].upper() if self.teacher.last_name else ''
-        return f"{self.year_group}{subject_initial}{teacher_first_name_initial}{teacher_last_name_initial}"
+        return class_display_name(self.year_group, self.subject.name, self.teacher.first_name, self.teacher.last_name)
     
 
 
@@ -116,7 +195,11 @@ class JoinRequest(db.Model):
     class_id = db.Column(db.Integer, db.ForeignKey('class.id'), nullable=False)
     class_ = db.relationship('Class', backref=db.backref('join_requests', lazy=True))
     status = db.Column(db.String(20), nullable=False)
-    __table_args__ = (db.UniqueConstraint('student_id', 'class_id'),)
+    # Index used to find a teacher's join requests by class and status
+    __table_args__ = (db.UniqueConstraint('student_id', 'class_id'), db.Index('ix_join_request_class_status', 'class_id', 'status'))
+
+# How long a redeemed coupon can be shown to staff before it expires
+REDEEMED_COUPON_LIFETIME = timedelta(days=2)
 
 class Coupon(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -128,6 +211,11 @@ class Coupon(db.Model):
     code = db.Column(db.String(8), nullable=True, unique=True)
     redeemed = db.Column(db.Boolean, nullable=False, default=False)
     redeem_date = db.Column(db.DateTime)
+    # active until redeemed, redeemed until expires_at, then expired by the sweep in coupons.py
+    status = db.Column(db.String(20), nullable=False, default='active', server_default='active')
+    expires_at = db.Column(db.DateTime)
+    # Indexes used to list a student's live coupons, which also serves lookups by student alone, and to find the redeemed coupons due to expire
+    __table_args__ = (db.Index('ix_coupon_student_status', 'student_id', 'status'), db.Index('ix_coupon_status_expires_at', 'status', 'expires_at'))
 
 
     def __init__(self, student_id, name, description, points_cost, code=None, redeemed=False, redeem_date=None):
@@ -140,20 +228,24 @@ class Coupon(db.Model):
         self.redeem_date = redeem_date
 
     def generate_code(self):
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        while Coupon.query.filter_by(code=code).first() is not None:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        return code
+        # Claim a pre-generated code from the pool, or None if the pool is empty, imported here to avoid a circular import
+        from .coupons import claim_code
+        return claim_code()
 
     def redeem(self):
         self.redeemed = True
         self.redeem_date = datetime.utcnow()
+        self.status = 'redeemed'
+        self.expires_at = self.redeem_date + REDEEMED_COUPON_LIFETIME
 
     @property
     def is_expired(self):
-        if self.redeem_date is None:
-            return False
-        return (datetime.utcnow() - self.redeem_date) > timedelta(days=2)
+        # A coupon past expires_at counts as expired even before the sweep has marked it
+        return self.status == 'expired' or (self.expires_at is not None and self.expires_at <= datetime.utcnow())
 
     def __repr__(self):
-        return f'<Coupon {self.name}>'
\ No newline at end of file
+        return f'<Coupon {self.name}>'
+
+class CouponCode(db.Model):
+    # Pool of pre-generated unique coupon codes that have not been issued yet, a code is issued by deleting its row
+    code = db.Column(db.String(8), primary_key=True)
\ No newline at end of file
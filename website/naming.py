@@ -0,0 +1,78 @@
+from . import db
+from .models import User, Class, NameCounter
+from .sql import insert_ignore, all_digits
+from sqlalchemy import select, update, func, cast, Integer
+
+# Names are allocated as the bare prefix first, then prefix1, prefix2, ... using a counter row per prefix.
+# Bumping the counter is a single UPDATE, which locks the row until the caller commits, so concurrent
+# allocations for the same prefix never get the same suffix and no probing of the named table is needed.
+
+
+# Function to get the highest suffix already used for a prefix, for names created before the counter existed, worked out
+# in SQL so no names are loaded. The bare prefix counts as suffix 0, and -1 means the prefix is unused
+def highest_suffix(column, prefix):
+    suffix = func.substr(column, len(prefix) + 1)
+    highest = db.session.query(func.max(cast(suffix, Integer))).filter(column.like(prefix + '%'), all_digits(suffix)).scalar()
+    if highest is not None:
+        return highest
+    return 0 if db.session.query(column).filter(column == prefix).first() is not None else -1
+
+
+# Function to reserve count consecutive suffixes for a prefix, returning them as a range
+def reserve_suffixes(kind, column, prefix, count=1):
+    bump = (
+        update(NameCounter)
+        .where(NameCounter.kind == kind, NameCounter.prefix == prefix)
+        .values(last_suffix=NameCounter.last_suffix + count)
+        .execution_options(synchronize_session=False)
+    )
+    if db.session.execute(bump).rowcount == 0:
+        # First use of this prefix, so start counting after any names that already exist
+        db.session.execute(insert_ignore(NameCounter).values(kind=kind, prefix=prefix, last_suffix=highest_suffix(column, prefix)))
+        db.session.execute(bump)
+    last_suffix = db.session.execute(select(NameCounter.last_suffix).where(NameCounter.kind == kind, NameCounter.prefix == prefix)).scalar_one()
+    return range(last_suffix - count + 1, last_suffix + 1)
+
+
+# Function to join a prefix and a suffix into a name, the first name for a prefix has no suffix
+def with_suffix(prefix, suffix):
+    return prefix if suffix == 0 else prefix + str(suffix)
+
+
+# Function to get the username prefix for a person, the first three letters of their first and last names
+def username_prefix(first_name, last_name):
+    return first_name[:3].lower() + last_name[:3].lower()
+
+
+# Function to allocate a unique name for each prefix in a list, with one counter bump per distinct prefix
+def allocate_names(kind, column, prefixes):
+    counts = {}
+    for prefix in prefixes:
+        counts[prefix] = counts.get(prefix, 0) + 1
+    suffixes = {prefix: iter(reserve_suffixes(kind, column, prefix, count)) for prefix, count in counts.items()}
+    return [with_suffix(prefix, next(suffixes[prefix])) for prefix in prefixes]
+
+
+# Function to allocate unique usernames for a list of (first_name, last_name) pairs
+def allocate_usernames(names):
+    return allocate_names('user_name', User.user_name, [username_prefix(first_name, last_name) for first_name, last_name in names])
+
+
+# Function to allocate one unique username
+def allocate_username(first_name, last_name):
+    return allocate_usernames([(first_name, last_name)])[0]
+
+
+# Function to get the class name prefix, the year group followed by the subject's initial and the teacher's initials
+def class_name_prefix(year_group, subject_name, first_name, last_name):
+    return f"{year_group}{subject_name[0]}{first_name[0]}{last_name[0]}"
+
+
+# Function to allocate unique class names for a list of prefixes
+def allocate_class_names(prefixes):
+    return allocate_names('class_name', Class.name, prefixes)
+
+
+# Function to allocate one unique class name
+def allocate_class_name(prefix):
+    return allocate_class_names([prefix])[0]
@@ -0,0 +1,27 @@
+# The password rules shared by sign up and the roster import
+
+
+# Function to calculate password strength
+def password_strength(password):
+    score = 0
+    if len(password) >= 8:
+        score += 1
+    if any(char.isdigit() for char in password):
+        score += 1
+    if any(char.isupper() for char in password):
+        score += 1
+    if any(char in set(r"!@#$%^&*()/") for char in password):
+        score += 1
+    if score >= 4:
+        return score, "Password is strong."
+    else:
+        missing_requirements = []
+        if len(password) < 8:
+            missing_requirements.append("Password must be at least 8 characters.")
+        if not any(char.isdigit() for char in password):
+            missing_requirements.append("Password must contain at least one digit.")
+        if not any(char.isupper() for char in password):
+            missing_requirements.append("Password must contain at least one uppercase letter.")
+        if not any(char in set(r"!@#$%^&*()/") for char in password):
+            missing_requirements.append("Password must contain at least one symbol (!@#$%^&*()/).")
+        return score, ", ".join(missing_requirements)
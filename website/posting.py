@@ -0,0 +1,217 @@
+from . import db
+from .roles import roles
+from . import quota, rollups, versions, coupons
+from .models import User, Account, Transactions, Class, Coupon, student_class
+from sqlalchemy import insert, select, update, literal, Integer
+from datetime import datetime
+
+
+# Error raised when a posting cannot be applied, the message is shown to the user
+class PostingError(Exception):
+    pass
+
+
+# Function to charge awarded points to a teacher's weekly quota and lifetime total, raising an error if over the limit
+def charge_teacher(teacher_id, points, today):
+    # Add the points to the teacher's quota for this ISO week, failing if it would go over their limit
+    if not quota.charge(teacher_id, points, today):
+        raise PostingError('You do not have enough points to award.')
+
+    # Add the points to the teacher's lifetime total
+    db.session.execute(
+        update(Account)
+        .where(Account.user_id == teacher_id)
+        .values(points_awarded=Account.points_awarded + points)
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Function to get the id of the teacher whose classes an award is limited to, or None for an admin, who may award to any class
+def owner_filter(teacher):
+    return None if teacher.is_admin() else teacher.id
+
+
+# Function to check that a class exists and, unless the awarding user is an admin, that they teach it
+def check_class(teacher, class_id):
+    owner_id = db.session.query(Class.teacher_id).filter(Class.id == class_id).first()
+    if owner_id is None:
+        raise PostingError('Invalid class ID')
+    if owner_filter(teacher) not in (None, owner_id[0]):
+        raise PostingError('You can only award points to your own classes.')
+
+
+# Function to award points from a teacher to a student as one atomic batch of statements, optionally in one of the student's classes
+def post_award(teacher, student_id, points, class_id=None):
+    if points <= 0:
+        raise PostingError('The amount must be a positive number of points.')
+
+    now = datetime.utcnow()
+    try:
+        # Charge the points to the teacher first, so an award over the limit changes nothing
+        charge_teacher(teacher.id, points, now.date())
+
+        # The award only counts towards a class, and its year group, if the teacher teaches it and the student is enrolled in it
+        year_group = None
+        if class_id is not None:
+            check_class(teacher, class_id)
+            year_group = db.session.execute(
+                select(Class.year_group)
+                .join(student_class, student_class.c.class_id == Class.id)
+                .where(Class.id == class_id, student_class.c.student_id == student_id)
+            ).scalar()
+            if year_group is None:
+                class_id = None
+
+        # Add the points to the student's balance in the database rather than in Python, so concurrent awards are not lost
+        student_ids = select(User.id).where(User.id == student_id, User.role_id == roles.id('student')).scalar_subquery()
+        credit = (
+            update(Account)
+            .where(Account.user_id == student_ids)
+            .values(balance=Account.balance + points)
+            .execution_options(synchronize_session=False)
+        )
+        if db.session.execute(credit).rowcount != 1:
+            raise PostingError('Invalid student ID')
+
+        # Record the award in the Transactions ledger against the student's account
+        db.session.execute(
+            insert(Transactions).from_select(
+                ['sequence', 'from_account_id', 'dateTime', 'to_account_id', 'amount', 'account_id', 'class_id', 'year_group'],
+                select(literal(1), literal(teacher.id), literal(now), literal(student_id), literal(points), Account.id, literal(class_id, Integer), literal(year_group, Integer))
+                .where(Account.user_id == student_id),
+            )
+        )
+
+        # Queue the points for the student, class and year group rollups, the worker adds them off the request path
+        rollups.record_award([student_id], points, class_id, year_group)
+
+        # Both the student's balance and the teacher's quota have changed
+        versions.bump_ledger(student_id, teacher.id)
+
+        # Commit every change together, so the award is applied completely or not at all
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Function to build a query for the ids of the students enrolled in a class, or in any class of a year group.
+# Given a teacher_id, only the classes that teacher teaches count, so a teacher's year group award reaches their own classes
+def bulk_targets(class_id=None, year_group=None, teacher_id=None):
+    enrolled = select(student_class.c.student_id).join(Class, Class.id == student_class.c.class_id)
+    if class_id is not None:
+        enrolled = enrolled.where(Class.id == class_id)
+    elif year_group is not None:
+        enrolled = enrolled.where(Class.year_group == year_group)
+    else:
+        raise PostingError('Please choose a class or a year group.')
+    if teacher_id is not None:
+        enrolled = enrolled.where(Class.teacher_id == teacher_id)
+    return select(User.id).where(User.id.in_(enrolled), User.role_id == roles.id('student'))
+
+
+# Function to award the same number of points to every student in a class or year group in a few statements
+def post_bulk_award(teacher, points, class_id=None, year_group=None):
+    if points <= 0:
+        raise PostingError('The amount must be a positive number of points.')
+
+    now = datetime.utcnow()
+    try:
+        # A teacher can only award to a class they teach, or to their own classes in a year group
+        if class_id is not None:
+            check_class(teacher, class_id)
+        elif year_group is not None and owner_filter(teacher) is not None:
+            teaches = db.session.query(Class.id).filter(Class.year_group == year_group, Class.teacher_id == teacher.id).first()
+            if teaches is None:
+                raise PostingError('You do not teach any classes in that year group.')
+        targets = bulk_targets(class_id, year_group, owner_filter(teacher))
+
+        # Find the account of every targeted student in one query
+        accounts = db.session.execute(select(Account.id, Account.user_id).where(Account.user_id.in_(targets))).all()
+        if not accounts:
+            raise PostingError('There are no students to award points to.')
+
+        # Check and charge the teacher's quota once for the total
+        total = points * len(accounts)
+        charge_teacher(teacher.id, total, now.date())
+
+        # A class award also counts towards the class's year group
+        if class_id is not None:
+            year_group = db.session.query(Class.year_group).filter(Class.id == class_id).scalar()
+
+        # Credit every targeted account with a single UPDATE
+        credit = (
+            update(Account)
+            .where(Account.user_id.in_(targets))
+            .values(balance=Account.balance + points)
+            .execution_options(synchronize_session=False)
+        )
+        if db.session.execute(credit).rowcount != len(accounts):
+            raise PostingError('The class changed while awarding points, please try again.')
+
+        # Record one ledger row per student with a single executemany INSERT
+        db.session.execute(insert(Transactions), [
+            {'sequence': 1, 'from_account_id': teacher.id, 'dateTime': now, 'to_account_id': account.user_id, 'amount': points, 'account_id': account.id,
+             'class_id': class_id, 'year_group': year_group}
+            for account in accounts
+        ])
+
+        # Queue the points for the rollups of every student, and of the class and year group
+        rollups.record_award([account.user_id for account in accounts], points, class_id, year_group)
+        versions.bump_ledger(teacher.id, *(account.user_id for account in accounts))
+
+        # Commit every change together, so the award is applied completely or not at all
+        db.session.commit()
+        return len(accounts)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Function to let a student spend points on a reward, debiting their balance, issuing the coupon and recording the ledger row together
+def post_purchase(student, name, description, points):
+    now = datetime.utcnow()
+    pool_empty = False
+    try:
+        # Take the points off the balance only if the student can afford them, checked in the same statement
+        debit = (
+            update(Account)
+            .where(Account.user_id == student.id, Account.balance >= points)
+            .values(balance=Account.balance - points)
+            .execution_options(synchronize_session=False)
+        )
+        if db.session.execute(debit).rowcount != 1:
+            raise PostingError('You do not have enough points to purchase this item')
+
+        # Claim a code from the pool, which is deleted in this transaction and so goes back if the purchase is rolled back
+        code = coupons.claim_code()
+        if code is None:
+            pool_empty = True
+            raise PostingError('Rewards are not available right now, please try again in a few minutes.')
+
+        # Issue the coupon and flush it to get its id for the ledger row
+        coupon = Coupon(student_id=student.id, name=name, description=description, points_cost=points, code=code)
+        db.session.add(coupon)
+        db.session.flush()
+
+        # Record the purchase in the Transactions ledger as a negative amount against the student's account
+        db.session.execute(
+            insert(Transactions).from_select(
+                ['sequence', 'from_account_id', 'dateTime', 'amount', 'account_id', 'coupon_id'],
+                select(literal(1), Account.id, literal(now), literal(-points), Account.id, literal(coupon.id)).where(Account.user_id == student.id),
+            )
+        )
+
+        # Queue the points for the student's spent total
+        rollups.record_purchase(student.id, points)
+        versions.bump_ledger(student.id)
+
+        # Commit every change together, so the purchase is applied completely or not at all
+        db.session.commit()
+        return coupon
+    except Exception:
+        db.session.rollback()
+        # Queue a fill straight away rather than waiting for the next scheduled one
+        if pool_empty:
+            coupons.schedule_fill()
+        raise
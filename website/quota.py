@@ -0,0 +1,109 @@
+from . import db
+from .models import User, TeacherQuota
+from .roles import roles
+from .sql import insert_ignore
+from sqlalchemy import select, update, case, func, literal, and_
+from flask.cli import with_appcontext
+from datetime import datetime, timedelta
+import click
+
+# Each teacher's weekly points are tracked in a TeacherQuota row per (teacher, ISO year, ISO week).
+# A new week simply has no row yet, so nothing has to be reset, and the limit is checked in the same UPDATE that charges it.
+
+
+# Function to get the (ISO year, ISO week) key of a date, so week 1 of one year is never mistaken for week 1 of another
+def week_key(day=None):
+    iso_year, iso_week, _ = (day or datetime.utcnow().date()).isocalendar()
+    return iso_year, iso_week
+
+
+# Function to get the roles that can award points and so have a weekly quota
+def awarding_role_ids():
+    return [roles.id('teacher'), roles.id('admin')]
+
+
+# Function to build the points a teacher awarded in the given week before quota rows existed, as recorded on the user
+def carried_over_points(key):
+    monday = datetime.fromisocalendar(key[0], key[1], 1).date()
+    in_week = and_(User.last_award_date >= monday, User.last_award_date < monday + timedelta(days=7))
+    return func.coalesce(case((in_week, User.points_awarded_this_week), else_=0), 0)
+
+
+# Function to build a SELECT of new quota rows for the given week, one per teacher matching the condition
+def new_quota_rows(key, condition):
+    iso_year, iso_week = key
+    return select(User.id, literal(iso_year), literal(iso_week), User.weekly_point_limit, carried_over_points(key)).where(condition)
+
+
+# Function to create the quota rows for a week that do not exist yet, for every teacher matching the condition
+def create_quota_rows(key, condition):
+    columns = ['teacher_id', 'iso_year', 'iso_week', 'point_limit', 'points_awarded']
+    return db.session.execute(insert_ignore(TeacherQuota).from_select(columns, new_quota_rows(key, condition))).rowcount
+
+
+# Function to charge points to a teacher's quota for the week of the given day, returning False if it would go over the limit
+def charge(teacher_id, points, day=None):
+    iso_year, iso_week = key = week_key(day)
+    charge_quota = (
+        update(TeacherQuota)
+        .where(
+            TeacherQuota.teacher_id == teacher_id, TeacherQuota.iso_year == iso_year, TeacherQuota.iso_week == iso_week,
+            TeacherQuota.points_awarded + points <= TeacherQuota.point_limit,
+        )
+        .values(points_awarded=TeacherQuota.points_awarded + points)
+        .execution_options(synchronize_session=False)
+    )
+    if db.session.execute(charge_quota).rowcount == 1:
+        return True
+    # The teacher may simply have no row for this week yet, so create it and try once more
+    if create_quota_rows(key, User.id == teacher_id):
+        return db.session.execute(charge_quota).rowcount == 1
+    return False
+
+
+# Function to create this week's quota row for every teacher with a single INSERT ... SELECT, meant to run at the start of each week
+def rollover(day=None):
+    created = create_quota_rows(week_key(day), User.role_id.in_(awarding_role_ids()))
+    db.session.commit()
+    return created
+
+
+# Function to build a query reporting the limit, points awarded and points remaining this week for every teacher, computed in SQL
+def quota_report_query(day=None):
+    iso_year, iso_week = key = week_key(day)
+    point_limit = func.coalesce(TeacherQuota.point_limit, User.weekly_point_limit)
+    points_awarded = func.coalesce(TeacherQuota.points_awarded, carried_over_points(key))
+    remaining = case((point_limit > points_awarded, point_limit - points_awarded), else_=0)
+    return (
+        db.session.query(
+            User.id.label('teacher_id'),
+            User.email,
+            User.first_name,
+            User.last_name,
+            point_limit.label('point_limit'),
+            points_awarded.label('points_awarded'),
+            remaining.label('remaining_points'),
+            (points_awarded * 100 / func.nullif(point_limit, 0)).label('points_awarded_percentage'),
+            (remaining * 100 / func.nullif(point_limit, 0)).label('remaining_point_percentage'),
+        )
+        .outerjoin(TeacherQuota, and_(TeacherQuota.teacher_id == User.id, TeacherQuota.iso_year == iso_year, TeacherQuota.iso_week == iso_week))
+        .filter(User.role_id.in_(awarding_role_ids()))
+    )
+
+
+# Function to get this week's quota for every teacher in one query
+def quota_report(day=None):
+    return quota_report_query(day).order_by(User.last_name, User.first_name).all()
+
+
+# Function to get this week's quota for one teacher in one query
+def teacher_quota(teacher_id, day=None):
+    return quota_report_query(day).filter(User.id == teacher_id).one()
+
+
+# Command to create this week's quota rows for every teacher, meant to be scheduled at the start of each week
+@click.command('rollover-quotas')
+@with_appcontext
+def rollover_quotas_command():
+    iso_year, iso_week = week_key()
+    click.echo(f'created {rollover()} quota rows for week {iso_week} of {iso_year}')
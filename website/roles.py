@@ -0,0 +1,37 @@
+from . import db
+
+
+# In-process registry of the Role table, mapping role names to ids so role checks need no queries
+class RoleRegistry:
+    def __init__(self):
+        self.ids_by_name = {}
+        self.names_by_id = {}
+
+    # Load the registry when the application starts
+    def init_app(self, app):
+        with app.app_context():
+            self.load()
+
+    # Read the whole Role table into memory
+    def load(self):
+        # Import here to avoid a circular import, as the models use the registry
+        from .models import Role
+        rows = db.session.query(Role.id, Role.name).all()
+        self.ids_by_name = {name: role_id for role_id, name in rows}
+        self.names_by_id = {role_id: name for role_id, name in rows}
+
+    # Get the id of the role with the given name, reloading once if it has been created since startup
+    def id(self, name):
+        if name not in self.ids_by_name:
+            self.load()
+        return self.ids_by_name.get(name)
+
+    # Get the name of the role with the given id, reloading once if it has been created since startup
+    def name(self, role_id):
+        if role_id is not None and role_id not in self.names_by_id:
+            self.load()
+        return self.names_by_id.get(role_id)
+
+
+# Initialize the role registry
+roles = RoleRegistry()
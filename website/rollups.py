@@ -0,0 +1,166 @@
+from . import db, jobs, ledger
+from .models import User, Account, Class, Transactions, StudentPoints, ClassPoints, YearGroupPoints, Job
+from .sql import upsert_add
+from sqlalchemy import select, insert, delete, func, case
+from flask.cli import with_appcontext
+import click
+import time
+
+# Points per student, class and year group are kept in rollup tables, so leaderboards and charts never scan the ledger.
+# The posting service queues each award and purchase as a rollup job in the same transaction as its ledger rows, and the
+# worker adds a whole batch of them to the rollups at once, see jobs.py. rebuild() recomputes the rollups from the ledger.
+# Only awards posted since the ledger recorded class_id and year_group count towards classes and years.
+
+# Number of entries shown on a leaderboard unless another limit is asked for, and the largest limit allowed
+LEADERBOARD_SIZE = 10
+MAX_LEADERBOARD_SIZE = 100
+
+# Kind of the jobs that add postings to the rollups
+ROLLUP_JOB = 'points_rollups'
+
+
+# Function to queue an award of points to each of the given students, and to the class and year group it was made in
+def record_award(student_ids, points, class_id=None, year_group=None):
+    jobs.enqueue(ROLLUP_JOB, {'student_ids': list(student_ids), 'earned': points, 'spent': 0, 'class_id': class_id, 'year_group': year_group})
+
+
+# Function to queue points a student has spent on a reward
+def record_purchase(student_id, points):
+    jobs.enqueue(ROLLUP_JOB, {'student_ids': [student_id], 'earned': 0, 'spent': points, 'class_id': None, 'year_group': None})
+
+
+# Job handler adding a batch of postings to the rollups, totalled in Python first so each row is written once per batch
+@jobs.handler(ROLLUP_JOB, batch_size=500)
+def apply_postings(postings):
+    students, classes, year_groups = {}, {}, {}
+    for posting in postings:
+        awards = 1 if posting['earned'] > 0 else 0
+        for student_id in posting['student_ids']:
+            totals = students.setdefault(student_id, {'student_id': student_id, 'points_earned': 0, 'points_spent': 0, 'awards': 0})
+            totals['points_earned'] += posting['earned']
+            totals['points_spent'] += posting['spent']
+            totals['awards'] += awards
+        if not awards:
+            continue
+        for group, key, value in ((classes, 'class_id', posting['class_id']), (year_groups, 'year_group', posting['year_group'])):
+            if value is not None:
+                totals = group.setdefault(value, {key: value, 'points_awarded': 0, 'awards': 0})
+                totals['points_awarded'] += posting['earned'] * len(posting['student_ids'])
+                totals['awards'] += len(posting['student_ids'])
+
+    # Rows are written in key order, so concurrent batches lock them in the same order
+    for model, key, add_columns, rows in (
+        (StudentPoints, 'student_id', ['points_earned', 'points_spent', 'awards'], students),
+        (ClassPoints, 'class_id', ['points_awarded', 'awards'], classes),
+        (YearGroupPoints, 'year_group', ['points_awarded', 'awards'], year_groups),
+    ):
+        if rows:
+            db.session.execute(upsert_add(model, [key], add_columns), [rows[value] for value in sorted(rows)])
+
+
+# Function to recompute every rollup from the ledger with one grouped INSERT ... SELECT per table, in one transaction
+def rebuild():
+    try:
+        # Hold off postings until the rebuild commits, so none can commit and queue its rollup job between dropping the
+        # queued jobs and reading the ledger, where it would be lost or counted twice
+        ledger.lock_ledger()
+        for model in (StudentPoints, ClassPoints, YearGroupPoints):
+            db.session.execute(delete(model))
+        # The ledger already holds the postings of the rollup jobs still queued, so they are dropped rather than counted twice
+        db.session.execute(delete(Job).where(Job.kind == ROLLUP_JOB))
+
+        # Awards are positive ledger rows and purchases negative ones, both recorded against the student's account
+        earned = func.coalesce(func.sum(case((Transactions.amount > 0, Transactions.amount), else_=0)), 0)
+        spent = func.coalesce(func.sum(case((Transactions.amount < 0, -Transactions.amount), else_=0)), 0)
+        awards = func.coalesce(func.sum(case((Transactions.amount > 0, 1), else_=0)), 0)
+        students = db.session.execute(insert(StudentPoints).from_select(
+            ['student_id', 'points_earned', 'points_spent', 'awards'],
+            select(Account.user_id, earned, spent, awards)
+            .join(Transactions, Transactions.account_id == Account.id)
+            .join(User, User.id == Account.user_id)
+            .group_by(Account.user_id),
+        )).rowcount
+
+        positive = Transactions.amount > 0
+        classes = db.session.execute(insert(ClassPoints).from_select(
+            ['class_id', 'points_awarded', 'awards'],
+            select(Transactions.class_id, func.sum(Transactions.amount), func.count(Transactions.id))
+            .where(Transactions.class_id.isnot(None), positive)
+            .group_by(Transactions.class_id),
+        )).rowcount
+        year_groups = db.session.execute(insert(YearGroupPoints).from_select(
+            ['year_group', 'points_awarded', 'awards'],
+            select(Transactions.year_group, func.sum(Transactions.amount), func.count(Transactions.id))
+            .where(Transactions.year_group.isnot(None), positive)
+            .group_by(Transactions.year_group),
+        )).rowcount
+
+        db.session.commit()
+        return students, classes, year_groups
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Function to clamp a requested leaderboard size to a sensible range
+def leaderboard_size(limit):
+    return max(1, min(limit or LEADERBOARD_SIZE, MAX_LEADERBOARD_SIZE))
+
+
+# Function to get the students who have earned the most points, reading only the top rows of the rollup's index
+def top_students(limit=LEADERBOARD_SIZE):
+    rows = (
+        db.session.query(StudentPoints.student_id, StudentPoints.points_earned, StudentPoints.awards, User.user_name, User.first_name, User.last_name)
+        .join(User, User.id == StudentPoints.student_id)
+        .order_by(StudentPoints.points_earned.desc(), StudentPoints.student_id.desc())
+        .limit(leaderboard_size(limit))
+    )
+    return [
+        {'id': row.student_id, 'name': f"{row.first_name or ''} {row.last_name or ''}".strip(), 'user_name': row.user_name,
+         'points': row.points_earned, 'awards': row.awards}
+        for row in rows
+    ]
+
+
+# Function to get the classes that have been awarded the most points
+def top_classes(limit=LEADERBOARD_SIZE):
+    rows = (
+        db.session.query(ClassPoints.class_id, ClassPoints.points_awarded, ClassPoints.awards, Class.name, Class.year_group)
+        .join(Class, Class.id == ClassPoints.class_id)
+        .order_by(ClassPoints.points_awarded.desc(), ClassPoints.class_id.desc())
+        .limit(leaderboard_size(limit))
+    )
+    return [
+        {'id': row.class_id, 'name': row.name, 'year_group': row.year_group, 'points': row.points_awarded, 'awards': row.awards}
+        for row in rows
+    ]
+
+
+# Function to get the year groups that have been awarded the most points
+def top_year_groups(limit=LEADERBOARD_SIZE):
+    rows = (
+        db.session.query(YearGroupPoints.year_group, YearGroupPoints.points_awarded, YearGroupPoints.awards)
+        .order_by(YearGroupPoints.points_awarded.desc(), YearGroupPoints.year_group.desc())
+        .limit(leaderboard_size(limit))
+    )
+    return [
+        {'id': row.year_group, 'name': f'Year {row.year_group}', 'points': row.points_awarded, 'awards': row.awards}
+        for row in rows
+    ]
+
+
+# Leaderboards by scope, as used by the leaderboard page and its chart data
+LEADERBOARDS = {
+    'students': top_students,
+    'classes': top_classes,
+    'year_groups': top_year_groups,
+}
+
+
+# Command to recompute the points rollups from the ledger, for example after importing old transactions
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    started = time.perf_counter()
+    students, classes, year_groups = rebuild()
+    click.echo(f'rebuilt points for {students} students, {classes} classes and {year_groups} year groups in {time.perf_counter() - started:.2f}s')
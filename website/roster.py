@@ -0,0 +1,205 @@
+from . import db, versions
+from .models import User, Account, Class, student_class
+from .roles import roles
+from .cache import cache
+from .naming import allocate_usernames
+from .passwords import password_strength
+from sqlalchemy import insert, update, select
+from concurrent.futures import ProcessPoolExecutor
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+import click
+import csv
+import os
+import time
+
+# Roles a roster can create
+ROSTER_ROLES = ('student', 'teacher')
+
+# Columns of the per-row error file
+ERROR_COLUMNS = ['line', 'email', 'error']
+
+# Number of rows inserted per executemany, and number of values looked up per IN query to stay below SQLite's bound parameter limit
+INSERT_BATCH_SIZE = 1000
+LOOKUP_CHUNK_SIZE = 900
+
+# Below this many passwords, starting worker processes costs more than it saves
+POOL_THRESHOLD = 500
+
+
+# Result of a roster import: the number of users created, the problems with the rows that were skipped, and the time taken
+class RosterResult:
+    def __init__(self, imported, errors, seconds):
+        self.imported = imported
+        self.errors = errors
+        self.seconds = seconds
+
+    @property
+    def rows_per_second(self):
+        return self.imported / self.seconds if self.seconds else 0
+
+
+# Function to split a list into lists of at most size items
+def chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+# Function to hash one password the same way sign-up does, at module level so worker processes can run it
+def hash_password(password):
+    return generate_password_hash(password, method='sha256')
+
+
+# Function to hash many passwords, spread over a pool of worker processes when there are enough of them
+def hash_passwords(passwords, workers=None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < POOL_THRESHOLD:
+        return [hash_password(password) for password in passwords]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(hash_password, passwords, chunksize=max(len(passwords) // (workers * 4), 1)))
+
+
+# Function to find the values of a column that are already in the database, one IN query per chunk
+def existing_values(column, values):
+    found = set()
+    for chunk in chunks(list(values), LOOKUP_CHUNK_SIZE):
+        found.update(value for (value,) in db.session.query(column).filter(column.in_(chunk)))
+    return found
+
+
+# Function to check one roster row, returning the list of problems with it
+def row_problems(row, known_classes):
+    problems = []
+    email = (row.get('email') or '').strip()
+    first_name = (row.get('first_name') or '').strip()
+    last_name = (row.get('last_name') or '').strip()
+    password = row.get('password') or ''
+    role = (row.get('role') or 'student').strip().lower()
+    if len(email) < 4 or '@' not in email:
+        problems.append('invalid email address')
+    if any(char.isdigit() for char in first_name + last_name) or len(first_name) < 2 or len(last_name) < 2:
+        problems.append('first name and last name must not contain numbers and should be at least 2 characters long')
+    if not 7 <= len(password) <= 25:
+        problems.append('password must be between 7 and 25 characters')
+    # The same rules as sign up, so an imported user's password is no weaker than one they could choose themselves
+    score, message = password_strength(password)
+    if score < 4:
+        problems.append(message)
+    if role not in ROSTER_ROLES:
+        problems.append(f'unknown role {role}')
+    class_names = [name.strip() for name in (row.get('classes') or '').split(';') if name.strip()]
+    if class_names and role != 'student':
+        problems.append('only students can be enrolled in classes')
+    problems.extend(f'unknown class {name}' for name in class_names if name not in known_classes)
+    return problems
+
+
+# Function to create the users in a roster with batched inserts in one transaction. Rows are dicts with email, first_name,
+# last_name, password, role (student or teacher, default student) and classes (class names separated by semicolons).
+# Rows with problems are skipped and reported instead of stopping the whole import.
+def import_roster(rows, workers=None):
+    started = time.perf_counter()
+    rows = list(rows)
+    try:
+        # Look up every email and class the roster mentions with one query per chunk
+        emails = {(row.get('email') or '').strip() for row in rows}
+        taken = existing_values(User.email, emails)
+        class_names = {name.strip() for row in rows for name in (row.get('classes') or '').split(';') if name.strip()}
+        known_classes = {}
+        for chunk in chunks(list(class_names), LOOKUP_CHUNK_SIZE):
+            known_classes.update(db.session.query(Class.name, Class.id).filter(Class.name.in_(chunk)))
+
+        # Check every row, keeping the ones that can be imported
+        errors = []
+        people = []
+        seen = set()
+        for line, row in enumerate(rows, start=2):
+            email = (row.get('email') or '').strip()
+            problems = row_problems(row, known_classes)
+            if email in taken:
+                problems.append('a user with this email address already exists')
+            elif email in seen:
+                problems.append('this email address is listed more than once')
+            if problems:
+                errors.extend({'line': line, 'email': email, 'error': problem} for problem in problems)
+                continue
+            seen.add(email)
+            people.append({
+                'email': email,
+                'first_name': row['first_name'].strip(),
+                'last_name': row['last_name'].strip(),
+                'password': row['password'],
+                'role': (row.get('role') or 'student').strip().lower(),
+                'classes': [known_classes[name.strip()] for name in (row.get('classes') or '').split(';') if name.strip()],
+            })
+
+        if people:
+            # Hash the passwords in parallel and allocate every username with one counter bump per distinct prefix
+            hashes = hash_passwords([person['password'] for person in people], workers)
+            usernames = allocate_usernames([(person['first_name'], person['last_name']) for person in people])
+
+            for batch in chunks(list(zip(people, hashes, usernames)), INSERT_BATCH_SIZE):
+                db.session.execute(insert(User), [
+                    {
+                        'email': person['email'],
+                        'password': password_hash,
+                        'first_name': person['first_name'],
+                        'last_name': person['last_name'],
+                        'user_name': user_name,
+                        'role_id': roles.id(person['role']),
+                        # Staff imported by an admin are trusted, so teachers are approved straight away
+                        'role_approved': person['role'] == 'teacher',
+                    }
+                    for person, password_hash, user_name in batch
+                ])
+
+            # Read back the new ids, then create and link every account and enrolment with batched statements
+            user_ids = {}
+            for chunk in chunks([person['email'] for person in people], LOOKUP_CHUNK_SIZE):
+                user_ids.update(db.session.query(User.email, User.id).filter(User.email.in_(chunk)))
+            for batch in chunks(list(user_ids.values()), INSERT_BATCH_SIZE):
+                db.session.execute(insert(Account), [{'user_id': user_id, 'balance': 0, 'points_awarded': 0} for user_id in batch])
+            for chunk in chunks(list(user_ids.values()), LOOKUP_CHUNK_SIZE):
+                db.session.execute(
+                    update(User)
+                    .where(User.id.in_(chunk))
+                    .values(account_id=select(Account.id).where(Account.user_id == User.id).limit(1).scalar_subquery())
+                    .execution_options(synchronize_session=False)
+                )
+            enrolments = [{'student_id': user_ids[person['email']], 'class_id': class_id} for person in people for class_id in dict.fromkeys(person['classes'])]
+            for batch in chunks(enrolments, INSERT_BATCH_SIZE):
+                db.session.execute(insert(student_class), batch)
+
+            # The admin quota report lists every teacher
+            if any(person['role'] == 'teacher' for person in people):
+                versions.bump(versions.TEACHERS)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # The teacher and student lists shown on other pages now include the new users
+    cache.invalidate('teachers', 'students')
+    return RosterResult(len(people), errors, time.perf_counter() - started)
+
+
+# Function to write the problems found in a roster to a CSV file object
+def write_errors(errors, file):
+    writer = csv.DictWriter(file, fieldnames=ERROR_COLUMNS)
+    writer.writeheader()
+    writer.writerows(errors)
+
+
+# Command to create the students and teachers in a CSV roster with email, first_name, last_name, password, role and classes columns
+@click.command('import-roster')
+@click.argument('roster', type=click.File())
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False, writable=True), default='roster_errors.csv', show_default=True, help='File the problem rows are written to.')
+@click.option('--workers', type=int, default=None, help='Number of processes hashing passwords, defaults to the number of CPUs.')
+@with_appcontext
+def import_roster_command(roster, errors_path, workers):
+    result = import_roster(csv.DictReader(roster), workers)
+    click.echo(f'imported {result.imported} users in {result.seconds:.1f}s ({result.rows_per_second:.0f} rows/s)')
+    if result.errors:
+        with open(errors_path, 'w', newline='') as errors_file:
+            write_errors(result.errors, errors_file)
+        click.echo(f'{len(result.errors)} problems were written to {errors_path}')
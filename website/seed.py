@@ -0,0 +1,114 @@
+from . import db, versions
+from .models import Role, User, Account, Subject
+from .roles import roles
+from .cache import cache
+from .sql import insert_ignore
+from .naming import allocate_usernames
+from sqlalchemy import insert, select, update, exists, literal
+from flask.cli import with_appcontext
+from werkzeug.security import generate_password_hash
+import click
+import json
+
+# Roles, subjects and users that every installation needs
+DEFAULT_ROLES = ['admin', 'teacher', 'student']
+DEFAULT_SUBJECTS = ['Math', 'English', 'Science', 'History', 'Geography', 'Art', 'Physical Education', 'Music']
+DEFAULT_USERS = [
+    {'email': 'admin@Kimberley.com', 'password': 'secret', 'first_name': 'Admin', 'last_name': None, 'role': 'admin'},
+    {'email': 'teacher@Kimberley.com', 'password': 'secret', 'first_name': 'Teacher', 'last_name': 'LastName', 'role': 'teacher'},
+    {'email': 'student@Kimberley.com', 'password': 'secret', 'first_name': 'Student', 'last_name': 'LastName', 'role': 'student'},
+]
+
+
+# Function to give each new user with a last name a unique username
+def assign_usernames(people):
+    named = [person for person in people if person.get('last_name')]
+    for person, username in zip(named, allocate_usernames([(person['first_name'], person['last_name']) for person in named])):
+        person['user_name'] = username
+
+
+# Function to create the given roles, subjects and users if they do not exist yet, using set-based statements in one transaction
+def seed(subjects=(), people=()):
+    subjects = list(dict.fromkeys(DEFAULT_SUBJECTS + list(subjects)))
+    people = DEFAULT_USERS + list(people)
+    try:
+        # Create the roles and reload the role registry so the new ids are known
+        db.session.execute(insert_ignore(Role), [{'name': name} for name in DEFAULT_ROLES])
+        roles.load()
+
+        # Create the subjects
+        db.session.execute(insert_ignore(Subject), [{'name': name} for name in subjects])
+
+        # Only hash passwords and allocate usernames for the users that do not exist yet
+        emails = [person['email'] for person in people]
+        existing = {email for (email,) in db.session.query(User.email).filter(User.email.in_(emails))}
+        new_people = [dict(person) for person in people if person['email'] not in existing]
+        assign_usernames(new_people)
+        if new_people:
+            db.session.execute(insert_ignore(User), [
+                {
+                    'email': person['email'],
+                    'password': generate_password_hash(person['password'], method='sha256'),
+                    'first_name': person['first_name'],
+                    'last_name': person.get('last_name'),
+                    'user_name': person.get('user_name'),
+                    'role_id': roles.id(person['role']),
+                    # Staff loaded by the seed are trusted, so teachers are approved straight away
+                    'role_approved': person['role'] == 'teacher',
+                }
+                for person in new_people
+            ])
+
+        # Create an account for every seeded teacher and student that does not have one
+        has_account = exists().where(Account.user_id == User.id)
+        db.session.execute(insert(Account).from_select(
+            ['user_id', 'balance', 'points_awarded'],
+            select(User.id, literal(0), literal(0)).where(User.email.in_(emails), User.role_id != roles.id('admin'), ~has_account),
+        ))
+
+        # Link each seeded user to their account
+        db.session.execute(
+            update(User)
+            .where(User.email.in_(emails), User.account_id.is_(None))
+            .values(account_id=select(Account.id).where(Account.user_id == User.id).limit(1).scalar_subquery())
+            .execution_options(synchronize_session=False)
+        )
+
+        # The admin quota report lists every teacher
+        versions.bump(versions.TEACHERS)
+        db.session.commit()
+        # Other processes keep their cached copies until the entries expire, unless the cache is shared through Redis
+        cache.invalidate('subjects', 'teachers', 'students')
+        return len(new_people)
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Function to read a seed file, a JSON object with a list of subject names and a list of staff
+def load_seed_file(path):
+    with open(path) as seed_file:
+        data = json.load(seed_file)
+    subjects = data.get('subjects', [])
+    people = data.get('staff', [])
+    for person in people:
+        required = ['email', 'password', 'first_name', 'role']
+        # Teachers and students need a last name for their username, and a teacher's also goes into their class names
+        if person.get('role') != 'admin':
+            required.append('last_name')
+        missing = [key for key in required if not person.get(key)]
+        if missing:
+            raise click.BadParameter(f"staff entry {person.get('email', '?')} is missing {', '.join(missing)}")
+        if person['role'] not in DEFAULT_ROLES:
+            raise click.BadParameter(f"staff entry {person['email']} has unknown role {person['role']}")
+    return subjects, people
+
+
+# Command to create the default roles, users and subjects, plus any subjects and staff listed in a seed file
+@click.command('seed')
+@click.option('--file', 'seed_file', type=click.Path(exists=True, dir_okay=False), help='JSON file with "subjects" and "staff" lists.')
+@with_appcontext
+def seed_command(seed_file):
+    subjects, people = load_seed_file(seed_file) if seed_file else ([], [])
+    created = seed(subjects, people)
+    click.echo(f'roles and subjects are in place, created {created} new users')
@@ -0,0 +1,71 @@
+from . import db
+from sqlalchemy import insert, update, func, text, and_
+from datetime import timedelta
+
+
+# Function to build an INSERT that skips rows which would break a unique constraint (INSERT ... ON CONFLICT DO NOTHING)
+def insert_ignore(model):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return insert(model).prefix_with('IGNORE')
+    return dialect_insert(model).on_conflict_do_nothing()
+
+
+# Function to build an INSERT that adds the given columns onto an existing row with the same key instead of failing (an upsert)
+def upsert_add(model, key_columns, add_columns):
+    dialect = db.session.get_bind().dialect.name
+    table = model.__table__
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        statement = dialect_insert(model)
+        return statement.on_duplicate_key_update({column: table.c[column] + statement.inserted[column] for column in add_columns})
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    statement = dialect_insert(model)
+    return statement.on_conflict_do_update(index_elements=key_columns, set_={column: table.c[column] + statement.excluded[column] for column in add_columns})
+
+
+# Function to build a condition that a string expression is one or more digits and nothing else
+def all_digits(expression):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return and_(expression != '', expression.op('NOT GLOB')('*[^0-9]*'))
+    if dialect == 'mysql':
+        return expression.op('REGEXP')('^[0-9]+$')
+    return expression.op('~')('^[0-9]+$')
+
+# Function to build an expression adding a number of days to a date and time column, for date arithmetic in a single UPDATE
+def add_days(column, days):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'sqlite':
+        return func.datetime(column, f'+{int(days)} days')
+    if dialect == 'mysql':
+        return func.timestampadd(text('DAY'), int(days), column)
+    return column + timedelta(days=days)
+
+
+# Function to update the rows of a model from a named subquery (UPDATE ... FROM), setting each column in values to an
+# expression over the subquery's columns where every condition in where, including the join, holds. Returns the rows updated.
+# SQLAlchemy 1.4 only writes these for PostgreSQL and MySQL, so for SQLite, which has UPDATE ... FROM since 3.33, the
+# statement is put together from its compiled parts
+def update_from(model, source, values, where):
+    dialect = db.session.get_bind().dialect
+    if dialect.name != 'sqlite':
+        statement = update(model).where(*where).values(values).execution_options(synchronize_session=False)
+        return db.session.execute(statement).rowcount
+
+    def compiled(clause):
+        return str(clause.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+    quote = dialect.identifier_preparer.quote
+    assignments = ', '.join(f'{quote(column)} = {compiled(expression)}' for column, expression in values.items())
+    return db.session.execute(text(
+        f'UPDATE {quote(model.__tablename__)} SET {assignments} FROM ({compiled(source.element)}) AS {quote(source.name)} '
+        f"WHERE {' AND '.join(compiled(condition) for condition in where)}"
+    )).rowcount
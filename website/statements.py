@@ -0,0 +1,150 @@
+from . import db
+from .models import Transactions, Account, User, Coupon
+from .ledger import EXPORT_CHUNK_SIZE
+from sqlalchemy import case
+from flask.cli import with_appcontext
+from markupsafe import escape
+from datetime import datetime
+import click
+import csv
+import io
+import json
+
+# A statement lists an account's ledger rows oldest first, with the coupon bought by each purchase and the running balance.
+# Statements are read with one query ordered by (account_id, id), which follows ix_transactions_account_id_id, and the rows
+# are streamed from a server-side cursor so memory use does not grow with the length of the history.
+
+# Columns of every statement row, in the order they are exported
+STATEMENT_COLUMNS = ['account_id', 'user_name', 'first_name', 'last_name', 'transaction_id', 'dateTime', 'amount', 'balance', 'coupon_name', 'coupon_code', 'date_redeemed']
+
+# Style of the HTML statements, with each account starting on a new printed page
+STATEMENT_STYLE = '''
+body { font-family: sans-serif; font-size: 11pt; }
+section { page-break-after: always; }
+table { border-collapse: collapse; width: 100%; }
+th, td { border-bottom: 1px solid #ccc; padding: 4px; text-align: left; }
+'''
+
+
+# Function to build the statement query for one account, or every account if account_id is None, with coupons joined in
+def statement_query(account_id=None):
+    query = (
+        db.session.query(
+            Transactions.account_id,
+            User.user_name,
+            User.first_name,
+            User.last_name,
+            Transactions.id.label('transaction_id'),
+            Transactions.dateTime,
+            Transactions.amount,
+            Coupon.name.label('coupon_name'),
+            # Only show the code once the coupon has been redeemed, as on the dashboard
+            case((Coupon.redeemed == True, Coupon.code), else_=None).label('coupon_code'),
+            Transactions.date_redeemed,
+        )
+        .join(Account, Account.id == Transactions.account_id)
+        .outerjoin(User, User.id == Account.user_id)
+        .outerjoin(Coupon, Coupon.id == Transactions.coupon_id)
+    )
+    if account_id is not None:
+        query = query.filter(Transactions.account_id == account_id)
+    return query.order_by(Transactions.account_id, Transactions.id).yield_per(EXPORT_CHUNK_SIZE).execution_options(stream_results=True)
+
+
+# Generator that yields every statement row as a dictionary, with the running balance of its account
+def iter_statement_rows(account_id=None):
+    current_account = None
+    balance = 0
+    for row in statement_query(account_id):
+        if row.account_id != current_account:
+            current_account = row.account_id
+            balance = 0
+        balance += row.amount or 0
+        yield {name: balance if name == 'balance' else getattr(row, name) for name in STATEMENT_COLUMNS}
+
+
+# Function to convert a statement row into a dictionary of JSON friendly values
+def record_to_json(record):
+    return {name: value.isoformat() if isinstance(value, datetime) else value for name, value in record.items()}
+
+
+# Function to get one account's statement rows as a list, for pages that show the whole history
+def statement_rows(account_id):
+    return list(iter_statement_rows(account_id))
+
+
+# Generator that streams statements as CSV text, one header line followed by one line per row
+def export_csv(account_id=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(STATEMENT_COLUMNS)
+    for record in iter_statement_rows(account_id):
+        writer.writerow([record[name] for name in STATEMENT_COLUMNS])
+        # Flush the buffer once it holds a reasonable amount of text
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+# Generator that streams statements as JSON lines, one object per row
+def export_jsonl(account_id=None):
+    lines = []
+    for record in iter_statement_rows(account_id):
+        lines.append(json.dumps(record_to_json(record)) + '\n')
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+    yield ''.join(lines)
+
+
+# Generator that streams statements as a printable HTML document, one section per account ending with its closing balance
+def export_html(account_id=None):
+    headings = ''.join(f'<th>{escape(name)}</th>' for name in ['Date', 'Amount', 'Balance', 'Coupon', 'Code', 'Redeemed'])
+    yield f'<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<title>Statements</title>\n<style>{STATEMENT_STYLE}</style>\n</head>\n<body>\n'
+
+    current_account = None
+    balance = 0
+    lines = []
+    for record in iter_statement_rows(account_id):
+        if record['account_id'] != current_account:
+            # Close the previous account's section and open a new one
+            if current_account is not None:
+                lines.append(f'</tbody></table>\n<p>Closing balance: {balance}</p>\n</section>\n')
+            current_account = record['account_id']
+            owner = ' '.join(part for part in (record['first_name'], record['last_name']) if part)
+            lines.append(
+                f"<section>\n<h1>Statement for {escape(owner)} ({escape(record['user_name'] or '')})</h1>\n"
+                f"<p>Account {current_account}</p>\n<table><thead><tr>{headings}</tr></thead><tbody>\n"
+            )
+        balance = record['balance']
+        cells = [record['dateTime'], record['amount'], record['balance'], record['coupon_name'], record['coupon_code'], record['date_redeemed']]
+        lines.append('<tr>' + ''.join(f"<td>{escape('' if value is None else value)}</td>" for value in cells) + '</tr>\n')
+        if len(lines) >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+    if current_account is not None:
+        lines.append(f'</tbody></table>\n<p>Closing balance: {balance}</p>\n</section>\n')
+    lines.append('</body>\n</html>\n')
+    yield ''.join(lines)
+
+
+# Export formats, as (generator, mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': (export_csv, 'text/csv', 'csv'),
+    'jsonl': (export_jsonl, 'application/x-ndjson', 'jsonl'),
+    'html': (export_html, 'text/html', 'html'),
+}
+
+
+# Command to write the statements of one account, or of every account, to a file, e.g. at the end of term
+@click.command('export-statements')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--account-id', type=int, default=None, help='Only export this account, instead of every account.')
+@click.option('--output', type=click.File('w'), default='-', help='File to write to, defaults to standard output.')
+@with_appcontext
+def export_statements_command(export_format, account_id, output):
+    export, _, _ = EXPORT_FORMATS[export_format]
+    for chunk in export(account_id):
+        output.write(chunk)
@@ -0,0 +1,93 @@
+from . import db
+from .models import User, Subject, Class
+from .roles import roles
+from .cache import cache
+from .naming import allocate_class_names, class_name_prefix
+from sqlalchemy import insert
+from flask.cli import with_appcontext
+import click
+import csv
+
+
+# Error raised when a timetable cannot be imported, listing every problem found
+class TimetableError(Exception):
+    def __init__(self, problems):
+        super().__init__('\n'.join(problems))
+        self.problems = problems
+
+
+# Function to create every class in a timetable in one transaction, rows are dicts with year_group, subject and teacher_email
+def create_timetable(rows):
+    rows = list(rows)
+    try:
+        # Look up every subject and teacher the timetable mentions with one query each
+        subjects = {subject.name: subject for subject in Subject.query.filter(Subject.name.in_({row['subject'] for row in rows}))}
+        teachers = {
+            teacher.email: teacher
+            for teacher in User.query.filter(User.email.in_({row['teacher_email'] for row in rows}), User.role_id == roles.id('teacher'))
+        }
+
+        # The classes these teachers already have, so importing the same timetable twice does not create them again
+        existing = set(
+            db.session.query(Class.subject_id, Class.year_group, Class.teacher_id)
+            .filter(Class.teacher_id.in_([teacher.id for teacher in teachers.values()]))
+        )
+
+        # Check every row before creating anything
+        problems = []
+        classes = []
+        seen = {}
+        for line, row in enumerate(rows, start=2):
+            subject = subjects.get(row['subject'])
+            teacher = teachers.get(row['teacher_email'])
+            year_group = row['year_group']
+            row_problems = []
+            if subject is None:
+                row_problems.append(f"line {line}: unknown subject {row['subject']}")
+            if teacher is None:
+                row_problems.append(f"line {line}: unknown teacher {row['teacher_email']}")
+            elif not teacher.role_approved:
+                row_problems.append(f"line {line}: teacher {row['teacher_email']} has not been approved")
+            if not str(year_group).isdigit():
+                row_problems.append(f'line {line}: invalid year group {year_group}')
+            elif not row_problems:
+                key = (subject.id, int(year_group), teacher.id)
+                if key in existing:
+                    row_problems.append(f"line {line}: {row['teacher_email']} already teaches year {year_group} {subject.name}")
+                elif key in seen:
+                    row_problems.append(f'line {line}: the same class as line {seen[key]}')
+                seen.setdefault(key, line)
+            problems.extend(row_problems)
+            if not row_problems:
+                classes.append({'subject_id': subject.id, 'year_group': int(year_group), 'teacher_id': teacher.id,
+                                'prefix': class_name_prefix(year_group, subject.name, teacher.first_name, teacher.last_name)})
+        if problems:
+            raise TimetableError(problems)
+
+        # Allocate every class name with one counter bump per distinct prefix, then insert all classes with one executemany
+        names = allocate_class_names([new_class.pop('prefix') for new_class in classes])
+        for new_class, name in zip(classes, names):
+            new_class['name'] = name
+        if classes:
+            db.session.execute(insert(Class), classes)
+
+        db.session.commit()
+        cache.invalidate('classes', 'year_groups')
+        return names
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# Command to create a whole timetable of classes from a CSV file with year_group, subject and teacher_email columns
+@click.command('import-timetable')
+@click.argument('timetable', type=click.File())
+@with_appcontext
+def import_timetable_command(timetable):
+    try:
+        names = create_timetable(csv.DictReader(timetable))
+    except TimetableError as error:
+        raise click.ClickException(f'no classes were created:\n{error}')
+    except KeyError as error:
+        raise click.ClickException(f'the timetable is missing the {error} column')
+    click.echo(f'created {len(names)} classes')
@@ -0,0 +1,58 @@
+from . import db
+from .models import EntityVersion
+from .sql import upsert_add
+import hashlib
+
+# Every piece of data served by the JSON API has a version stamp row that writes bump in the same transaction as the
+# change itself. An ETag is a hash of the stamps a response depends on, so a conditional GET only has to read those
+# few primary key rows to know the client's copy is still current, and the heavy queries are skipped.
+#
+# Stamps are kept per user, 'user:<id>', covering their balance, transactions, coupons, join requests and quota,
+# for changes to rows already in the ledger, 'ledger', and for the list of teachers, 'teachers'. Every ETag also includes the 'epoch'
+# stamp, which maintenance commands bump to invalidate everything at once. A posting only adds ledger rows, so the admin views
+# of every account are tagged with the ledger's highest transaction id as well, and postings never update a stamp all of
+# them would queue behind.
+
+# Stamp of the rows already in the ledger, bumped by the jobs that change them, e.g. to record redeem dates
+LEDGER = 'ledger'
+
+# Stamp of the list of teachers, bumped when teachers are added
+TEACHERS = 'teachers'
+
+# Stamp included in every ETag
+EPOCH = 'epoch'
+
+
+# Function to get the stamp name of a user's own data
+def user_entity(user_id):
+    return f'user:{user_id}'
+
+
+# Function to move the given stamps on to their next version, creating them if needed, in the current transaction
+def bump(*entities):
+    # Sorted so concurrent writers take the row locks in the same order
+    entities = sorted(set(entities))
+    if entities:
+        db.session.execute(upsert_add(EntityVersion, ['entity'], ['version']), [{'entity': entity, 'version': 1} for entity in entities])
+
+
+# Function to bump the stamps of the given users, for writes that change their balances or ledger rows
+def bump_ledger(*user_ids):
+    bump(*(user_entity(user_id) for user_id in user_ids))
+
+
+# Function to invalidate every ETag at once, for maintenance commands that rewrite data outside the posting service
+def bump_all():
+    bump(EPOCH)
+
+
+# Function to get the current version of each given stamp, with one primary key lookup
+def current(*entities):
+    found = dict(db.session.query(EntityVersion.entity, EntityVersion.version).filter(EntityVersion.entity.in_(entities)))
+    return [(entity, found.get(entity, 0)) for entity in entities]
+
+
+# Function to build the ETag of a response from the stamps it depends on and anything else that changes it, e.g. query arguments
+def etag(entities, *extra):
+    parts = [f'{entity}={version}' for entity, version in current(EPOCH, *entities)] + [repr(value) for value in extra]
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()